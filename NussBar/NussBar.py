@@ -1,19 +1,18 @@
 import os
-import unittest
 import vtk, qt, ctk, slicer
-import logging, time
-import numpy, math, slicer, math
+from vtk.util import numpy_support
+import colorsys, contextlib, importlib.util, logging, random, shutil, subprocess, sys, time, threading
 from slicer.ScriptedLoadableModule import *
-from numpy import mean
-from heapq import nsmallest
 import numpy as np
-try:
-  import trimesh
-except:
-  slicer.util.pip_install('trimesh')
-  import trimesh
-from scipy.optimize import curve_fit
-import random
+from NussBarLib import bending, cache, clearance, export, geometry, placement, planning, plans, profiling, segmentation, surface, sweep, tasks, thresholds, volumes
+
+# Packages needed beyond Slicer's own, by import name and pip name. They are
+# imported on first use, so a missing one only affects the features using it.
+DEPENDENCIES = {'scipy': 'scipy'}
+
+def missingDependencies():
+  """pip names of the dependencies that cannot be imported, without importing them"""
+  return [package for name, package in DEPENDENCIES.items() if importlib.util.find_spec(name) is None]
 
 #
 # NussBar
@@ -48,6 +47,9 @@ class NussBarWidget(ScriptedLoadableModuleWidget):
   
   def setup(self):
     ScriptedLoadableModuleWidget.setup(self)
+    
+    # Keep one logic instance so that segmentation results stay cached between runs
+    self.logic = NussBarLogic()
 
     #####
     ## Visualize CT Scan area
@@ -72,7 +74,7 @@ class NussBarWidget(ScriptedLoadableModuleWidget):
     self.inputSelector.setMRMLScene( slicer.mrmlScene )
     self.inputFrame.layout().addWidget(self.inputSelector)
     
-    self.control_points = None
+    self.bar_points = None
 
 
     # Apply Button 'Create a quick mesh'
@@ -84,6 +86,139 @@ class NussBarWidget(ScriptedLoadableModuleWidget):
     # connections 'Create a quick mesh'
     self.applyButton2.connect('clicked(bool)', self.onApplyButton2)
 
+    # Thresholds and smoothing of the segmentation
+    self.presetSelector = qt.QComboBox()
+    self.presetSelector.addItems(list(thresholds.PRESETS))
+    self.presetSelector.toolTip = "Threshold range and smoothing for the tissue to segment"
+    self.meshFormLayout.addRow("Preset:", self.presetSelector)
+
+    self.thresholdRange = ctk.ctkRangeWidget()
+    self.thresholdRange.minimum = -1024
+    self.thresholdRange.maximum = 5000
+    self.thresholdRange.singleStep = 1
+    self.thresholdRange.decimals = 0
+    self.thresholdRange.toolTip = "Voxels with values in this range (HU for CT) are segmented"
+    self.meshFormLayout.addRow("Threshold:", self.thresholdRange)
+
+    self.kernelSize = qt.QDoubleSpinBox()
+    self.kernelSize.minimum = 0
+    self.kernelSize.maximum = 30
+    self.kernelSize.suffix = " mm"
+    self.kernelSize.specialValueText = "No smoothing"
+    self.kernelSize.toolTip = "Size of the median smoothing kernel"
+    self.meshFormLayout.addRow("Smoothing kernel:", self.kernelSize)
+
+    autoThresholdFrame = qt.QFrame()
+    autoThresholdFrame.setLayout(qt.QHBoxLayout())
+    autoThresholdFrame.layout().setContentsMargins(0, 0, 0, 0)
+    self.autoThresholdMethod = qt.QComboBox()
+    self.autoThresholdMethod.addItems(["Otsu", "Valley"])
+    self.autoThresholdMethod.toolTip = ("Otsu: best separation of the two classes of the histogram. "
+      "Valley: lowest point of the histogram between its two main peaks.")
+    autoThresholdFrame.layout().addWidget(self.autoThresholdMethod)
+    self.autoThresholdButton = qt.QPushButton("Auto Threshold")
+    self.autoThresholdButton.toolTip = "Set the minimum threshold from the histogram of the volume, within the range of the preset"
+    autoThresholdFrame.layout().addWidget(self.autoThresholdButton)
+    self.meshFormLayout.addRow("Automatic minimum:", autoThresholdFrame)
+
+    self.thresholdPreviewCheckBox = qt.QCheckBox()
+    self.thresholdPreviewCheckBox.checked = False
+    self.thresholdPreviewCheckBox.toolTip = "Show a coarse surface that follows the threshold and smoothing while they are adjusted"
+    self.meshFormLayout.addRow("Live preview:", self.thresholdPreviewCheckBox)
+    # Coalesce slider moves into one preview update
+    self.thresholdPreviewTimer = qt.QTimer()
+    self.thresholdPreviewTimer.singleShot = True
+    self.thresholdPreviewTimer.interval = 50
+    self.thresholdPreviewTimer.connect('timeout()', self.updateThresholdPreview)
+
+    self.presetSelector.connect('currentIndexChanged(int)', self.onPresetChanged)
+    self.autoThresholdButton.connect('clicked(bool)', self.onAutoThreshold)
+    self.thresholdRange.connect('valuesChanged(double,double)', self.scheduleThresholdPreview)
+    self.kernelSize.connect('valueChanged(double)', self.scheduleThresholdPreview)
+    self.thresholdPreviewCheckBox.connect('toggled(bool)', self.onThresholdPreviewToggled)
+    self.inputSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.scheduleThresholdPreview)
+    self.onPresetChanged()
+
+    # Region of the scan to segment
+    self.cropModeSelector = qt.QComboBox()
+    self.cropModeSelector.addItems(["Whole volume", "Around source points", "ROI node"])
+    self.cropModeSelector.toolTip = "Only segment the chest wall around the bar to save time and memory"
+    self.meshFormLayout.addRow("Segmented region:", self.cropModeSelector)
+
+    self.roiSelector = slicer.qMRMLNodeComboBox()
+    self.roiSelector.nodeTypes = ( ("vtkMRMLMarkupsROINode"), "" )
+    self.roiSelector.addEnabled = True
+    self.roiSelector.removeEnabled = False
+    self.roiSelector.noneEnabled = True
+    self.roiSelector.setMRMLScene( slicer.mrmlScene )
+    self.roiSelector.setToolTip( "Region of interest used when the segmented region is 'ROI node'" )
+    self.meshFormLayout.addRow("ROI: ", self.roiSelector)
+
+    self.cropPadding = qt.QDoubleSpinBox()
+    self.cropPadding.minimum = 0
+    self.cropPadding.maximum = 200
+    self.cropPadding.value = 30
+    self.cropPadding.suffix = " mm"
+    self.cropPadding.toolTip = "Margin added around the source points"
+    self.meshFormLayout.addRow("Padding:", self.cropPadding)
+
+    self.spacingScale = qt.QDoubleSpinBox()
+    self.spacingScale.minimum = 1
+    self.spacingScale.maximum = 8
+    self.spacingScale.singleStep = 0.5
+    self.spacingScale.value = 1
+    self.spacingScale.toolTip = "Segment the region at a coarser spacing (multiple of the original voxel spacing)"
+    self.meshFormLayout.addRow("Spacing scale:", self.spacingScale)
+
+    self.refineCheckBox = qt.QCheckBox()
+    self.refineCheckBox.checked = False
+    self.refineCheckBox.toolTip = ("After the coarse pass, segment again at the original spacing, only within the "
+      "bounds of the coarse surface (without the air around the body). With Run in background, the region is "
+      "segmented once at the original spacing.")
+    self.meshFormLayout.addRow("Refine at full resolution:", self.refineCheckBox)
+
+    # Optional export of the skin surface
+    self.exportFormatSelector = qt.QComboBox()
+    self.exportFormatSelector.addItems(["Don't save", "STL", "PLY", "GLB"])
+    self.exportFormatSelector.toolTip = "Also save the skin surface to a file, in the background"
+    self.meshFormLayout.addRow("Save skin surface:", self.exportFormatSelector)
+
+    self.exportDirectory = ctk.ctkPathLineEdit()
+    self.exportDirectory.filters = ctk.ctkPathLineEdit.Dirs
+    self.exportDirectory.toolTip = "Folder for the saved skin surface. Defaults to the folder of the volume file."
+    self.meshFormLayout.addRow("Save folder:", self.exportDirectory)
+
+    self.exportSimplify = qt.QDoubleSpinBox()
+    self.exportSimplify.minimum = 0
+    self.exportSimplify.maximum = 20
+    self.exportSimplify.singleStep = 0.5
+    self.exportSimplify.value = 0
+    self.exportSimplify.suffix = " mm"
+    self.exportSimplify.specialValueText = "Full resolution"
+    self.exportSimplify.toolTip = ("Merge the vertices of the saved surface within cells of this size, for smaller files. "
+      "GLB positions are also stored as 16-bit integers.")
+    self.meshFormLayout.addRow("Simplify saved surface:", self.exportSimplify)
+
+    self.backgroundCheckBox = qt.QCheckBox()
+    self.backgroundCheckBox.checked = False
+    self.backgroundCheckBox.toolTip = ("Segment on a worker thread with a cancellable progress dialog, so that several "
+      "volumes can be processed at once. With 'Refine', the region is processed at full resolution only.")
+    self.meshFormLayout.addRow("Run in background:", self.backgroundCheckBox)
+
+    self.workerThreads = qt.QSpinBox()
+    self.workerThreads.minimum = 1
+    self.workerThreads.maximum = max(os.cpu_count() or 1, 1)
+    self.workerThreads.value = self.workerThreads.maximum
+    self.workerThreads.toolTip = ("Threads used by the background segmentation. With more than one, the volume is "
+      "smoothed and meshed in blocks on all of them, with the same result.")
+    self.meshFormLayout.addRow("Worker threads:", self.workerThreads)
+
+    self.streamCheckBox = qt.QCheckBox()
+    self.streamCheckBox.checked = False
+    self.streamCheckBox.toolTip = ("Read the volume file (uncompressed NRRD or NIfTI) in slabs of slices in the background, "
+      "so that large scans fit in memory. The whole volume is segmented, without cropping.")
+    self.meshFormLayout.addRow("Stream from file:", self.streamCheckBox)
+
     #####
     ## Create Nuss Bar area
     #####
@@ -107,13 +242,72 @@ class NussBarWidget(ScriptedLoadableModuleWidget):
     self.SourceSelector.setToolTip( "Pick up a Markups node listing fiducials. The name must be different to model name" )
     parametersFormLayout.addRow("Source points: ", self.SourceSelector)
     
+    # Propose source points from the CT scan
+    self.autoPlaceButton = qt.QPushButton("Place Automatically")
+    self.autoPlaceButton.toolTip = ("Find the sternal depression in the input volume, create source points across the "
+      "chest at its deepest level and draw the bar")
+    parametersFormLayout.addRow(self.autoPlaceButton)
+    self.autoPlaceButton.connect('clicked(bool)', self.onAutoPlace)
+    
+    self.hallerIndex = qt.QLineEdit()
+    self.hallerIndex.text = '...'
+    self.hallerIndex.readOnly = True
+    self.hallerIndex.frame = True
+    self.hallerIndex.styleSheet = "QLineEdit { background:transparent; }"
+    parametersFormLayout.addRow("Haller Index:", self.hallerIndex)
+    
     # Textbox for Bar Length
     self.barLength = qt.QLineEdit()
-    self.barLength.text = '12'
+    self.barLength.text = ''
+    self.barLength.placeholderText = 'Curve length'
+    self.barLength.toolTip = "Trim or extend the bar about its middle to this length. Leave empty to keep the curve length."
     self.barLength.frame = True
     self.barLength.cursor = qt.QCursor(qt.Qt.IBeamCursor)
     parametersFormLayout.addRow("Physical Bar Length (in):", self.barLength)
 
+    # Surface the bar curve can be snapped to
+    self.snapCheckBox = qt.QCheckBox()
+    self.snapCheckBox.checked = False
+    self.snapCheckBox.toolTip = "Project the bar curve onto the selected surface instead of following the raw fiducials"
+    parametersFormLayout.addRow("Snap to surface:", self.snapCheckBox)
+
+    self.snapSurfaceSelector = slicer.qMRMLNodeComboBox()
+    self.snapSurfaceSelector.nodeTypes = ( ("vtkMRMLModelNode"), "" )
+    self.snapSurfaceSelector.addEnabled = False
+    self.snapSurfaceSelector.removeEnabled = False
+    self.snapSurfaceSelector.noneEnabled = True
+    self.snapSurfaceSelector.setMRMLScene( slicer.mrmlScene )
+    self.snapSurfaceSelector.setToolTip( "Skin or bone surface, for example the model made by 'Create 3D Model'" )
+    parametersFormLayout.addRow("Surface: ", self.snapSurfaceSelector)
+
+    self.clearance = qt.QDoubleSpinBox()
+    self.clearance.minimum = -50
+    self.clearance.maximum = 50
+    self.clearance.value = 2
+    self.clearance.suffix = " mm"
+    self.clearance.toolTip = "Distance kept between the bar curve and the surface, on the side most fiducials are on"
+    parametersFormLayout.addRow("Clearance:", self.clearance)
+
+    # Smoothing of noisy fiducials
+    self.fitTolerance = qt.QDoubleSpinBox()
+    self.fitTolerance.minimum = 0
+    self.fitTolerance.maximum = 20
+    self.fitTolerance.singleStep = 0.5
+    self.fitTolerance.value = 0
+    self.fitTolerance.suffix = " mm"
+    self.fitTolerance.specialValueText = "Through every point"
+    self.fitTolerance.toolTip = "Fit a smooth curve within this RMS distance of the source points instead of through each of them"
+    parametersFormLayout.addRow("Fit tolerance:", self.fitTolerance)
+    
+    self.outlierDistance = qt.QDoubleSpinBox()
+    self.outlierDistance.minimum = 0
+    self.outlierDistance.maximum = 100
+    self.outlierDistance.value = 0
+    self.outlierDistance.suffix = " mm"
+    self.outlierDistance.specialValueText = "Keep all points"
+    self.outlierDistance.toolTip = "Ignore source points farther than this from the smooth curve, e.g. misplaced clicks"
+    parametersFormLayout.addRow("Reject outliers beyond:", self.outlierDistance)
+    
     # Apply Button "Draw Bar Shape"
     self.applyButtonDraw = qt.QPushButton("Draw Bar Shape")
     self.applyButtonDraw.toolTip = "Draw the Nuss Bar Shape given the fiducials"
@@ -122,6 +316,26 @@ class NussBarWidget(ScriptedLoadableModuleWidget):
     # connections "Draw Bar Shape"
     self.applyButtonDraw.connect('clicked(bool)', self.onApplyButtonDraw)
     
+    # Redraw while the fiducials are being moved
+    self.livePreviewCheckBox = qt.QCheckBox()
+    self.livePreviewCheckBox.checked = False
+    self.livePreviewCheckBox.toolTip = "Update the bar shape and lengths while source points are added, moved or removed"
+    parametersFormLayout.addRow("Live preview:", self.livePreviewCheckBox)
+    self.sourceObservations = []
+    # Coalesce point events to at most one update per display frame
+    self.previewTimer = qt.QTimer()
+    self.previewTimer.singleShot = True
+    self.previewTimer.interval = 16
+    self.previewTimer.connect('timeout()', self.updatePreview)
+    self.livePreviewCheckBox.connect('toggled(bool)', self.observeSourcePoints)
+    self.SourceSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.observeSourcePoints)
+    self.barLength.connect('textChanged(QString)', self.schedulePreview)
+    self.snapCheckBox.connect('toggled(bool)', self.schedulePreview)
+    self.snapSurfaceSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.schedulePreview)
+    self.clearance.connect('valueChanged(double)', self.schedulePreview)
+    self.fitTolerance.connect('valueChanged(double)', self.schedulePreview)
+    self.outlierDistance.connect('valueChanged(double)', self.schedulePreview)
+    
     # Textbox for Markup Bar Length
     self.markupBarLength = qt.QLineEdit()
     self.markupBarLength.text = '...'
@@ -140,6 +354,20 @@ class NussBarWidget(ScriptedLoadableModuleWidget):
     self.generatedBarLength.styleSheet = "QLineEdit { background:transparent; }"
     parametersFormLayout.addRow("Generated Bar Length (in):", self.generatedBarLength)
     
+    # Bar cross-section profile
+    self.barProfile = qt.QComboBox()
+    self.barProfile.addItems(["Rectangular", "Rounded"])
+    self.barProfile.toolTip = "Cross-section swept along the bar curve"
+    parametersFormLayout.addRow("Bar Profile:", self.barProfile)
+    
+    # Number of samples along the bar
+    self.barSamples = qt.QSpinBox()
+    self.barSamples.minimum = 10
+    self.barSamples.maximum = 100000
+    self.barSamples.value = 1000
+    self.barSamples.toolTip = "Number of cross-sections along the output bar mesh"
+    parametersFormLayout.addRow("Bar Resolution:", self.barSamples)
+    
     # Apply Button "Output Generated Nuss Bar"
     self.applyButtonOutput = qt.QPushButton("Output Nuss Bar")
     self.applyButtonOutput.toolTip = "Output the Nuss Bar Shape given the fiducials"
@@ -148,30 +376,475 @@ class NussBarWidget(ScriptedLoadableModuleWidget):
     # connections "Output Generated Nuss Bar"
     self.applyButtonOutput.connect('clicked(bool)', self.onApplyButtonOutput) # NEED
 
+    # Bend table for shaping the bar on a bender
+    self.bendTolerance = qt.QDoubleSpinBox()
+    self.bendTolerance.minimum = 0.05
+    self.bendTolerance.maximum = 10
+    self.bendTolerance.singleStep = 0.25
+    self.bendTolerance.value = 1
+    self.bendTolerance.suffix = " mm"
+    self.bendTolerance.toolTip = "Largest distance allowed between the bent bar and the drawn bar"
+    parametersFormLayout.addRow("Bend tolerance:", self.bendTolerance)
+    
+    self.bendSpacing = qt.QDoubleSpinBox()
+    self.bendSpacing.minimum = 0
+    self.bendSpacing.maximum = 100
+    self.bendSpacing.value = 0
+    self.bendSpacing.suffix = " mm"
+    self.bendSpacing.specialValueText = "Any"
+    self.bendSpacing.toolTip = "Smallest distance between two bends the bender can make"
+    parametersFormLayout.addRow("Min bend spacing:", self.bendSpacing)
+    
+    self.bendButton = qt.QPushButton("Bend Instructions...")
+    self.bendButton.toolTip = ("Find the fewest bends that shape a straight bar like the drawn bar, show the bent bar "
+      "and save the bend table")
+    parametersFormLayout.addRow(self.bendButton)
+    self.bendButton.connect('clicked(bool)', self.onBendInstructions)
+    
+    self.bendResult = qt.QLineEdit()
+    self.bendResult.text = '...'
+    self.bendResult.readOnly = True
+    self.bendResult.styleSheet = "QLineEdit { background:transparent; }"
+    parametersFormLayout.addRow("Bends:", self.bendResult)
+
+    # Clearance of the drawn bar from the selected surface
+    self.contactDistance = qt.QDoubleSpinBox()
+    self.contactDistance.minimum = 0
+    self.contactDistance.maximum = 20
+    self.contactDistance.singleStep = 0.5
+    self.contactDistance.value = 1
+    self.contactDistance.suffix = " mm"
+    self.contactDistance.toolTip = "Parts of the bar closer than this to the surface are reported as contacts"
+    parametersFormLayout.addRow("Contact distance:", self.contactDistance)
+    
+    self.analyzeClearanceButton = qt.QPushButton("Analyze Clearance")
+    self.analyzeClearanceButton.toolTip = ("Color the drawn bar by its distance to the selected surface and "
+      "mark the predicted contact points")
+    parametersFormLayout.addRow(self.analyzeClearanceButton)
+    self.analyzeClearanceButton.connect('clicked(bool)', self.onAnalyzeClearance)
+    
+    self.clearanceResult = qt.QLineEdit()
+    self.clearanceResult.text = '...'
+    self.clearanceResult.readOnly = True
+    self.clearanceResult.styleSheet = "QLineEdit { background:transparent; }"
+    parametersFormLayout.addRow("Min clearance:", self.clearanceResult)
+
+    #####
+    ## Plan files
+    #####
+    plansCollapsibleButton = ctk.ctkCollapsibleButton()
+    plansCollapsibleButton.text = "Plan Files"
+    plansCollapsibleButton.collapsed = True
+    self.layout.addWidget(plansCollapsibleButton)
+    plansFormLayout = qt.QFormLayout(plansCollapsibleButton)
+    
+    planButtons = qt.QHBoxLayout()
+    self.savePlanButton = qt.QPushButton("Save Plan...")
+    self.savePlanButton.toolTip = ("Save the source points, fitted curve, bar, settings above and a reference to the "
+      "selected surface, to reopen the case without segmenting and drawing again")
+    planButtons.addWidget(self.savePlanButton)
+    self.loadPlanButton = qt.QPushButton("Load Plan...")
+    self.loadPlanButton.toolTip = "Restore the source points, bar, surface and settings of a saved plan"
+    planButtons.addWidget(self.loadPlanButton)
+    self.reviewPlansButton = qt.QPushButton("Review Plans...")
+    self.reviewPlansButton.toolTip = "Show the bars of many saved plans side by side"
+    planButtons.addWidget(self.reviewPlansButton)
+    plansFormLayout.addRow(planButtons)
+    self.savePlanButton.connect('clicked(bool)', self.onSavePlan)
+    self.loadPlanButton.connect('clicked(bool)', self.onLoadPlan)
+    self.reviewPlansButton.connect('clicked(bool)', self.onReviewPlans)
+    
+    self.plansTable = qt.QTableWidget()
+    self.plansTable.setColumnCount(6)
+    self.plansTable.setHorizontalHeaderLabels(["Plan", "Curve (in)", "Bar (in)", "Fiducials", "Surface", "Saved"])
+    self.plansTable.editTriggers = qt.QAbstractItemView.NoEditTriggers
+    self.plansTable.verticalHeader().visible = False
+    self.plansTable.horizontalHeader().setSectionResizeMode(0, qt.QHeaderView.Stretch)
+    self.plansTable.toolTip = "Double-click a plan to load it"
+    plansFormLayout.addRow(self.plansTable)
+    self.plansTable.connect('cellDoubleClicked(int,int)', self.onReviewedPlanDoubleClicked)
+    self.reviewedPlanPaths = []
+
+    #####
+    ## Compare candidate bars
+    #####
+    candidatesCollapsibleButton = ctk.ctkCollapsibleButton()
+    candidatesCollapsibleButton.text = "Compare Candidates"
+    candidatesCollapsibleButton.collapsed = True
+    self.layout.addWidget(candidatesCollapsibleButton)
+    candidatesFormLayout = qt.QFormLayout(candidatesCollapsibleButton)
+    
+    self.candidateSelector = slicer.qMRMLCheckableNodeComboBox()
+    self.candidateSelector.nodeTypes = ["vtkMRMLMarkupsFiducialNode"]
+    self.candidateSelector.setMRMLScene( slicer.mrmlScene )
+    self.candidateSelector.setToolTip( "Markups nodes with the fiducials of each candidate bar" )
+    candidatesFormLayout.addRow("Candidate points:", self.candidateSelector)
+    
+    self.candidateLevels = qt.QSpinBox()
+    self.candidateLevels.minimum = 1
+    self.candidateLevels.maximum = 9
+    self.candidateLevels.value = 1
+    self.candidateLevels.toolTip = "Also plan copies of each candidate moved up and down along the sternum"
+    candidatesFormLayout.addRow("Levels:", self.candidateLevels)
+    
+    self.candidateLevelSpacing = qt.QDoubleSpinBox()
+    self.candidateLevelSpacing.minimum = 1
+    self.candidateLevelSpacing.maximum = 100
+    self.candidateLevelSpacing.value = 25
+    self.candidateLevelSpacing.suffix = " mm"
+    self.candidateLevelSpacing.toolTip = "Distance between levels, about one intercostal space"
+    candidatesFormLayout.addRow("Level spacing:", self.candidateLevelSpacing)
+    
+    self.planCandidatesButton = qt.QPushButton("Plan Candidates")
+    self.planCandidatesButton.toolTip = ("Plan every candidate with the bar length, surface, clearance, profile and "
+      "resolution above, and rank them")
+    candidatesFormLayout.addRow(self.planCandidatesButton)
+    self.planCandidatesButton.connect('clicked(bool)', self.onPlanCandidates)
+    
+    self.candidatesTable = qt.QTableWidget()
+    self.candidatesTable.setColumnCount(8)
+    self.candidatesTable.setHorizontalHeaderLabels(["Rank", "Candidate", "Curve (in)", "Bar (in)",
+      "Min bend radius (mm)", "Min clearance (mm)", "Mean clearance (mm)", "Too close"])
+    self.candidatesTable.editTriggers = qt.QAbstractItemView.NoEditTriggers
+    self.candidatesTable.verticalHeader().visible = False
+    self.candidatesTable.horizontalHeader().setSectionResizeMode(1, qt.QHeaderView.Stretch)
+    candidatesFormLayout.addRow(self.candidatesTable)
+
+    #####
+    ## Timing of the last runs
+    #####
+    timingCollapsibleButton = ctk.ctkCollapsibleButton()
+    timingCollapsibleButton.text = "Timing"
+    timingCollapsibleButton.collapsed = True
+    self.layout.addWidget(timingCollapsibleButton)
+    timingFormLayout = qt.QFormLayout(timingCollapsibleButton)
+    
+    self.timingTable = qt.QTableWidget()
+    self.timingTable.setColumnCount(6)
+    self.timingTable.setHorizontalHeaderLabels(["Step", "Stage", "Calls", "Wall (s)", "CPU (s)", "Memory (MiB)"])
+    self.timingTable.editTriggers = qt.QAbstractItemView.NoEditTriggers
+    self.timingTable.verticalHeader().visible = False
+    self.timingTable.horizontalHeader().setSectionResizeMode(1, qt.QHeaderView.Stretch)
+    timingFormLayout.addRow(self.timingTable)
+    
+    timingButtons = qt.QHBoxLayout()
+    self.clearTimingButton = qt.QPushButton("Clear")
+    self.clearTimingButton.toolTip = "Forget the recorded timings"
+    timingButtons.addWidget(self.clearTimingButton)
+    self.exportTraceButton = qt.QPushButton("Export Trace...")
+    self.exportTraceButton.toolTip = "Save the recorded timings in Chrome trace format (chrome://tracing, ui.perfetto.dev)"
+    timingButtons.addWidget(self.exportTraceButton)
+    timingFormLayout.addRow(timingButtons)
+    self.clearTimingButton.connect('clicked(bool)', self.onClearTiming)
+    self.exportTraceButton.connect('clicked(bool)', self.onExportTrace)
+    self.logic.timingChanged = self.updateTimingTable
+
     # Add vertical spacer
     self.layout.addStretch(1)
 
+    # Offer missing dependencies once the module is shown, never at application start
+    self.dependencyPrompt = None
+    qt.QTimer.singleShot(0, self.offerDependencyInstall)
+
+  def offerDependencyInstall(self):
+    """Ask, without blocking the application, whether to install missing dependencies"""
+    missing = missingDependencies()
+    if not missing:
+      return
+    self.dependencyPrompt = qt.QMessageBox(qt.QMessageBox.Question, 'Nuss Bar',
+      'ShapeNuss needs the Python packages ' + ', '.join(missing) + '. Install them now in the background?',
+      qt.QMessageBox.Yes | qt.QMessageBox.No, slicer.util.mainWindow())
+    self.dependencyPrompt.setModal(False)
+
+    def onFinished(result):
+      if result == qt.QMessageBox.Yes:
+        self.logic.installDependencies(missing)
+      self.dependencyPrompt = None
+
+    self.dependencyPrompt.connect('finished(int)', onFinished)
+    self.dependencyPrompt.show()
+
 
   def cleanup(self):
-    pass
+    self.logic.taskRunner.cancel_all()
+    self.logic.timingChanged = None
+    self.previewTimer.stop()
+    self.thresholdPreviewTimer.stop()
+    self.removeSourceObservers()
+  
+  def removeSourceObservers(self):
+    for node, tag in self.sourceObservations:
+      node.RemoveObserver(tag)
+    self.sourceObservations = []
+  
+  def observeSourcePoints(self, *args):
+    """Follow point events of the source node while live preview is on"""
+    self.removeSourceObservers()
+    node = self.SourceSelector.currentNode()
+    if not self.livePreviewCheckBox.checked or not node:
+      return
+    for event in (slicer.vtkMRMLMarkupsNode.PointModifiedEvent, slicer.vtkMRMLMarkupsNode.PointAddedEvent,
+        slicer.vtkMRMLMarkupsNode.PointRemovedEvent):
+      self.sourceObservations.append((node, node.AddObserver(event, self.onSourcePointsModified)))
+    self.schedulePreview()
+  
+  def onSourcePointsModified(self, caller, event):
+    self.schedulePreview()
+  
+  def schedulePreview(self, *args):
+    """Update the preview on the next timer tick; events until then share that update"""
+    if self.livePreviewCheckBox.checked and not self.previewTimer.active:
+      self.previewTimer.start()
+  
+  def updatePreview(self):
+    node = self.SourceSelector.currentNode()
+    if not node:
+      return
+    snapSurfaceNode = self.snapSurfaceSelector.currentNode() if self.snapCheckBox.checked else None
+    result = self.logic.updatePreview(node, snapSurfaceNode=snapSurfaceNode, clearanceMm=self.clearance.value,
+      barLengthMm=self.barLengthMm(), fitToleranceMm=self.fitTolerance.value,
+      outlierDistanceMm=self.outlierDistance.value)
+    if not result:
+      return
+    markupLength, generatedLength, self.bar_points = result
+    self.markupBarLength.text = str(markupLength)
+    self.generatedBarLength.text = str(generatedLength)
+  
+  def updateTimingTable(self):
+    """Show the time and memory spent in each stage so far"""
+    rows = self.logic.profiler.breakdown()
+    self.timingTable.setRowCount(len(rows))
+    for row, stage in enumerate(rows):
+      memory = '' if stage['rssDelta'] is None else '%.1f' % (stage['rssDelta'] / 1024**2)
+      values = [stage['category'], stage['name'], str(stage['calls']), '%.3f' % stage['wall'], '%.3f' % stage['cpu'], memory]
+      for column, value in enumerate(values):
+        self.timingTable.setItem(row, column, qt.QTableWidgetItem(value))
+  
+  def onClearTiming(self):
+    self.logic.profiler.clear()
+    self.updateTimingTable()
+  
+  def onExportTrace(self):
+    path = qt.QFileDialog.getSaveFileName(None, 'Export Trace', 'NussBarTrace.json', 'JSON (*.json)')
+    if path:
+      self.logic.profiler.write_chrome_trace(path)
   
   def onApplyButtonOutput(self):
-    logic = NussBarLogic()
+    logic = self.logic
     self.applyButtonOutput.text = "Working..."
     slicer.app.processEvents()
     
-    if (self.control_points == None):
+    if self.bar_points is None:
       slicer.util.errorDisplay("Please draw the bar shape first.")
       return
     
-    logic.output(self.control_points)
+    logic.output(self.bar_points, self.barProfile.currentText.lower(), self.barSamples.value)
     self.applyButtonOutput.text = "Output Nuss Bar"
+    self.updateTimingTable()
+
+  def onBendInstructions(self):
+    if self.bar_points is None:
+      slicer.util.errorDisplay("Please draw the bar shape first.")
+      return
+    table = self.logic.bendInstructions(self.bar_points, self.bendTolerance.value, self.bendSpacing.value)
+    self.updateTimingTable()
+    if table:
+      self.bendResult.text = '%d bend%s, max deviation %.2f mm' % (len(table.bends),
+        '' if len(table.bends) == 1 else 's', table.max_deviation)
 
+  def onAnalyzeClearance(self):
+    if self.bar_points is None:
+      slicer.util.errorDisplay("Please draw the bar shape first.")
+      return
+    surfaceNode = self.snapSurfaceSelector.currentNode()
+    if not surfaceNode:
+      slicer.util.errorDisplay("Select the surface to measure the clearance from.")
+      return
+    result = self.logic.analyzeClearance(self.bar_points, surfaceNode, self.barProfile.currentText.lower(),
+      self.barSamples.value, self.contactDistance.value)
+    self.updateTimingTable()
+    self.clearanceResult.text = '%.1f mm, %d contact%s' % (result.min_clearance, len(result.contacts),
+      '' if len(result.contacts) == 1 else 's')
+
+  def onAutoPlace(self):
+    result = self.logic.autoPlace(self.inputSelector.currentNode(), **self.segmentationParameters())
+    self.updateTimingTable()
+    if not result:
+      return
+    fiducialNode, proposal = result
+    self.hallerIndex.text = '%.2f (depression %.1f mm)' % (proposal.haller_index, proposal.depression_depth)
+    self.SourceSelector.setCurrentNode(fiducialNode)
+    self.onApplyButtonDraw()
+  
+  def onPlanCandidates(self):
+    surfaceNode = self.snapSurfaceSelector.currentNode()
+    candidates = self.logic.planCandidates(self.candidateSelector.checkedNodes(), self.candidateLevels.value,
+      self.candidateLevelSpacing.value, surfaceNode, self.snapCheckBox.checked, self.clearance.value,
+      self.barLengthMm(), self.barSamples.value, self.barProfile.currentText.lower(),
+      self.fitTolerance.value, self.outlierDistance.value)
+    self.candidatesTable.setRowCount(len(candidates))
+    for row, candidate in enumerate(candidates):
+      summary = candidate.summary()
+      def number(key, format='%.2f'):
+        return '' if summary[key] is None else format % summary[key]
+      values = [str(summary['rank']), summary['name'], number('curveLengthIn'), number('barLengthIn'),
+        number('minBendRadiusMm', '%.1f'), number('minClearanceMm'), number('meanClearanceMm'),
+        'passes through' if summary['penetrates'] else 'yes' if summary['tooClose'] else '']
+      for column, value in enumerate(values):
+        self.candidatesTable.setItem(row, column, qt.QTableWidgetItem(value))
+    self.updateTimingTable()
+
+  def planParameters(self):
+    """Settings of the drawn bar, stored in plan files by the keyword names of NussBarLib"""
+    return {
+      'bar_length': self.barLengthMm(),
+      'snap': self.snapCheckBox.checked,
+      'clearance': self.clearance.value,
+      'fit_tolerance': self.fitTolerance.value,
+      'outlier_distance': self.outlierDistance.value,
+      'profile': self.barProfile.currentText.lower(),
+      'samples': self.barSamples.value,
+      'contact_distance': self.contactDistance.value,
+      'bend_tolerance': self.bendTolerance.value,
+      'bend_spacing': self.bendSpacing.value,
+      'preset': self.presetSelector.currentText,
+      'minimum_threshold': self.thresholdRange.minimumValue,
+      'maximum_threshold': self.thresholdRange.maximumValue,
+      'kernel_size_mm': self.kernelSize.value,
+    }
+  
+  def setPlanParameters(self, parameters):
+    """Show the settings of a plan, keeping the current value of those it lacks"""
+    if 'bar_length' in parameters:
+      barLength = parameters['bar_length']
+      self.barLength.text = '%g' % round(geometry.mm_to_in(barLength), 4) if barLength else ''
+    if 'snap' in parameters:
+      self.snapCheckBox.checked = bool(parameters['snap'])
+    if parameters.get('profile'):
+      self.barProfile.currentIndex = max(self.barProfile.findText(parameters['profile'].capitalize()), 0)
+    # The preset first, as choosing it resets the thresholds and kernel size
+    if parameters.get('preset') in thresholds.PRESETS:
+      self.presetSelector.currentIndex = self.presetSelector.findText(parameters['preset'])
+    if parameters.get('minimum_threshold') is not None and parameters.get('maximum_threshold') is not None:
+      self.thresholdRange.setValues(parameters['minimum_threshold'], parameters['maximum_threshold'])
+    for key, spinBox in (('clearance', self.clearance), ('fit_tolerance', self.fitTolerance),
+        ('outlier_distance', self.outlierDistance), ('samples', self.barSamples),
+        ('contact_distance', self.contactDistance), ('bend_tolerance', self.bendTolerance),
+        ('bend_spacing', self.bendSpacing), ('kernel_size_mm', self.kernelSize)):
+      if parameters.get(key) is not None:
+        spinBox.value = parameters[key]
+  
+  def onSavePlan(self):
+    node = self.SourceSelector.currentNode()
+    if not node:
+      slicer.util.errorDisplay("Select the source points of the bar first.")
+      return
+    path = qt.QFileDialog.getSaveFileName(None, 'Save Plan', node.GetName() + plans.MANIFEST_EXTENSION,
+      'Nuss bar plan (*%s)' % plans.MANIFEST_EXTENSION)
+    if not path:
+      return
+    self.logic.savePlan(path, node, self.snapSurfaceSelector.currentNode(), self.planParameters())
+    self.updateTimingTable()
+  
+  def onLoadPlan(self, checked=False, path=None):
+    if not path:
+      path = qt.QFileDialog.getOpenFileName(None, 'Load Plan', '', 'Nuss bar plan (*%s)' % plans.MANIFEST_EXTENSION)
+    if not path:
+      return
+    result = self.logic.loadPlan(path)
+    self.updateTimingTable()
+    if not result:
+      return
+    plan, fiducialNode, surfaceNode = result
+    self.SourceSelector.setCurrentNode(fiducialNode)
+    if surfaceNode:
+      self.snapSurfaceSelector.setCurrentNode(surfaceNode)
+    self.setPlanParameters(plan.parameters)
+    self.bar_points = plan.bar_points
+    summary = plan.summary()
+    self.markupBarLength.text = str(summary['markupBarLengthIn'])
+    self.generatedBarLength.text = str(summary['generatedBarLengthIn'])
+  
+  def onReviewPlans(self):
+    paths = qt.QFileDialog.getOpenFileNames(None, 'Review Plans', '', 'Nuss bar plan (*%s)' % plans.MANIFEST_EXTENSION)
+    if not paths:
+      return
+    loaded, errors = self.logic.reviewPlans(list(paths))
+    self.updateTimingTable()
+    self.reviewedPlanPaths = [path for path in paths if path not in dict(errors)]
+    self.plansTable.setRowCount(len(loaded))
+    for row, plan in enumerate(loaded):
+      summary = plan.summary()
+      values = [summary['name'], '%.2f' % summary['markupBarLengthIn'], '%.2f' % summary['generatedBarLengthIn'],
+        str(summary['numberOfFiducials']), summary['surface'] or '', summary['created'] or '']
+      for column, value in enumerate(values):
+        self.plansTable.setItem(row, column, qt.QTableWidgetItem(value))
+    if errors:
+      slicer.util.errorDisplay('%d plan%s could not be read:\n%s' % (len(errors), '' if len(errors) == 1 else 's',
+        '\n'.join('%s: %s' % (os.path.basename(path), message) for path, message in errors)), windowTitle='Nuss Bar error')
+  
+  def onReviewedPlanDoubleClicked(self, row, column):
+    if 0 <= row < len(self.reviewedPlanPaths):
+      self.onLoadPlan(path=self.reviewedPlanPaths[row])
+  
+  def onPresetChanged(self, *args):
+    preset = thresholds.PRESETS[self.presetSelector.currentText]
+    self.thresholdRange.setValues(preset.minimum, preset.maximum)
+    self.kernelSize.value = preset.kernel_size_mm
+  
+  def onAutoThreshold(self):
+    minimum = self.logic.autoThreshold(self.inputSelector.currentNode(), self.presetSelector.currentText,
+      self.autoThresholdMethod.currentText.lower())
+    self.updateTimingTable()
+    if minimum is not None:
+      self.thresholdRange.minimumValue = round(minimum)
+  
+  def scheduleThresholdPreview(self, *args):
+    if self.thresholdPreviewCheckBox.checked:
+      self.thresholdPreviewTimer.start()
+  
+  def onThresholdPreviewToggled(self, checked):
+    if checked:
+      self.scheduleThresholdPreview()
+    else:
+      self.logic.removeOwned('preview')
+  
+  def updateThresholdPreview(self):
+    node = self.inputSelector.currentNode()
+    if node and self.thresholdPreviewCheckBox.checked:
+      self.logic.previewThreshold(node, self.thresholdRange.minimumValue, self.thresholdRange.maximumValue,
+        self.kernelSize.value)
+  
+  def segmentationParameters(self):
+    """Thresholds and kernel size chosen in the widget, as keyword arguments of the logic"""
+    return {'minimumThreshold': self.thresholdRange.minimumValue, 'maximumThreshold': self.thresholdRange.maximumValue,
+      'kernelSizeMm': self.kernelSize.value}
+  
   def onApplyButton2(self):
-    logic = NussBarLogic()
+    logic = self.logic
     slicer.app.processEvents()
-    logic.mesh(self.inputSelector.currentNode())
+    cropMode = self.cropModeSelector.currentText
+    cropRoiNode = self.roiSelector.currentNode() if cropMode == "ROI node" else None
+    cropFiducialNode = self.SourceSelector.currentNode() if cropMode == "Around source points" else None
+    exportFormat = self.exportFormatSelector.currentText if self.exportFormatSelector.currentIndex > 0 else None
+    if self.streamCheckBox.checked:
+      logic.meshFromFile(self.inputSelector.currentNode(),
+        exportFormat=exportFormat, exportDirectory=self.exportDirectory.currentPath,
+        exportCellSizeMm=self.exportSimplify.value, **self.segmentationParameters())
+    elif self.backgroundCheckBox.checked:
+      logic.meshInBackground(self.inputSelector.currentNode(),
+        cropRoiNode=cropRoiNode, cropFiducialNode=cropFiducialNode, paddingMm=self.cropPadding.value,
+        spacingScale=1.0 if self.refineCheckBox.checked else self.spacingScale.value,
+        exportFormat=exportFormat, exportDirectory=self.exportDirectory.currentPath,
+        exportCellSizeMm=self.exportSimplify.value, workers=self.workerThreads.value, **self.segmentationParameters())
+    else:
+      logic.mesh(self.inputSelector.currentNode(),
+        cropRoiNode=cropRoiNode, cropFiducialNode=cropFiducialNode, paddingMm=self.cropPadding.value,
+        spacingScale=self.spacingScale.value, refine=self.refineCheckBox.checked,
+        exportFormat=exportFormat, exportDirectory=self.exportDirectory.currentPath,
+        exportCellSizeMm=self.exportSimplify.value, **self.segmentationParameters())
     self.applyButton2.text = "Create 3D Model"
+    self.updateTimingTable()
 
   def onSelect(self):
     self.applyButton.enabled = self.inputTargetModelSelector.currentNode() and self.outputSelector.currentNode()
@@ -180,28 +853,147 @@ class NussBarWidget(ScriptedLoadableModuleWidget):
     return self.applyButtonDraw
 
   def onApplyButtonDraw(self):
-    logic = NussBarLogic()
+    logic = self.logic
         
-    barL, control_points = logic.draw(self.SourceSelector, self.getButtonApplyDrawButton())
-    self.control_points = control_points
-    
-    modelNodes = slicer.util.getNodes('vtkMRMLModelNode*Line*')
-    logging.info('Model nodes: ' + str(modelNodes))
+    snapSurfaceNode = self.snapSurfaceSelector.currentNode() if self.snapCheckBox.checked else None
+    result = logic.draw(self.SourceSelector, self.getButtonApplyDrawButton(),
+      snapSurfaceNode=snapSurfaceNode, clearanceMm=self.clearance.value, barLengthMm=self.barLengthMm(),
+      fitToleranceMm=self.fitTolerance.value, outlierDistanceMm=self.outlierDistance.value)
+    self.updateTimingTable()
+    if not result:
+      self.applyButtonDraw.text = "Draw Bar Shape"
+      return
+    markupLength, generatedLength, barPoints = result
+    self.bar_points = barPoints
     
     self.applyButtonDraw.text = "Draw Bar Shape"
-    self.markupBarLength.text = str(barL)
+    self.markupBarLength.text = str(markupLength)
+    self.generatedBarLength.text = str(generatedLength)
+
+  def barLengthMm(self):
+    """Requested physical bar length in millimeters, or None (empty or 0) to keep the curve length"""
+    try:
+      length = float(self.barLength.text)
+    except ValueError:
+      return None
+    return geometry.in_to_mm(length) if length > 0 else None
 
 class NussBarLogic(ScriptedLoadableModuleLogic):
 
+  # Node attribute marking the nodes created by this module, and what they are for
+  ROLE_ATTRIBUTE = 'NussBar.Role'
+
   def __init__(self):
     self.StimulationPoint = 0
     self.M1Site = 0
     self.MTunadjusted = 100
     self.curve_actors = []  # List to keep track of curve actors
+    self.segmentationCache = cache.LRUCache()
+    self.volumeDigests = {}
+    self.exportThreads = []
+    self.taskRunner = tasks.TaskRunner()
+    self.taskWatchers = []
+    self.surfaceLocators = {}
+    self.profiler = profiling.Profiler()
+    # Called on the GUI thread when background work recorded new timings
+    self.timingChanged = None
+    # Node IDs, (renderer, actor) pairs and (object, observer tag) pairs created by this module, by role
+    self.ownedNodeIDs = {}
+    self.ownedActors = {}
+    self.ownedObservations = {}
+    self.adoptOwnedNodes()
+    # Persistent curve pipeline shared by draw and the live preview
+    self.curvePoints = vtk.vtkPoints()
+    self.curvePoints.SetDataTypeToDouble()
+    self.curveSource = vtk.vtkPolyLineSource()
+    self.curveSource.SetPoints(self.curvePoints)
+
+  def adoptOwnedNodes(self):
+    """Register the nodes a previous logic instance left in the scene"""
+    for i in range(slicer.mrmlScene.GetNumberOfNodes()):
+      node = slicer.mrmlScene.GetNthNode(i)
+      role = node.GetAttribute(self.ROLE_ATTRIBUTE)
+      if role:
+        self.ownedNodeIDs.setdefault(role, []).append(node.GetID())
+
+  @contextlib.contextmanager
+  def sceneBatch(self):
+    """Group scene changes so that observers process them once"""
+    slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+    try:
+      yield
+    finally:
+      slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+
+  def own(self, node, role):
+    """Tag a node as created by this module so that it can be removed with removeOwned(role)"""
+    node.SetAttribute(self.ROLE_ATTRIBUTE, role)
+    self.ownedNodeIDs.setdefault(role, []).append(node.GetID())
+    return node
+
+  def createNode(self, className, name, role):
+    return self.own(slicer.mrmlScene.AddNewNodeByClass(className, name), role)
+
+  def ownedNodes(self, role):
+    """Nodes of a role that are still in the scene"""
+    nodes = [slicer.mrmlScene.GetNodeByID(nodeID) for nodeID in self.ownedNodeIDs.get(role, [])]
+    return [node for node in nodes if node is not None and node.GetAttribute(self.ROLE_ATTRIBUTE) == role]
 
-  def mesh(self, inputVolume):
+  def addActor(self, renderer, actor, role):
+    """Add an actor (3D or 2D) to a renderer and remember it under role"""
+    renderer.AddViewProp(actor)
+    self.ownedActors.setdefault(role, []).append((renderer, actor))
+    return actor
+
+  def addObserver(self, vtkObject, event, callback, role):
+    """Observe an object until the objects of role are removed"""
+    self.ownedObservations.setdefault(role, []).append((vtkObject, vtkObject.AddObserver(event, callback)))
+
+  def removeOwned(self, *roles):
+    """Remove the nodes and actors of the given roles in one batched scene change"""
+    with self.sceneBatch():
+      for role in roles:
+        for node in self.ownedNodes(role):
+          slicer.mrmlScene.RemoveNode(node)
+        self.ownedNodeIDs.pop(role, None)
+        for renderer, actor in self.ownedActors.pop(role, []):
+          renderer.RemoveViewProp(actor)
+        for vtkObject, tag in self.ownedObservations.pop(role, []):
+          vtkObject.RemoveObserver(tag)
+
+  def volumeDigest(self, volumeNode):
+    """
+    Content hash of a volume's voxels and geometry. Remembered per node until
+    the node or its image data is modified.
+    """
+    imageData = volumeNode.GetImageData()
+    mtime = (volumeNode.GetMTime(), imageData.GetMTime())
+    known = self.volumeDigests.get(volumeNode.GetID())
+    if known and known[0] == mtime:
+      return known[1]
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    ijkToRASElements = tuple(ijkToRAS.GetElement(i, j) for i in range(4) for j in range(4))
+    digest = cache.array_digest(slicer.util.arrayFromVolume(volumeNode), ijkToRASElements)
+    self.volumeDigests[volumeNode.GetID()] = (mtime, digest)
+    return digest
+
+  def mesh(self, inputVolume, minimumThreshold=100, maximumThreshold=5000, smoothingMethod="MEDIAN", kernelSizeMm=10,
+      cropRoiNode=None, cropFiducialNode=None, paddingMm=30.0, spacingScale=1.0, refine=False,
+      exportFormat=None, exportDirectory=None, exportCellSizeMm=0.0):
     """
     From the ExtractSkin.py of lassoan: https://gist.github.com/lassoan/1673b25d8e7913cbc245b4f09ed853f9
+    Thresholded and smoothed label maps and the final surface are cached, keyed on
+    the volume content and the parameters of each stage.
+    To only process part of the scan, give either an ROI node or a fiducial node
+    (cropped to the padded bounding box of its points). The cropped region is
+    processed with its spacing multiplied by spacingScale and, if refine is set,
+    processed again at the original spacing within the bounds of the coarse
+    surface (padded by a coarse voxel and half the kernel), which leaves out the
+    air around the body.
+    The surface is shown in a new model node. If exportFormat ("stl", "ply" or "glb")
+    is given, it is also written to exportDirectory (default: next to the volume
+    file) in a background thread, simplified to exportCellSizeMm if nonzero.
     """
     # verifies inputVolume is not empty
     if not inputVolume:
@@ -209,36 +1001,14 @@ class NussBarLogic(ScriptedLoadableModuleLogic):
         slicer.util.errorDisplay(error_text, windowTitle='Nuss Bar error', parent=None, standardButtons=None)
         return False
       
-    # delete previous model
-    for i in range(1, 1000):
-      try:
-        slicer.mrmlScene.RemoveNode(slicer.util.getNode('vtkMRMLModelNode'+str(i)))
-      except:
-        pass
-    
-    for i in range(11, 20):
-      try:
-        delete_node('ModelDisplay_'  + str(i))
-      except:
-        pass
-    
-    # delete previous segmentation
-    try:
-      for i in range(1, 1000):
-          slicer.mrmlScene.RemoveNode(slicer.util.getNode('vtkMRMLSegmentationNode'+str(i)))
-    except:
-      pass
+    with self.profiler.span('Remove previous results', 'mesh'):
+      # delete previous skin models, segmentations and leftovers of failed runs
+      self.removeOwned('skin', 'segmentation', 'temporary')
     
     # update view
     slicer.app.processEvents()
     # force render view
     slicer.app.layoutManager().threeDWidget(0).threeDView().forceRender()
-    
-    
-    # print all registered nodes
-    for i in range(0, slicer.mrmlScene.GetNumberOfNodes()):
-      logging.info(slicer.mrmlScene.GetNthNode(i).GetName())
-    
 
     logging.info('Processing started')
     # wait popup
@@ -247,202 +1017,525 @@ class NussBarLogic(ScriptedLoadableModuleLogic):
     slicer.app.processEvents()
     # model filename
     nom = inputVolume.GetName()
-    print(nom)
-    masterVolumeNode = slicer.util.getNode(nom)
+    masterVolumeNode = inputVolume
+    
+    roiNode = self.regionOfInterest(cropRoiNode, cropFiducialNode, paddingMm)
     
     ## Makes the Mesh
-    # Create segmentation
-    segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
-    segmentationNode.CreateDefaultDisplayNodes() # only needed for display
-    segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(masterVolumeNode)
-    addedSegmentID = segmentationNode.GetSegmentation().AddEmptySegment("skin")
-    
-    # Create segment editor to get access to effects
-    segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-    segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-    segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
-    segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
-    segmentEditorWidget.setSegmentationNode(segmentationNode)
-    segmentEditorWidget.setMasterVolumeNode(masterVolumeNode)
-    
-    # Thresholding
-    segmentEditorWidget.setActiveEffectByName("Threshold")
-    effect = segmentEditorWidget.activeEffect()
-    effect.setParameter("MinimumThreshold","100") # adjusting according to data
-    effect.setParameter("MaximumThreshold","5000") # adjusting according to data
-    effect.self().onApply()
-    progressBar.value = 10
-    
-    # Smoothing
-    segmentEditorWidget.setActiveEffectByName("Smoothing")
-    effect = segmentEditorWidget.activeEffect()
-    effect.setParameter("SmoothingMethod", "MEDIAN")
-    effect.setParameter("KernelSizeMm", 10)
-    effect.self().onApply()
-    print(nom)
-    progressBar.value = 30
-    
-    # Clean up
-    segmentEditorWidget = None
-    slicer.mrmlScene.RemoveNode(segmentEditorNode)
-    
-    # Make segmentation results visible in 3D
-    segmentationNode.CreateClosedSurfaceRepresentation()
-    
-    # Fix normals
-    surfaceMesh = vtk.vtkPolyData()
-    segmentationNode.GetClosedSurfaceRepresentation(addedSegmentID, surfaceMesh)
-    normals = vtk.vtkPolyDataNormals() # to normal data
-    normals.AutoOrientNormalsOn()
-    normals.ConsistencyOn() # to normal data
-    normals.SetInputData(surfaceMesh) # to normal data
-    normals.Update() # to normal data
-    surfaceMesh = normals.GetOutput() # to normal data
+    workingVolumeNode = masterVolumeNode
+    if roiNode:
+      # Coarse pass inside the region of interest
+      with self.profiler.span('Crop volume', 'mesh'):
+        workingVolumeNode = self.cropVolume(masterVolumeNode, roiNode, spacingScale)
+    surfaceMesh, segmentationNode = self.extractSkinSurface(workingVolumeNode, progressBar,
+      minimumThreshold, maximumThreshold, smoothingMethod, kernelSizeMm)
+    if roiNode and refine and spacingScale != 1.0:
+      # Refine at the original resolution, only around the coarse surface
+      progressBar.labelText = 'Refining around the coarse surface'
+      coarseSpacingMm = max(workingVolumeNode.GetSpacing())
+      slicer.mrmlScene.RemoveNode(workingVolumeNode)
+      if segmentationNode:
+        slicer.mrmlScene.RemoveNode(segmentationNode)
+      refineRoiNode = roiNode
+      if surfaceMesh.GetNumberOfPoints():
+        refineRoiNode = self.roiAroundSurface(surfaceMesh, coarseSpacingMm + kernelSizeMm / 2, roiNode)
+      with self.profiler.span('Crop volume', 'mesh'):
+        workingVolumeNode = self.cropVolume(masterVolumeNode, refineRoiNode, 1.0)
+      if refineRoiNode is not roiNode:
+        slicer.mrmlScene.RemoveNode(refineRoiNode)
+      surfaceMesh, segmentationNode = self.extractSkinSurface(workingVolumeNode, progressBar,
+        minimumThreshold, maximumThreshold, smoothingMethod, kernelSizeMm)
+    if workingVolumeNode is not masterVolumeNode:
+      slicer.mrmlScene.RemoveNode(workingVolumeNode)
+    if roiNode is not cropRoiNode:
+      slicer.mrmlScene.RemoveNode(roiNode)
 
     ## Display Output
+    if segmentationNode:
+      segmentationNode.SetDisplayVisibility(0)
     progressBar.value = 80
-    
-    # Write to STL file
-    writer = vtk.vtkSTLWriter()
-    writer.SetInputData(surfaceMesh)
-    volumeNode2 = slicer.util.getNode(nom)
-    filename2 = volumeNode2.GetStorageNode().GetFileName()
-    nom=filename2+'.stl'
-    logging.info('Model is writing')
-    writer.SetFileName(nom)
-    writer.SetHeader("NussBar output. SPACE=RAS")
-    writer.Update()
-    
-    ## Load this model
-    name = inputVolume.GetName()
-    volumeNode2 = slicer.util.getNode(name)
-    filename2 = volumeNode2.GetStorageNode().GetFileName()
-    name2=filename2+'.stl'
-    SegNode_View = slicer.util.getNode('vtkMRMLSegmentationNode1')
-    SegNode_View.SetDisplayVisibility(0)
-    progressBar.value = 80
-
-    slicer.util.loadModel(name2)
-
-    # Add skin color
-    ModelNode_color= slicer.util.getNode('vtkMRMLModelNode4')
-    displayNode = ModelNode_color.GetDisplayNode()
-    RGB_COLOR = 0.6941176470588235, 0.47843137254901963, 0.396078431372549
-    displayNode.SetColor(RGB_COLOR)
-
-    base=os.path.basename(name2)
-    base2=os.path.splitext(base)[0]
+    with self.profiler.span('Show skin surface', 'mesh'):
+      modelNode = self.showSkinSurface(inputVolume, surfaceMesh, exportFormat, exportDirectory, exportCellSizeMm)
 
     progressBar.value = 100
     progressBar.close()
     logging.info('Processing completed here '+nom)
+    return modelNode
   
-  def remove_actors(self):
-    # Remove 3D curve actors from the 3D view
-    view = slicer.app.layoutManager().threeDWidget(0).threeDView()
-    renderer = view.renderWindow().GetRenderers().GetFirstRenderer()
+  def meshInBackground(self, inputVolume, minimumThreshold=100, maximumThreshold=5000, kernelSizeMm=10,
+      cropRoiNode=None, cropFiducialNode=None, paddingMm=30.0, spacingScale=1.0,
+      exportFormat=None, exportDirectory=None, exportCellSizeMm=0.0, workers=1):
+    """
+    Same as mesh() with median smoothing, but thresholding, smoothing and surface
+    extraction run on a worker thread (NussBarLib.segmentation) with a cancellable
+    progress dialog. Several volumes can be processed at the same time. With
+    several workers, the stages are split into blocks run on that many threads.
+    Returns the task, or None if the surface was shown from the cache.
+    """
+    if not inputVolume:
+      slicer.util.errorDisplay('Add a volume.nii', windowTitle='Nuss Bar error', parent=None, standardButtons=None)
+      return None
     
-    actors_to_remove = []
-    for actor in renderer.GetActors():
-        # Check if the actor is a line (curve) with specific properties
-        if (isinstance(actor, vtk.vtkActor) and 
-            actor.GetProperty().GetLineWidth() > 1):
-            actors_to_remove.append(actor)
+    # Collect everything the worker needs while on the GUI thread
+    roiNode = self.regionOfInterest(cropRoiNode, cropFiducialNode, paddingMm)
+    with self.profiler.span('Crop volume', 'mesh'):
+      workingVolumeNode = self.cropVolume(inputVolume, roiNode, spacingScale) if roiNode else inputVolume
+    surfaceKey = ('surface', self.volumeDigest(workingVolumeNode), minimumThreshold, maximumThreshold, "MEDIAN", kernelSizeMm, 'numpy')
+    surfaceMesh = self.segmentationCache.get(surfaceKey)
+    if surfaceMesh is None:
+      with self.profiler.span('Copy voxels', 'mesh'):
+        voxels = slicer.util.arrayFromVolume(workingVolumeNode).copy()
+      ijkToRAS = vtk.vtkMatrix4x4()
+      workingVolumeNode.GetIJKToRASMatrix(ijkToRAS)
+      ijkToRAS = slicer.util.arrayFromVTKMatrix(ijkToRAS)
+    if workingVolumeNode is not inputVolume:
+      slicer.mrmlScene.RemoveNode(workingVolumeNode)
+    if roiNode is not cropRoiNode:
+      slicer.mrmlScene.RemoveNode(roiNode)
     
-    for actor in actors_to_remove:
-        renderer.RemoveActor(actor)
+    if surfaceMesh is not None:
+      logging.info('Using cached skin surface')
+      self.showSkinSurface(inputVolume, surfaceMesh, exportFormat, exportDirectory, exportCellSizeMm)
+      return None
     
-    # Force render to update the view
-    view.forceRender()
-
-    # Remove curve model nodes
-    curve_nodes = slicer.util.getNodesByClass('vtkMRMLModelNode')
-    for node in curve_nodes:
-        if node.GetName().startswith('NussCurve_'):
-            slicer.mrmlScene.RemoveNode(node)
-
-    # Remove 2D actors from slice views
-    for view_name in ["Red", "Yellow", "Green"]:
-        slice_view = slicer.app.layoutManager().sliceWidget(view_name).sliceView()
-        slice_renderer = slice_view.renderWindow().GetRenderers().GetFirstRenderer()
-        actors_to_remove = [actor for actor in slice_renderer.GetActors2D() 
-                            if isinstance(actor, vtk.vtkActor2D) and hasattr(actor, 'is_curve_actor')]
-        for actor in actors_to_remove:
-            slice_renderer.RemoveActor2D(actor)
-
-    # Remove curve model nodes
-    old_model_nodes = slicer.util.getNodes('vtkMRMLModelNode*NussCurve*').values()
-    for node in old_model_nodes:
-        slicer.mrmlScene.RemoveNode(node)
-    view.forceRender()
-
-  # Create 2D actor for slice views
-  def create_2d_actor(self, renderer, view, curve_source):
-    mapper = vtk.vtkPolyDataMapper2D()
-    actor = vtk.vtkActor2D()
-    actor.SetMapper(mapper)
-    actor.GetProperty().SetColor(random.random(), random.random(), random.random())
-    actor.GetProperty().SetLineWidth(10)
-    actor.is_curve_actor = True
-    renderer.AddActor2D(actor)
+    def onFinished(result):
+      surfaceMesh, mask = result
+      self.segmentationCache.put(surfaceKey, surfaceMesh, surfaceMesh.GetActualMemorySize() * 1024)
+      with self.profiler.span('Show skin surface', 'mesh'):
+        self.showSkinSurface(inputVolume, surfaceMesh, exportFormat, exportDirectory, exportCellSizeMm)
     
-    # Get the slice node
-    sliceNode = view.mrmlSliceNode()
+    if workers > 1:
+      extractSkinSurface = self.profiler.traced(segmentation.parallel_skin_surface, 'Skin surface (multi-core)', 'mesh')
+      options = {'workers': workers}
+    else:
+      extractSkinSurface = self.profiler.traced(segmentation.extract_skin_surface, 'Skin surface (background)', 'mesh')
+      options = {}
+    task = self.taskRunner.submit(extractSkinSurface, voxels, ijkToRAS,
+      minimumThreshold, maximumThreshold, kernelSizeMm, name='Skin surface of ' + inputVolume.GetName(), **options)
+    self.watchTask(task, onFinished)
+    return task
+  
+  def meshFromFile(self, inputVolume, minimumThreshold=100, maximumThreshold=5000, kernelSizeMm=10, slabSlices=32,
+      exportFormat=None, exportDirectory=None, exportCellSizeMm=0.0):
+    """
+    Same as meshInBackground, but the voxels are read in slabs of slabSlices
+    axial slices from the uncompressed NRRD or NIfTI file the volume was loaded
+    from (NussBarLib.segmentation.stream_skin_surface), so that peak memory does
+    not grow with the size of the scan. The whole volume is segmented.
+    Returns the task, or None if the surface was shown from the cache.
+    """
+    storageNode = inputVolume.GetStorageNode() if inputVolume else None
+    fileName = storageNode.GetFileName() if storageNode else None
+    if not fileName:
+      slicer.util.errorDisplay('The volume must be loaded from a file to stream it', windowTitle='Nuss Bar error')
+      return None
+    try:
+      volume = volumes.read_volume(fileName)
+    except (OSError, ValueError, KeyError) as e:
+      slicer.util.errorDisplay('Cannot stream %s: %s' % (fileName, e), windowTitle='Nuss Bar error')
+      return None
     
-    # Create a transform to map from RAS to XY view coordinates
-    rasToXY = vtk.vtkTransform()
-    xyToRAS = sliceNode.GetXYToRAS()
-    rasToXYMatrix = vtk.vtkMatrix4x4()
-    vtk.vtkMatrix4x4.Invert(xyToRAS, rasToXYMatrix)
-    rasToXY.SetMatrix(rasToXYMatrix)
+    surfaceKey = ('surface', fileName, os.path.getmtime(fileName), minimumThreshold, maximumThreshold, "MEDIAN",
+      kernelSizeMm, 'stream')
+    surfaceMesh = self.segmentationCache.get(surfaceKey)
+    if surfaceMesh is not None:
+      logging.info('Using cached skin surface')
+      self.showSkinSurface(inputVolume, surfaceMesh, exportFormat, exportDirectory, exportCellSizeMm)
+      return None
     
-    # Transform the curve points
-    transformFilter = vtk.vtkTransformPolyDataFilter()
-    transformFilter.SetInputConnection(curve_source.GetOutputPort())
-    transformFilter.SetTransform(rasToXY)
-    transformFilter.Update()
+    def onFinished(surfaceMesh):
+      self.segmentationCache.put(surfaceKey, surfaceMesh, surfaceMesh.GetActualMemorySize() * 1024)
+      with self.profiler.span('Show skin surface', 'mesh'):
+        self.showSkinSurface(inputVolume, surfaceMesh, exportFormat, exportDirectory, exportCellSizeMm)
     
-    # Set the transformed data to the mapper
-    mapper.SetInputConnection(transformFilter.GetOutputPort())
+    streamSkinSurface = self.profiler.traced(segmentation.stream_skin_surface, 'Skin surface (streamed)', 'mesh')
+    task = self.taskRunner.submit(streamSkinSurface, volume, minimumThreshold, maximumThreshold, kernelSizeMm,
+      slabSlices, name='Skin surface of ' + inputVolume.GetName())
+    self.watchTask(task, onFinished)
+    return task
+  
+  def watchTask(self, task, onFinished=None):
+    """
+    Show the progress of a background task in a cancellable progress dialog and
+    call onFinished(result) on the GUI thread when it completes.
+    """
+    progressBar = slicer.util.createProgressDialog(windowTitle=task.name, labelText=task.name,
+      windowModality=qt.Qt.NonModal)
+    timer = qt.QTimer()
+    timer.setInterval(100)
+    watcher = (timer, progressBar)
     
-    return actor
+    def poll():
+      if progressBar.wasCanceled and not task.cancelled:
+        task.cancel()
+      if not task.done():
+        progressBar.labelText = task.message
+        progressBar.value = int(100 * task.progress)
+        return
+      timer.stop()
+      progressBar.close()
+      self.taskWatchers.remove(watcher)
+      if self.timingChanged:
+        self.timingChanged()
+      try:
+        result = task.result()
+      except tasks.TaskCancelled:
+        logging.info(task.name + ' cancelled')
+        return
+      except Exception as e:
+        logging.error(task.name + ' failed: ' + str(e))
+        slicer.util.errorDisplay(task.name + ' failed: ' + str(e), windowTitle='Nuss Bar error')
+        return
+      if onFinished:
+        onFinished(result)
+    
+    timer.connect('timeout()', poll)
+    # Keep the timer and dialog alive until the task is done
+    self.taskWatchers.append(watcher)
+    timer.start()
+  
+  def installDependencies(self, packages):
+    """Install Python packages with pip in a background task"""
+    def install(packages, progress=None):
+      progress(0.0, 'Installing ' + ', '.join(packages))
+      python = shutil.which('PythonSlicer') or sys.executable
+      try:
+        subprocess.run([python, '-m', 'pip', 'install'] + list(packages), check=True, capture_output=True, text=True)
+      except subprocess.CalledProcessError as e:
+        raise RuntimeError(e.stderr.strip().splitlines()[-1] if e.stderr.strip() else str(e))
+      return packages
+    
+    def onFinished(packages):
+      importlib.invalidate_caches()
+      logging.info('Installed ' + ', '.join(packages))
+      slicer.util.showStatusMessage('Installed ' + ', '.join(packages), 3000)
+    
+    task = self.taskRunner.submit(install, list(packages), name='Install ' + ', '.join(packages))
+    self.watchTask(task, onFinished)
+    return task
+  
+  def autoThreshold(self, volumeNode, preset='Default', method='otsu'):
+    """Minimum threshold of volumeNode from its histogram (NussBarLib.thresholds), or None"""
+    if not volumeNode:
+      slicer.util.errorDisplay('Add a volume.nii', windowTitle='Nuss Bar error', parent=None, standardButtons=None)
+      return None
+    with self.profiler.span('Auto threshold', 'threshold'):
+      try:
+        minimum = thresholds.auto_threshold(slicer.util.arrayFromVolume(volumeNode), preset, method)
+      except ValueError as e:
+        slicer.util.errorDisplay('Automatic threshold failed: ' + str(e), windowTitle='Nuss Bar error')
+        return None
+    logging.info('%s threshold of %s (%s preset): %g' % (method, volumeNode.GetName(), preset, minimum))
+    return minimum
+  
+  def previewThreshold(self, volumeNode, minimumThreshold=100, maximumThreshold=5000, kernelSizeMm=10):
+    """
+    Show a coarse skin surface of volumeNode (NussBarLib.segmentation.preview_surface),
+    updating the preview model in place. Returns the model node.
+    """
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    with self.profiler.span('Preview surface', 'threshold'):
+      surfaceMesh = segmentation.preview_surface(slicer.util.arrayFromVolume(volumeNode),
+        slicer.util.arrayFromVTKMatrix(ijkToRAS), minimumThreshold, maximumThreshold, kernelSizeMm)
+    modelNodes = self.ownedNodes('preview')
+    if modelNodes:
+      modelNode = modelNodes[0]
+    else:
+      with self.sceneBatch():
+        modelNode = self.createNode('vtkMRMLModelNode', 'NussThresholdPreview', 'preview')
+        modelNode.CreateDefaultDisplayNodes()
+        modelNode.GetDisplayNode().SetColor(0.6941176470588235, 0.47843137254901963, 0.396078431372549)
+        modelNode.GetDisplayNode().SetOpacity(0.6)
+    modelNode.SetAndObservePolyData(surfaceMesh)
+    return modelNode
   
-  # sort points
-  def sort_points_polar(self, points):
-    points_array = np.array(points)
+  def showSkinSurface(self, volumeNode, surfaceMesh, exportFormat=None, exportDirectory=None, exportCellSizeMm=0.0):
+    """
+    Show a copy of the skin surface of volumeNode in a model node, optionally
+    saving surfaceMesh in the background. surfaceMesh itself is left untouched.
+    """
+    name = volumeNode.GetName() + "_skin"
+    with self.sceneBatch():
+      self.removeOwned('preview')
+      for previousModelNode in self.ownedNodes('skin'):
+        if previousModelNode.GetName() == name:
+          slicer.mrmlScene.RemoveNode(previousModelNode)
     
-    # Find the centermost point
-    center = np.mean(points_array[:, :2], axis=0)
-    center[1] = np.min(points_array[:, 1]) - 1
+      # The model node gets its own copy: surfaceMesh may be cached, and Slicer
+      # edits displayed models in place (transforms, Surface Toolbox, ...)
+      modelMesh = vtk.vtkPolyData()
+      modelMesh.DeepCopy(surfaceMesh)
+      modelNode = self.createNode("vtkMRMLModelNode", name, 'skin')
+      modelNode.SetAndObservePolyData(modelMesh)
+    modelNode.CreateDefaultDisplayNodes()
+    
+    # Add skin color
+    displayNode = modelNode.GetDisplayNode()
+    RGB_COLOR = 0.6941176470588235, 0.47843137254901963, 0.396078431372549
+    displayNode.SetColor(RGB_COLOR)
     
-    # Calculate angles of points relative to the center
-    angles = np.arctan2(points_array[:, 1] - center[1], points_array[:, 0] - center[0])
+    # Optionally save the surface without waiting for the write to finish
+    if exportFormat:
+      exportPath = self.surfaceExportPath(volumeNode, exportDirectory, exportFormat)
+      if exportPath:
+        self.exportSurfaceInBackground(surfaceMesh, exportPath, exportCellSizeMm)
+      else:
+        logging.warning('Skin surface not exported: choose an export folder or save the volume first')
+    return modelNode
+  
+  def extractSkinSurface(self, volumeNode, progressBar, minimumThreshold=100, maximumThreshold=5000, smoothingMethod="MEDIAN", kernelSizeMm=10):
+    """
+    Threshold, smooth and extract the closed surface of the skin from volumeNode.
+    Returns the surface and the segmentation node, or None as segmentation node
+    when the surface came from the cache.
+    """
+    volumeDigest = self.volumeDigest(volumeNode)
+    thresholdKey = ('threshold', volumeDigest, minimumThreshold, maximumThreshold)
+    smoothingKey = thresholdKey + (smoothingMethod, kernelSizeMm)
+    surfaceKey = ('surface',) + smoothingKey[1:]
     
-    # Adjust angles to go from 0 to 2*pi
-    angles = (angles + 2*np.pi) % (2*np.pi)
+    segmentationNode = None
+    surfaceMesh = self.segmentationCache.get(surfaceKey)
+    if surfaceMesh is not None:
+      logging.info('Using cached skin surface')
+      progressBar.value = 80
+    else:
+      # Create segmentation
+      segmentationNode = self.createNode("vtkMRMLSegmentationNode", volumeNode.GetName() + "_segmentation", 'segmentation')
+      segmentationNode.CreateDefaultDisplayNodes() # only needed for display
+      segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(volumeNode)
+      addedSegmentID = segmentationNode.GetSegmentation().AddEmptySegment("skin")
     
-    # Create a custom sorting key
-    def sorting_key(angle):
-        if np.pi <= angle <= 2*np.pi:
-            return angle - np.pi
+      smoothed = self.segmentationCache.get(smoothingKey)
+      thresholded = None if smoothed is not None else self.segmentationCache.get(thresholdKey)
+      if smoothed is not None:
+        logging.info('Using cached smoothed label map')
+        with self.profiler.span('Load cached label map', 'mesh'):
+          slicer.util.updateSegmentBinaryLabelmapFromArray(cache.unpack_mask(smoothed), segmentationNode, addedSegmentID, volumeNode)
+        progressBar.value = 30
+      else:
+        # Create segment editor to get access to effects
+        segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
+        segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
+        segmentEditorNode = self.createNode("vtkMRMLSegmentEditorNode", "NussBarSegmentEditor", 'temporary')
+        segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
+        segmentEditorWidget.setSegmentationNode(segmentationNode)
+        segmentEditorWidget.setMasterVolumeNode(volumeNode)
+      
+        # Thresholding
+        if thresholded is not None:
+          logging.info('Using cached threshold label map')
+          with self.profiler.span('Load cached label map', 'mesh'):
+            slicer.util.updateSegmentBinaryLabelmapFromArray(cache.unpack_mask(thresholded), segmentationNode, addedSegmentID, volumeNode)
         else:
-            return angle + np.pi
+          with self.profiler.span('Threshold', 'mesh'):
+            segmentEditorWidget.setActiveEffectByName("Threshold")
+            effect = segmentEditorWidget.activeEffect()
+            effect.setParameter("MinimumThreshold",str(minimumThreshold)) # adjusting according to data
+            effect.setParameter("MaximumThreshold",str(maximumThreshold)) # adjusting according to data
+            effect.self().onApply()
+            self.cacheLabelmap(thresholdKey, segmentationNode, addedSegmentID, volumeNode)
+        progressBar.value = 10
+      
+        # Smoothing
+        with self.profiler.span('Smoothing', 'mesh'):
+          segmentEditorWidget.setActiveEffectByName("Smoothing")
+          effect = segmentEditorWidget.activeEffect()
+          effect.setParameter("SmoothingMethod", smoothingMethod)
+          effect.setParameter("KernelSizeMm", kernelSizeMm)
+          effect.self().onApply()
+          self.cacheLabelmap(smoothingKey, segmentationNode, addedSegmentID, volumeNode)
+        progressBar.value = 30
+      
+        # Clean up
+        segmentEditorWidget = None
+        slicer.mrmlScene.RemoveNode(segmentEditorNode)
     
-    # Sort points based on these adjusted angles
-    sorted_indices = sorted(range(len(angles)), key=lambda i: sorting_key(angles[i]))
-    sorted_points = points_array[sorted_indices]
+      # Make segmentation results visible in 3D
+      with self.profiler.span('Closed surface', 'mesh'):
+        segmentationNode.CreateClosedSurfaceRepresentation()
     
-    return sorted_points
+      # Fix normals
+      with self.profiler.span('Normals', 'mesh'):
+        surfaceMesh = vtk.vtkPolyData()
+        segmentationNode.GetClosedSurfaceRepresentation(addedSegmentID, surfaceMesh)
+        normals = vtk.vtkPolyDataNormals() # to normal data
+        normals.AutoOrientNormalsOn()
+        normals.ConsistencyOn() # to normal data
+        normals.SetInputData(surfaceMesh) # to normal data
+        normals.Update() # to normal data
+        surfaceMesh = normals.GetOutput() # to normal data
+      self.segmentationCache.put(surfaceKey, surfaceMesh, surfaceMesh.GetActualMemorySize() * 1024)
+    return surfaceMesh, segmentationNode
+
+  def autoPlace(self, inputVolume, minimumThreshold=100, maximumThreshold=5000, kernelSizeMm=10, fiducialCount=9):
+    """
+    Propose the bar from the CT scan alone: find the axial level with the
+    largest Haller index in the thresholded and smoothed volume (reusing the
+    label map of a previous mesh() run when cached) and place fiducialCount
+    fiducials across the chest at that level.
+    Returns the new fiducial node and the NussBarLib.placement.Placement, or None.
+    """
+    if not inputVolume:
+      slicer.util.errorDisplay('Add a volume.nii', windowTitle='Nuss Bar error', parent=None, standardButtons=None)
+      return None
+    
+    volumeDigest = self.volumeDigest(inputVolume)
+    smoothingKey = ('threshold', volumeDigest, minimumThreshold, maximumThreshold, "MEDIAN", kernelSizeMm)
+    packed = self.segmentationCache.get(smoothingKey)
+    if packed is None:
+      packed = self.segmentationCache.get(smoothingKey + ('numpy',))
+    if packed is not None:
+      logging.info('Using cached smoothed label map')
+      mask = cache.unpack_mask(packed)
+    else:
+      voxels = slicer.util.arrayFromVolume(inputVolume)
+      with self.profiler.span('Threshold', 'placement'):
+        mask = segmentation.threshold(voxels, minimumThreshold, maximumThreshold)
+      with self.profiler.span('Smoothing', 'placement'):
+        kernelSize = segmentation.median_kernel_size(kernelSizeMm, inputVolume.GetSpacing()[::-1])
+        mask = segmentation.smooth_median(mask, kernelSize)
+      packed = cache.pack_mask(mask)
+      self.segmentationCache.put(smoothingKey + ('numpy',), packed, packed[0].nbytes)
+    
+    ijkToRAS = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRAS)
+    with self.profiler.span('Find depression', 'placement'):
+      try:
+        result = placement.place_bar(mask, slicer.util.arrayFromVTKMatrix(ijkToRAS), fiducialCount)
+      except ValueError as e:
+        slicer.util.errorDisplay('Automatic placement failed: ' + str(e), windowTitle='Nuss Bar error')
+        return None
+    logging.info('Automatic placement: ' + str(result.summary()))
+    
+    with self.profiler.span('Show fiducials', 'placement'), self.sceneBatch():
+      self.removeOwned('placement')
+      fiducialNode = self.createNode('vtkMRMLMarkupsFiducialNode', inputVolume.GetName() + '_bar', 'placement')
+      fiducialNode.CreateDefaultDisplayNodes()
+      slicer.util.updateMarkupsControlPointsFromArray(fiducialNode, result.fiducials)
+    return fiducialNode, result
+  
+  def surfaceExportPath(self, volumeNode, directory, fileFormat):
+    """File name for the exported skin surface, or None if there is nowhere to write it"""
+    if not directory:
+      storageNode = volumeNode.GetStorageNode()
+      if not storageNode or not storageNode.GetFileName():
+        return None
+      directory = os.path.dirname(storageNode.GetFileName())
+    return os.path.join(directory, volumeNode.GetName() + "_skin." + fileFormat.lower())
   
-  def draw(self, fiducialInput, getApplyButtonDrawButton):
+  def exportSurfaceInBackground(self, surfaceMesh, fileName, cellSizeMm=0.0):
+    """
+    Write a surface to binary STL, binary PLY or GLB (quantized) in a worker
+    thread, streamed from NumPy views of its arrays. With cellSizeMm, the
+    surface is first simplified by vertex clustering.
+    """
+    # Shares the point and cell arrays of the displayed surface
+    surfaceCopy = vtk.vtkPolyData()
+    surfaceCopy.ShallowCopy(surfaceMesh)
+    vertices, triangles = surface.polydata_arrays(surfaceCopy)
+    
+    def write():
+      logging.info('Model is writing to ' + fileName)
+      try:
+        if cellSizeMm:
+          with self.profiler.span('Simplify skin surface', 'mesh'):
+            simplified = export.cluster_vertices(vertices, triangles, cellSizeMm)
+          logging.info('Simplified skin surface from %d to %d triangles' % (len(triangles), len(simplified[1])))
+        else:
+          simplified = vertices, triangles
+        with self.profiler.span('Write skin surface', 'mesh'):
+          export.write_mesh(fileName, *simplified, quantize=True)
+      except (OSError, ValueError) as e:
+        logging.error('Failed to write %s: %s' % (fileName, e))
+      else:
+        logging.info('Model written to ' + fileName)
+    
+    thread = threading.Thread(target=write, name='NussBarSurfaceExport', daemon=True)
+    thread.start()
+    self.exportThreads = [t for t in self.exportThreads if t.is_alive()] + [thread]
+    return thread
+  
+  def regionOfInterest(self, cropRoiNode=None, cropFiducialNode=None, paddingMm=30.0):
+    """The ROI node to crop to: cropRoiNode, or a temporary ROI around cropFiducialNode, or None"""
+    if cropRoiNode:
+      return cropRoiNode
+    if cropFiducialNode and cropFiducialNode.GetNumberOfControlPoints() > 0:
+      return self.roiFromFiducials(cropFiducialNode, paddingMm)
+    return None
+  
+  def roiFromFiducials(self, fiducialNode, paddingMm):
+    """Temporary ROI node around the control points of fiducialNode, padded on every side"""
+    center, radius = geometry.padded_bounds(slicer.util.arrayFromMarkupsControlPoints(fiducialNode), paddingMm)
+    return self.temporaryRoi(center, radius)
+  
+  def roiAroundSurface(self, surfaceMesh, paddingMm, roiNode):
+    """Temporary ROI node around the bounds of surfaceMesh, padded on every side but not beyond roiNode"""
+    surfaceBounds = np.reshape(surfaceMesh.GetBounds(), (3, 2))
+    roiBounds = [0.0] * 6
+    roiNode.GetRASBounds(roiBounds)
+    roiBounds = np.reshape(roiBounds, (3, 2))
+    low = np.maximum(surfaceBounds[:, 0] - paddingMm, roiBounds[:, 0])
+    high = np.minimum(surfaceBounds[:, 1] + paddingMm, roiBounds[:, 1])
+    center, radius = geometry.padded_bounds(np.stack((low, high)), 0.0)
+    return self.temporaryRoi(center, radius)
+  
+  def temporaryRoi(self, center, radius):
+    """Hidden temporary ROI node of the given center and half-size"""
+    roiNode = self.createNode("vtkMRMLMarkupsROINode", "NussBarCropROI", 'temporary')
+    roiNode.SetXYZ(center)
+    roiNode.SetRadiusXYZ(radius)
+    roiNode.SetDisplayVisibility(0)
+    return roiNode
+  
+  def cropVolume(self, volumeNode, roiNode, spacingScale=1.0):
+    """Crop volumeNode to roiNode, resampled with its spacing multiplied by spacingScale"""
+    cropParameters = self.createNode("vtkMRMLCropVolumeParametersNode", "NussBarCropParameters", 'temporary')
+    cropParameters.SetInputVolumeNodeID(volumeNode.GetID())
+    cropParameters.SetROINodeID(roiNode.GetID())
+    cropParameters.SetVoxelBased(spacingScale == 1.0)
+    cropParameters.SetSpacingScalingConst(spacingScale)
+    slicer.modules.cropvolume.logic().Apply(cropParameters)
+    croppedVolumeNode = cropParameters.GetOutputVolumeNode()
+    croppedVolumeNode.SetName(volumeNode.GetName() + "_crop")
+    self.own(croppedVolumeNode, 'temporary')
+    slicer.mrmlScene.RemoveNode(cropParameters)
+    logging.info('Cropped volume to %s voxels' % (croppedVolumeNode.GetImageData().GetDimensions(),))
+    return croppedVolumeNode
+  
+  def cacheLabelmap(self, key, segmentationNode, segmentID, referenceVolumeNode):
+    """Store the current label map of a segment, one bit per voxel"""
+    labelmap = slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, segmentID, referenceVolumeNode)
+    packed = cache.pack_mask(labelmap)
+    self.segmentationCache.put(key, packed, packed[0].nbytes)
+  
+  def surfaceLocator(self, modelNode):
+    """Spatial index over the surface of modelNode, built once and reused until the surface changes"""
+    polyData = modelNode.GetPolyData()
+    key = (polyData.GetMTime(), polyData.GetNumberOfPoints())
+    known = self.surfaceLocators.get(modelNode.GetID())
+    if known and known[0] == key:
+      return known[1]
+    logging.info('Building surface locator for ' + modelNode.GetName())
+    locator = surface.SurfaceLocator.from_polydata(polyData)
+    self.surfaceLocators[modelNode.GetID()] = (key, locator)
+    return locator
+  
+  def draw(self, fiducialInput, getApplyButtonDrawButton, snapSurfaceNode=None, clearanceMm=0.0, snapSamples=500,
+      barLengthMm=None, barSamples=4000, fitToleranceMm=0.0, outlierDistanceMm=0.0):
     """
     Draw the Curve
+    With fitToleranceMm or outlierDistanceMm, a smoothing spline is fitted instead
+    of passing through every fiducial (see geometry.fit_curve).
+    If snapSurfaceNode is given, the curve is sampled at snapSamples points that are
+    projected onto its surface, clearanceMm away on the side most fiducials are on.
+    If barLengthMm is given, the bar is trimmed or extended to that length.
+    Returns (curve length, bar length) in inches and barSamples points along the bar.
     """
     
     drawButton = getApplyButtonDrawButton
     
-    self.remove_actors()
-    
     # verifies fiducials have been created
     if not fiducialInput.currentNode():
         error_text='Add at least two fiducials'
@@ -469,110 +1562,39 @@ class NussBarLogic(ScriptedLoadableModuleLogic):
     logging.info('Processing fiducials...')
     progressBar.value = 20
 
-    list=[]
-    for i in range(numFids):
-        ras = [0,0,0]
-        fiducialInput.currentNode().GetNthControlPointPosition(i,ras)
-        list.append(ras)
+    with self.profiler.span('Read fiducials', 'draw'):
+      list=[]
+      for i in range(numFids):
+          ras = [0,0,0]
+          fiducialInput.currentNode().GetNthControlPointPosition(i,ras)
+          list.append(ras)
         
-    # sort list based on x coordinate from least to greatest
-    list = sorted(list, key=lambda x: x[0])
-    
     progressBar.labelText = "Fiducials processed"
     logging.info('First fiducial: ' + str(list[0]) + '...')
     progressBar.labelText = "Curve fit..."
     logging.info('Curve fit...')
     progressBar.value = 40
     
-    # Create control points for Bezier curve
-    control_points = []
-    for i in range(len(list) - 1):
-        p0 = list[i]
-        p1 = list[i+1]
-        control_points.append(p0)
-        
-    control_points.append(list[-1])
-    control_points = self.sort_points_polar(control_points)
+    # order the control points along the bar, follow the surface if asked and trim or extend to the requested length
+    if snapSurfaceNode:
+      progressBar.labelText = "Snap to surface..."
+      logging.info('Snap to surface...')
+    curve, bar_points = self.barCurve(list, snapSurfaceNode, clearanceMm, snapSamples, barLengthMm, barSamples,
+      fitToleranceMm=fitToleranceMm, outlierDistanceMm=outlierDistanceMm)
+    markupLength = curve.length()
     
     progressBar.value = 50
     progressBar.labelText = "Create curve"
-    logging.info('Create VTK PolyData...')
-    
-    # Create a VTK PolyData object for the line
-    line_points = vtk.vtkPoints()
-    for i in range(len(control_points)):
-        line_points.InsertNextPoint(control_points[i][0], control_points[i][1], control_points[i][2])
-    
-    spline = vtk.vtkParametricSpline()
-    spline.SetPoints(line_points)
-    curve_source = vtk.vtkParametricFunctionSource()
-    curve_source.SetParametricFunction(spline)
-    curve_source.Update()    
+    logging.info('Update curve...')
+    self.updateCurvePoints(bar_points)
     progressBar.value = 60
     progressBar.labelText = "Plot curve..."
     logging.info('Create mapper...')
-        
-    # Create a mapper
-    mapper = vtk.vtkPolyDataMapper()
-    mapper.SetInputData(curve_source.GetOutput())
-
-    # Create an actor
-    actor = vtk.vtkActor()
-    actor.SetMapper(mapper)
-    actor.GetProperty().SetColor(random.random(), random.random(), random.random())
-    actor.GetProperty().SetLineWidth(10)  
-    actor.is_curve_actor = True
-
-    # Add the actor to the renderer
-    renderer = view.renderWindow().GetRenderers().GetFirstRenderer()
-    renderer.AddActor(actor)
-    progressBar.value = 70
-    view.forceRender()
-
-    # Get the slice view renderers
-    red_renderer = slicer.app.layoutManager().sliceWidget("Red").sliceView().renderWindow().GetRenderers().GetFirstRenderer()
-    yellow_renderer = slicer.app.layoutManager().sliceWidget("Yellow").sliceView().renderWindow().GetRenderers().GetFirstRenderer()
-    green_renderer = slicer.app.layoutManager().sliceWidget("Green").sliceView().renderWindow().GetRenderers().GetFirstRenderer()
-
-    red_view = slicer.app.layoutManager().sliceWidget("Red").sliceView()
-    yellow_view = slicer.app.layoutManager().sliceWidget("Yellow").sliceView()
-    green_view = slicer.app.layoutManager().sliceWidget("Green").sliceView()
-
-    # Create 2D mappers and actors for slice views
-    red_mapper = vtk.vtkPolyDataMapper2D()
-    red_mapper.SetInputData(curve_source.GetOutput())
-    red_actor = self.create_2d_actor(red_renderer, red_view, curve_source)
-    red_renderer.AddActor2D(red_actor)
-
-    yellow_mapper = vtk.vtkPolyDataMapper2D()
-    yellow_mapper.SetInputData(curve_source.GetOutput())
-    yellow_actor = self.create_2d_actor(yellow_renderer, yellow_view, curve_source)
-    yellow_renderer.AddActor2D(yellow_actor)
-
-    green_mapper = vtk.vtkPolyDataMapper2D()
-    green_mapper.SetInputData(curve_source.GetOutput())
-    green_actor = self.create_2d_actor(green_renderer, green_view, curve_source)
-    green_renderer.AddActor2D(green_actor)
-    
-    # Remove old model nodes
-    old_model_nodes = slicer.util.getNodes('vtkMRMLModelNode*Line*').values()
-    for node in old_model_nodes:
-        slicer.mrmlScene.RemoveNode(node)
-    
-    # Create a model node
-    modelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode')
-    modelNode.SetName('NussCurve_' + str(random.randint(1, 1000)))
-    modelNode.SetAndObservePolyData(curve_source.GetOutput())
-    modelNode.CreateDefaultDisplayNodes()
-    modelNode.GetDisplayNode().SetColor(random.random(), random.random(), random.random())  
-    modelNode.GetDisplayNode().SetLineWidth(10)
+    with self.profiler.span('Show curve', 'draw'):
+      self.showCurve()
     
     view.forceRender()
     progressBar.value = 90
-    
-    # set line color to random color
-    modelNode.GetDisplayNode().SetColor(random.random(), random.random(), random.random())  
-    modelNode.GetDisplayNode().SetLineWidth(10)  
         
     # display output
     logging.info('Processing completed')
@@ -580,66 +1602,390 @@ class NussBarLogic(ScriptedLoadableModuleLogic):
     progressBar.value = 100
     progressBar.close()
     
-    # Returns the arc length
-    def arc_length(x, y):
-      return np.sum(np.sqrt(np.diff(x)**2 + np.diff(y)**2))
+    # Returns the arc lengths in inches
+    return (round(geometry.mm_to_in(markupLength), 4), round(geometry.mm_to_in(geometry.polyline_length(bar_points)), 4),
+      bar_points)
+  
+  def barCurve(self, points, snapSurfaceNode=None, clearanceMm=0.0, snapSamples=500, barLengthMm=None,
+      barSamples=4000, category='draw', fitToleranceMm=0.0, outlierDistanceMm=0.0):
+    """
+    Curve through (or, with a fit tolerance or outlier distance, smoothed
+    through) the fiducial positions, optionally snapped to a surface, and
+    barSamples points along the bar.
+    """
+    with self.profiler.span('Fit curve', category):
+      control_points = geometry.order_fiducials(points)
+      curve = geometry.fit_curve(control_points, fitToleranceMm, outlierDistanceMm)
+      if outlierDistanceMm and not curve.inliers.all():
+        logging.info('Ignoring %d fiducials farther than %g mm from the curve' % (
+          np.count_nonzero(~curve.inliers), outlierDistanceMm))
+    
+    # Follow the surface with a fixed clearance
+    if snapSurfaceNode:
+      with self.profiler.span('Snap to surface', category):
+        locator = self.surfaceLocator(snapSurfaceNode)
+        # One side for the whole curve, the side most fiducials are on
+        side = locator.side_of(control_points)
+        curve = geometry.PolylineCurve(locator.project(curve.sample(snapSamples), clearanceMm, side))
     
-    # Convert arc length from millimeters to inches
-    def mm_to_in(mm):
-      return mm * 0.0393701
-
-    return round(mm_to_in(arc_length(np.array(list)[:,0], np.array(list)[:,1])), 4), control_points
+    # Arc length of the curve, and the bar trimmed or extended to the requested length
+    with self.profiler.span('Arc length', category):
+      if barLengthMm:
+        bar_points = geometry.constrain_length(curve, barLengthMm, barSamples)
+      else:
+        bar_points = curve.sample_by_length(barSamples)
+    return curve, bar_points
+  
+  def updateCurvePoints(self, barPoints):
+    """Copy the bar points into the persistent curve pipeline, reallocating only when their number changes"""
+    barPoints = np.asarray(barPoints, dtype=float)
+    if self.curvePoints.GetNumberOfPoints() != len(barPoints):
+      self.curvePoints.SetNumberOfPoints(len(barPoints))
+    numpy_support.vtk_to_numpy(self.curvePoints.GetData())[:] = barPoints
+    self.curvePoints.Modified()
+    self.curveSource.Modified()
   
-  def output(self, control_points):
-    # turn control_points into 3D by extruding the points 7.5 millimeters up and down and 1 millimeter up and down
-    extrusion_width = 7.5  # this is in millimeters
-    extrusion_depth = 1  # this is in millimeters
+  def showCurve(self):
+    """
+    Display the persistent curve pipeline, unless it is displayed already: one
+    model node in 3D, and its projection onto each slice view through a
+    transform that follows the slice. Returns the curve model node.
+    """
+    modelNodes = self.ownedNodes('curve')
+    if modelNodes:
+      return modelNodes[0]
+    color = (random.random(), random.random(), random.random())
+    with self.sceneBatch():
+      # Remove leftovers of a curve whose model node was deleted
+      self.removeOwned('curve')
+      
+      # Create a model node
+      modelNode = self.createNode('vtkMRMLModelNode', 'NussCurve', 'curve')
+      modelNode.SetPolyDataConnection(self.curveSource.GetOutputPort())
+      modelNode.CreateDefaultDisplayNodes()
+      displayNode = modelNode.GetDisplayNode()
+      displayNode.SetColor(color)
+      displayNode.SetLineWidth(10)
+      # A line only crosses a slice at single points, the projection is drawn instead
+      displayNode.SetVisibility2D(False)
     
-    vertices = []
-    triangles = []
+    for view_name in ["Red", "Yellow", "Green"]:
+      self.addSliceProjection(slicer.app.layoutManager().sliceWidget(view_name).sliceView(), color, 'curve')
+    return modelNode
+  
+  def addSliceProjection(self, sliceView, color, role):
+    """Draw the curve source projected onto a slice view, updated when the slice moves"""
+    sliceNode = sliceView.mrmlSliceNode()
+    rasToXY = vtk.vtkTransform()
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetInputConnection(self.curveSource.GetOutputPort())
+    transformFilter.SetTransform(rasToXY)
+    mapper = vtk.vtkPolyDataMapper2D()
+    mapper.SetInputConnection(transformFilter.GetOutputPort())
+    actor = vtk.vtkActor2D()
+    actor.SetMapper(mapper)
+    actor.GetProperty().SetColor(color)
+    actor.GetProperty().SetLineWidth(10)
     
-    for i, point in enumerate(control_points):
-        # Create 4 vertices for each control point
-        vertices.append([point[0], point[1] + extrusion_depth, point[2] + extrusion_width])
-        vertices.append([point[0], point[1] + extrusion_depth, point[2] - extrusion_width])
-        vertices.append([point[0], point[1] - extrusion_depth, point[2] + extrusion_width])
-        vertices.append([point[0], point[1] - extrusion_depth, point[2] - extrusion_width])
-        
-        if i < len(control_points) - 1:
-            base = i * 4
-            next_base = (i + 1) * 4
-            
-            # Front face
-            triangles.append([base, next_base, next_base + 1])
-            triangles.append([base, next_base + 1, base + 1])
-            
-            # Back face
-            triangles.append([base + 2, next_base + 3, next_base + 2])
-            triangles.append([base + 2, base + 3, next_base + 3])
-            
-            # Top face
-            triangles.append([base, next_base + 2, next_base])
-            triangles.append([base, base + 2, next_base + 2])
-            
-            # Bottom face
-            triangles.append([base + 1, next_base + 1, next_base + 3])
-            triangles.append([base + 1, next_base + 3, base + 3])
+    rasToXYMatrix = vtk.vtkMatrix4x4()
+    def onSliceModified(caller=None, event=None):
+      vtk.vtkMatrix4x4.Invert(sliceNode.GetXYToRAS(), rasToXYMatrix)
+      rasToXY.SetMatrix(rasToXYMatrix)
+      sliceView.scheduleRender()
+    onSliceModified()
     
-    # Add end caps correctly
-    triangles.append([0, 1, 2])
-    triangles.append([1, 3, 2])
+    renderer = sliceView.renderWindow().GetRenderers().GetFirstRenderer()
+    self.addActor(renderer, actor, role)
+    self.addObserver(sliceNode, vtk.vtkCommand.ModifiedEvent, onSliceModified, role)
+    return actor
+  
+  def updatePreview(self, fiducialNode, snapSurfaceNode=None, clearanceMm=0.0, snapSamples=500, barLengthMm=None,
+      barSamples=4000, fitToleranceMm=0.0, outlierDistanceMm=0.0):
+    """
+    Recompute the bar from the current control points of fiducialNode and update
+    the displayed curve in place.
+    Returns (curve length, bar length) in inches and the bar points, or None
+    with fewer than two points.
+    """
+    points = slicer.util.arrayFromMarkupsControlPoints(fiducialNode)
+    if len(points) < 2:
+      return None
+    curve, bar_points = self.barCurve(points, snapSurfaceNode, clearanceMm, snapSamples, barLengthMm, barSamples,
+      category='preview', fitToleranceMm=fitToleranceMm, outlierDistanceMm=outlierDistanceMm)
+    self.updateCurvePoints(bar_points)
+    self.showCurve()
+    return (round(geometry.mm_to_in(curve.length()), 4), round(geometry.mm_to_in(geometry.polyline_length(bar_points)), 4),
+      bar_points)
+  
+  def planCandidates(self, fiducialNodes, levelCount=1, levelSpacingMm=25.0, surfaceNode=None, snap=False,
+      clearanceMm=0.0, barLengthMm=None, samples=1000, profile='rectangular', fitToleranceMm=0.0,
+      outlierDistanceMm=0.0):
+    """
+    Plan one bar per fiducial node, or levelCount bars per node spaced
+    levelSpacingMm apart along the superior axis, and show each as a model.
+    With a surface, the clearance of every bar is measured on the side most
+    fiducials are on and, if snap is set, the curves follow the surface
+    clearanceMm away on that side. The curves are fitted as in draw().
+    Returns the candidates of NussBarLib.planning in rank order.
+    """
+    pointSets, names = [], []
+    with self.profiler.span('Read fiducials', 'candidates'):
+      for node in fiducialNodes:
+        points = slicer.util.arrayFromMarkupsControlPoints(node)
+        if len(points) < 2:
+          logging.warning('Skipping %s: fewer than two fiducials' % node.GetName())
+          continue
+        for offset, shifted in planning.levels(points, levelCount, levelSpacingMm):
+          pointSets.append(shifted)
+          names.append(node.GetName() if levelCount == 1 else '%s %+g mm' % (node.GetName(), offset))
+    if not pointSets:
+      slicer.util.errorDisplay('Check at least one markups node with two fiducials or more', windowTitle='Nuss Bar error')
+      return []
     
-    last = len(vertices) - 4
-    triangles.append([last, last + 1, last + 2])
-    triangles.append([last + 1, last + 3, last + 2])
+    locator = self.surfaceLocator(surfaceNode) if surfaceNode else None
+    with self.profiler.span('Plan candidates', 'candidates'):
+      candidates = planning.plan_candidates(pointSets, names, samples, barLengthMm, profile,
+        locator=locator, snap=snap, clearance=clearanceMm, fit_tolerance=fitToleranceMm,
+        outlier_distance=outlierDistanceMm)
     
-    mesh = trimesh.Trimesh(vertices, faces=triangles, process=False)
+    with self.profiler.span('Show candidates', 'candidates'), self.sceneBatch():
+      self.removeOwned('candidate')
+      for candidate in candidates:
+        modelNode = self.createNode('vtkMRMLModelNode', 'NussCandidate_%d' % candidate.rank, 'candidate')
+        modelNode.SetDescription(candidate.name)
+        modelNode.SetAndObservePolyData(surface.arrays_polydata(candidate.vertices, candidate.faces))
+        modelNode.CreateDefaultDisplayNodes()
+        display = modelNode.GetDisplayNode()
+        # The best candidate green, the others fading to gray, too close or penetrating ones red
+        if candidate.too_close:
+          display.SetColor(0.9, 0.2, 0.2)
+        else:
+          shade = min(0.15 * (candidate.rank - 1), 0.6)
+          display.SetColor(0.2 + shade, 0.8 - shade / 2, 0.3 + shade / 2)
+    for candidate in candidates:
+      logging.info('Candidate %d %s' % (candidate.rank, candidate.summary()))
+    return candidates
+  
+  def savePlan(self, path, fiducialNode, surfaceNode=None, parameters=None):
+    """
+    Plan the bar of fiducialNode as draw() does with parameters (see
+    NussBarWidget.planParameters), build its mesh and save both in a plan file
+    with a reference to surfaceNode, the skin or bone surface.
+    Returns the NussBarLib.plans.Plan, or None with fewer than two fiducials.
+    """
+    parameters = dict(parameters or {})
+    points = slicer.util.arrayFromMarkupsControlPoints(fiducialNode)
+    if len(points) < 2:
+      slicer.util.errorDisplay('Add at least two fiducials', windowTitle='Nuss Bar error')
+      return None
+    snapSurfaceNode = surfaceNode if parameters.get('snap') else None
+    curve, barPoints = self.barCurve(points, snapSurfaceNode, parameters.get('clearance', 0.0),
+      barLengthMm=parameters.get('bar_length'), category='plan',
+      fitToleranceMm=parameters.get('fit_tolerance', 0.0), outlierDistanceMm=parameters.get('outlier_distance', 0.0))
+    with self.profiler.span('Build bar mesh', 'plan'):
+      vertices, triangles = sweep.bar_mesh(barPoints, parameters.get('samples', 1000),
+        parameters.get('profile', 'rectangular'))
     
-    # Allow user to specify where to save the file as an obj
-    save_path = qt.QFileDialog.getSaveFileName(None, 'Save Nuss Bar', '', 'OBJ (*.obj)')
-    if save_path:
-        mesh.export(save_path, file_type='obj')
-    else:
+    reference = None
+    if surfaceNode:
+      with self.profiler.span('Surface digest', 'plan'):
+        storageNode = surfaceNode.GetStorageNode()
+        reference = plans.surface_reference(slicer.util.arrayFromModelPoints(surfaceNode), surfaceNode.GetName(),
+          storageNode.GetFileName() if storageNode else None)
+    plan = plans.Plan(fiducialNode.GetName(), points, geometry.order_fiducials(points), curve, barPoints, vertices,
+      triangles, parameters, reference)
+    with self.profiler.span('Write plan', 'plan'):
+      path = plans.save_plan(path, plan)
+    logging.info('Plan saved to ' + path)
+    return plan
+  
+  def loadPlan(self, path):
+    """
+    Restore a saved plan: its fiducials as a new markups node, the drawn bar,
+    and its surface, found in the scene by content or loaded from its file.
+    Nothing is fitted or integrated again, and the live preview continues from
+    the saved curve.
+    Returns (plan, fiducial node, surface node or None), or None if the plan
+    cannot be read.
+    """
+    with self.profiler.span('Read plan', 'plan'):
+      try:
+        plan = plans.load_plan(path)
+      except plans.PLAN_ERRORS as e:
+        slicer.util.errorDisplay('Cannot load the plan: ' + str(e), windowTitle='Nuss Bar error')
+        return None
+    
+    with self.profiler.span('Show plan', 'plan'):
+      with self.sceneBatch():
+        self.removeOwned('plan')
+        fiducialNode = self.createNode('vtkMRMLMarkupsFiducialNode', plan.name, 'plan')
+        fiducialNode.CreateDefaultDisplayNodes()
+        slicer.util.updateMarkupsControlPointsFromArray(fiducialNode, plan.fiducials)
+      self.updateCurvePoints(plan.bar_points)
+      self.showCurve()
+    
+    surfaceNode = None
+    if plan.surface:
+      with self.profiler.span('Find surface', 'plan'):
+        surfaceNode = self.findSurface(plan.surface)
+      if surfaceNode is None:
+        logging.warning('Surface %s of the plan not found' % plan.surface.get('name'))
+    logging.info('Plan loaded: ' + str(plan.summary()))
+    return plan, fiducialNode, surfaceNode
+  
+  def findSurface(self, reference):
+    """
+    Model node whose points match a surface reference of a plan file, or the
+    model loaded from the file of the reference if no node matches.
+    """
+    for node in slicer.util.getNodesByClass('vtkMRMLModelNode'):
+      polyData = node.GetPolyData()
+      if polyData is None or polyData.GetNumberOfPoints() != reference['numberOfPoints']:
+        continue
+      if plans.surface_reference(slicer.util.arrayFromModelPoints(node))['digest'] == reference['digest']:
+        return node
+    path = reference.get('path')
+    if path and os.path.exists(path):
+      return slicer.util.loadModel(path)
+    return None
+  
+  def reviewPlans(self, paths):
+    """
+    Read many plan files at once and show the bar of each as a model.
+    Returns the plans read and (path, error message) for the others.
+    """
+    with self.profiler.span('Read plans', 'review'):
+      loaded, errors = plans.load_plans(paths)
+    for path, message in errors:
+      logging.warning('Skipping plan %s: %s' % (path, message))
+    
+    with self.profiler.span('Show plans', 'review'), self.sceneBatch():
+      self.removeOwned('review')
+      for index, plan in enumerate(loaded):
+        modelNode = self.createNode('vtkMRMLModelNode', 'NussPlan_' + plan.name, 'review')
+        modelNode.SetDescription(plan.created or '')
+        modelNode.SetAndObservePolyData(surface.arrays_polydata(plan.vertices, plan.faces))
+        modelNode.CreateDefaultDisplayNodes()
+        # Hues spread by the golden ratio, so that neighbouring plans differ
+        modelNode.GetDisplayNode().SetColor(*colorsys.hsv_to_rgb((index * 0.618034) % 1.0, 0.6, 0.9))
+    return loaded, errors
+  
+  def analyzeClearance(self, barPoints, surfaceNode, profile='rectangular', samples=1000, contactDistanceMm=1.0,
+      colorRangeMm=10.0):
+    """
+    Measure the clearance of the bar mesh from the surface of surfaceNode, show
+    the bar colored by clearance (red in contact, blue colorRangeMm away or
+    more) and mark the predicted contact points.
+    Returns the NussBarLib.clearance.Clearance of the bar.
+    """
+    locator = self.surfaceLocator(surfaceNode)
+    with self.profiler.span('Build bar mesh', 'clearance'):
+      centerline = sweep.resample_polyline(np.asarray(barPoints, dtype=float), samples)
+      vertices, triangles = sweep.sweep_profile(centerline, sweep.make_profile(profile))
+    with self.profiler.span('Measure clearance', 'clearance'):
+      result = clearance.analyze_clearance(centerline, vertices, locator, contactDistanceMm)
+    logging.info('Clearance: ' + str(result.summary()))
+    
+    with self.profiler.span('Show clearance', 'clearance'), self.sceneBatch():
+      self.removeOwned('clearance')
+      polyData = surface.arrays_polydata(vertices, triangles)
+      scalars = numpy_support.numpy_to_vtk(result.vertex_clearances.astype(np.float32), deep=True)
+      scalars.SetName('Clearance')
+      polyData.GetPointData().SetScalars(scalars)
+      modelNode = self.createNode('vtkMRMLModelNode', 'NussBarClearance', 'clearance')
+      modelNode.SetAndObservePolyData(polyData)
+      modelNode.CreateDefaultDisplayNodes()
+      display = modelNode.GetDisplayNode()
+      display.SetAndObserveColorNodeID('vtkMRMLProceduralColorNodeRedGreenBlue')
+      display.SetActiveScalarName('Clearance')
+      display.SetScalarRangeFlag(slicer.vtkMRMLDisplayNode.UseManualScalarRange)
+      display.SetScalarRange(0.0, colorRangeMm)
+      display.SetScalarVisibility(True)
+      
+      if result.contacts:
+        contactNode = self.createNode('vtkMRMLMarkupsFiducialNode', 'NussContacts', 'clearance')
+        contactNode.CreateDefaultDisplayNodes()
+        contactNode.GetDisplayNode().SetSelectedColor(0.9, 0.2, 0.2)
+        for contact in result.contacts:
+          index = contactNode.AddControlPoint(vtk.vtkVector3d(*contact.surface_point))
+          contactNode.SetNthControlPointLabel(index, '%.1f mm' % contact.clearance)
+          contactNode.SetNthControlPointLocked(index, True)
+    return result
+  
+  def bendInstructions(self, barPoints, toleranceMm=1.0, minSpacingMm=0.0, candidates=200):
+    """
+    Find the fewest bends, at least minSpacingMm apart, that shape a straight
+    bar within toleranceMm of the bar points, among candidates stations. Show
+    the bar rebuilt from the bend table and its bends, then ask where to save
+    the table (CSV or JSON).
+    Returns the NussBarLib.bending.BendTable, or None if no bends fit.
+    """
+    with self.profiler.span('Bend stations', 'bending'):
+      try:
+        table = bending.bend_table(np.asarray(barPoints, dtype=float), toleranceMm, candidates, minSpacingMm)
+      except ValueError as e:
+        slicer.util.errorDisplay(str(e), windowTitle='Nuss Bar error')
+        return None
+    logging.info('Bend table: ' + str(table.summary()))
+    
+    with self.profiler.span('Show bends', 'bending'), self.sceneBatch():
+      self.removeOwned('bends')
+      lineSource = vtk.vtkPolyLineSource()
+      lineSource.SetNumberOfPoints(len(table.bends) + 2)
+      for index, point in enumerate(table.vertices()):
+        lineSource.SetPoint(index, *point)
+      lineSource.Update()
+      modelNode = self.createNode('vtkMRMLModelNode', 'NussBentBar', 'bends')
+      modelNode.SetAndObservePolyData(lineSource.GetOutput())
+      modelNode.CreateDefaultDisplayNodes()
+      modelNode.GetDisplayNode().SetColor(0.9, 0.6, 0.1)
+      modelNode.GetDisplayNode().SetLineWidth(4)
+      if table.bends:
+        bendNode = self.createNode('vtkMRMLMarkupsFiducialNode', 'NussBends', 'bends')
+        bendNode.CreateDefaultDisplayNodes()
+        bendNode.GetDisplayNode().SetSelectedColor(0.9, 0.6, 0.1)
+        for number, bend in enumerate(table.bends):
+          index = bendNode.AddControlPoint(vtk.vtkVector3d(*bend.point))
+          bendNode.SetNthControlPointLabel(index, 'B%d %.0f\u00b0' % (number + 1, bend.angle))
+          bendNode.SetNthControlPointLocked(index, True)
+    
+    path = qt.QFileDialog.getSaveFileName(None, 'Save Bend Table', 'NussBends.csv', 'CSV (*.csv);;JSON (*.json)')
+    if path:
+      if not path.lower().endswith(('.csv', '.json')):
+        path += '.csv'
+      bending.write_bend_table(path, table)
+      logging.info('Bend table written to ' + path)
+    return table
+  
+  def output(self, bar_points, profile='rectangular', samples=1000):
+    """
+    Ask where to save the bar, then build and write its mesh on a worker thread.
+    Returns the task, or None if no file was chosen.
+    """
+    # Allow user to specify where to save the file and in which format
+    save_path = qt.QFileDialog.getSaveFileName(None, 'Save Nuss Bar', '',
+      'OBJ (*.obj);;Binary STL (*.stl);;Binary PLY (*.ply);;glTF binary (*.glb)')
+    if not save_path:
         slicer.util.errorDisplay('Please specify a save path.')
-        return
-      
\ No newline at end of file
+        return None
+    if os.path.splitext(save_path)[1].lstrip('.').lower() not in export.MESH_FORMATS:
+      save_path += '.obj'
+    
+    task = self.taskRunner.submit(self.writeBarMesh, save_path, np.array(bar_points), profile, samples,
+      name='Nuss Bar output')
+    self.watchTask(task, lambda path: logging.info('Nuss Bar written to ' + path))
+    return task
+  
+  def writeBarMesh(self, save_path, bar_points, profile='rectangular', samples=1000, progress=lambda fraction, message: None):
+    """
+    Sweep the bar along the drawn bar centerline and save it in the format of
+    the file extension. Safe to run on a worker thread.
+    """
+    # turn the centerline into 3D by sweeping a 15 x 2 millimeter cross-section along it
+    progress(0.3, 'Building bar mesh')
+    with self.profiler.span('Build bar mesh', 'output'):
+      vertices, triangles = sweep.bar_mesh(bar_points, samples, profile)
+    progress(0.7, 'Writing ' + os.path.basename(save_path))
+    with self.profiler.span('Write bar mesh', 'output'):
+      export.write_mesh(save_path, vertices, triangles)
+    return save_path
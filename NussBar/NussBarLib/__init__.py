@@ -0,0 +1,6 @@
+"""
+Slicer-independent planning code for ShapeNuss.
+
+The modules in this package only depend on NumPy so they can be used both from
+the NussBar scripted module and from the batch command line (see cli.py).
+"""
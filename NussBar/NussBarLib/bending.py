@@ -0,0 +1,298 @@
+"""
+Bend instructions for pre-shaping the bar on a bender.
+
+The planned centerline is replaced by a polyline whose vertices are the bend
+stations: the bar is fed straight between stations and bent at each one by an
+angle, in a plane rotated about the bar axis from the plane of the previous
+bend. Stations are chosen among evenly spaced candidates along the bar by
+dynamic programming, as the fewest stations whose straight segments stay
+within a tolerance of the curve (the least squared error among those). The
+error of a segment is estimated from the cumulative turning angle of the
+curve, then measured exactly, and the estimate is scaled until the measured
+error fits. The bar is finally rebuilt from the bend table alone and compared
+with the planned centerline.
+"""
+import csv
+import json
+
+import numpy as np
+
+HEADER = 'NussBar bend table. SPACE=RAS'
+
+
+class Bend:
+  """One bend station: where along the straight bar, by how much and in which plane"""
+
+  def __init__(self, position, angle, rotation, point):
+    # Distance from the start of the bar (millimeters)
+    self.position = position
+    # Bend angle and rotation of the bending plane about the bar axis from the
+    # previous bend, or from superior for the first bend (degrees)
+    self.angle = angle
+    self.rotation = rotation
+    # Planned position of the station (RAS)
+    self.point = point
+
+  def summary(self):
+    return {
+      'positionMm': round(float(self.position), 4),
+      'angleDeg': round(float(self.angle), 4),
+      'rotationDeg': round(float(self.rotation), 4),
+      'point': np.round(self.point, 4).tolist(),
+    }
+
+
+class BendTable:
+  """
+  Bends of one bar (millimeters, degrees) and the pose of its start, from which
+  the bent bar is rebuilt. max_deviation and rms_deviation are the distances
+  from the planned centerline to the rebuilt bar, once measured.
+  """
+
+  def __init__(self, bends, length, start, direction, normal, tolerance):
+    self.bends = bends
+    self.length = length
+    self.start = start
+    self.direction = direction
+    # Reference for the rotation of the first bend, normal to direction
+    self.normal = normal
+    self.tolerance = tolerance
+    self.max_deviation = None
+    self.rms_deviation = None
+
+  def vertices(self):
+    """Vertices of the bar rebuilt from the table, start and end included"""
+    return reconstruct(self)
+
+  def summary(self):
+    """JSON-serializable bend table"""
+    def rounded(value):
+      return None if value is None else round(float(value), 4)
+    return {
+      'numberOfBends': len(self.bends),
+      'barLengthMm': rounded(self.length),
+      'toleranceMm': rounded(self.tolerance),
+      'maxDeviationMm': rounded(self.max_deviation),
+      'rmsDeviationMm': rounded(self.rms_deviation),
+      'start': np.round(self.start, 4).tolist(),
+      'direction': np.round(self.direction, 6).tolist(),
+      'normal': np.round(self.normal, 6).tolist(),
+      'bends': [bend.summary() for bend in self.bends],
+    }
+
+
+def _normalize(v):
+  n = np.linalg.norm(v, axis=-1, keepdims=True)
+  return v / np.where(n > 0, n, 1.0)
+
+
+def _rotate(v, axis, angle):
+  """Rotate the 3-vector v about the unit axis by angle (radians), right-handed"""
+  # np.cross is slow on single vectors
+  cross = np.array([axis[1] * v[2] - axis[2] * v[1], axis[2] * v[0] - axis[0] * v[2], axis[0] * v[1] - axis[1] * v[0]])
+  return v * np.cos(angle) + cross * np.sin(angle) + axis * np.dot(axis, v) * (1 - np.cos(angle))
+
+
+def _reference_normal(direction, up):
+  """up made normal to direction, or any normal if they are parallel"""
+  for axis in (up, (1.0, 0.0, 0.0), (0.0, 1.0, 0.0)):
+    axis = np.asarray(axis, dtype=float)
+    normal = axis - np.dot(axis, direction) * direction
+    if np.linalg.norm(normal) > 1e-6:
+      return _normalize(normal)
+
+
+def turning_angles(points):
+  """Angle (radians) between consecutive segments at each interior vertex of a polyline"""
+  segments = _normalize(np.diff(points, axis=0))
+  return np.arccos(np.clip(np.sum(segments[:-1] * segments[1:], axis=1), -1.0, 1.0))
+
+
+def distances_to_polyline(points, vertices, chunk=4096):
+  """Distance from each point to the closest segment of a polyline"""
+  a = vertices[:-1]
+  ab = np.diff(vertices, axis=0)
+  squared = np.maximum(np.sum(ab * ab, axis=1), 1e-300)
+  distances = np.empty(len(points))
+  for start in range(0, len(points), chunk):
+    ap = points[start:start + chunk, None, :] - a[None]
+    t = np.clip(np.sum(ap * ab[None], axis=-1) / squared, 0.0, 1.0)
+    distances[start:start + chunk] = np.linalg.norm(ap - t[..., None] * ab[None], axis=-1).min(axis=1)
+  return distances
+
+
+def segment_errors(points, arc_lengths, vertices, vertex_arc_lengths):
+  """
+  Largest distance from the points of each piece of a curve to the straight
+  segment that replaces it. The pieces are delimited by the arc lengths of the
+  vertices, and the points by their own arc lengths.
+  """
+  segment = np.clip(np.searchsorted(vertex_arc_lengths, arc_lengths, side='right') - 1, 0, len(vertices) - 2)
+  a, b = vertices[segment], vertices[segment + 1]
+  ab, ap = b - a, points - a
+  t = np.clip(np.sum(ap * ab, axis=1) / np.maximum(np.sum(ab * ab, axis=1), 1e-300), 0.0, 1.0)
+  distances = np.linalg.norm(ap - t[:, None] * ab, axis=1)
+  errors = np.zeros(len(vertices) - 1)
+  np.maximum.at(errors, segment, distances)
+  return errors
+
+
+def choose_stations(arc_lengths, cumulative_turning, tolerance, scale=0.125, min_spacing=0.0):
+  """
+  Indices of the fewest candidates, first and last included, such that the
+  estimated error of every straight segment between consecutive ones is within
+  tolerance; among those, the ones with the least sum of squared errors. The
+  error of the segment from candidate i to j is estimated as
+  scale * length * turning, with the turning angle at the candidates strictly
+  between them (for a circular arc, scale 1/8 gives its sagitta). Segments
+  shorter than min_spacing are not allowed.
+  Returns the indices and the estimated error of each segment.
+  """
+  s, turning = arc_lengths, cumulative_turning
+  n = len(s)
+
+  def estimate(i, j):
+    return scale * (s[j] - s[i]) * (turning[np.maximum(j - 1, i)] - turning[i])
+
+  # The estimate only grows as a segment starts earlier, so the candidates a
+  # segment can start from form a window: from the first within tolerance
+  # (found for every end at once by bisection) to the last min_spacing away
+  end = np.arange(n)
+  first, last = np.zeros(n, dtype=np.int64), np.maximum(end - 1, 0)
+  while np.any(first < last):
+    middle = (first + last) // 2
+    fits = estimate(middle, end) <= tolerance
+    first, last = np.where(fits, first, middle + 1), np.where(fits, middle, last)
+  last = np.minimum(np.searchsorted(s, s - min_spacing, side='right') - 1, end - 1)
+
+  # Fewest segments first, then the least sum of squared estimates: with the
+  # count weighted above any possible sum, one argmin ranks both
+  weight = n * tolerance**2 + 1.0
+  key = np.full(n, np.inf)
+  key[0] = 0.0
+  previous = np.zeros(n, dtype=np.int64)
+  for j in range(1, n):
+    if first[j] > last[j]:
+      continue
+    window = np.arange(first[j], last[j] + 1)
+    totals = key[window] + weight + estimate(window, j)**2
+    best = int(np.argmin(totals))
+    key[j], previous[j] = totals[best], window[best]
+  if not np.isfinite(key[-1]):
+    raise ValueError('No bend stations %g mm apart or more keep the bar within %g mm of the curve' % (
+      min_spacing, tolerance))
+  stations = [n - 1]
+  while stations[-1] != 0:
+    stations.append(previous[stations[-1]])
+  stations = np.array(stations[::-1])
+  return stations, estimate(stations[:-1], stations[1:])
+
+
+def table_from_polyline(vertices, tolerance, up=(0.0, 0.0, 1.0)):
+  """Bend table of a bar bent at the interior vertices of a polyline"""
+  feeds = np.linalg.norm(np.diff(vertices, axis=0), axis=1)
+  directions = _normalize(np.diff(vertices, axis=0))
+  positions = np.cumsum(feeds)
+  incoming, outgoing = directions[:-1], directions[1:]
+  axes = np.cross(incoming, outgoing)
+  sines = np.linalg.norm(axes, axis=1)
+  angles = np.degrees(np.arctan2(sines, np.sum(incoming * outgoing, axis=1)))
+  axes = _normalize(axes)
+  # The rotation from the previous bending axis r to this one a about the bar
+  # axis d has sine d.(r x a) = r.(a x d)
+  sine_terms = np.cross(axes, incoming)
+  normal = _reference_normal(directions[0], up)
+  reference = normal
+  bends = []
+  for k in range(len(axes)):
+    rotation = 0.0
+    # A straight station keeps the previous plane
+    if sines[k] > 1e-12:
+      rotation = np.degrees(np.arctan2(np.dot(reference, sine_terms[k]), np.dot(reference, axes[k])))
+      reference = axes[k]
+    bends.append(Bend(positions[k], angles[k], rotation, vertices[k + 1]))
+  return BendTable(bends, float(positions[-1]), vertices[0], directions[0], normal, tolerance)
+
+
+def reconstruct(table):
+  """
+  Bar bent as the table says: fed straight from the start, and at each bend
+  turned about its axis by the rotation, then bent by the angle.
+  Returns the vertices of the bar, start and end included.
+  """
+  point = np.asarray(table.start, dtype=float)
+  direction = np.asarray(table.direction, dtype=float)
+  normal = np.asarray(table.normal, dtype=float)
+  vertices = [point]
+  position = 0.0
+  for bend in table.bends:
+    point = point + (bend.position - position) * direction
+    position = bend.position
+    vertices.append(point)
+    normal = _rotate(normal, direction, np.radians(bend.rotation))
+    direction = _normalize(_rotate(direction, normal, np.radians(bend.angle)))
+  vertices.append(point + (table.length - position) * direction)
+  return np.array(vertices)
+
+
+def bend_table(points, tolerance=1.0, candidates=200, min_spacing=0.0, up=(0.0, 0.0, 1.0), max_iterations=10):
+  """
+  Bend table of the bar centerline points (ordered, RAS millimeters) that keeps
+  the bent bar within tolerance millimeters of it, with bends at least
+  min_spacing millimeters apart, chosen among candidates evenly spaced
+  stations. The rotation of the first bend is measured from up.
+  Returns the BendTable, with the deviation of the rebuilt bar measured.
+  """
+  points = np.asarray(points, dtype=float)
+  lengths = np.linalg.norm(np.diff(points, axis=0), axis=1)
+  points = points[np.concatenate(([True], lengths > 0))]
+  if len(points) < 2:
+    raise ValueError('The centerline has zero length')
+  arc_lengths = np.concatenate(([0.0], np.cumsum(np.linalg.norm(np.diff(points, axis=0), axis=1))))
+
+  # Candidate stations evenly spaced along the bar, and the cumulative turning
+  # angle of the curve up to each of them
+  s = np.linspace(0.0, arc_lengths[-1], max(int(candidates), 2))
+  candidate_points = np.stack([np.interp(s, arc_lengths, points[:, axis]) for axis in range(3)], axis=1)
+  turning = np.zeros(len(s))
+  turning[1:-1] = np.cumsum(turning_angles(candidate_points))
+  turning[-1] = turning[-2]
+
+  # Scale the error estimate until the measured errors fit the tolerance
+  scale = 0.125
+  for iteration in range(max_iterations):
+    stations, estimates = choose_stations(s, turning, tolerance, scale, min_spacing)
+    vertices = candidate_points[stations]
+    errors = segment_errors(points, arc_lengths, vertices, s[stations])
+    too_far = (errors > tolerance) & (estimates > 0)
+    if not too_far.any():
+      break
+    scale *= max(float(np.max(errors[too_far] / estimates[too_far])), 1.05)
+
+  table = table_from_polyline(vertices, tolerance, up)
+  deviations = distances_to_polyline(points, table.vertices())
+  table.max_deviation = float(deviations.max())
+  table.rms_deviation = float(np.sqrt(np.mean(deviations**2)))
+  return table
+
+
+def write_bend_table(path, table):
+  """Write a bend table as CSV, or as JSON if path ends with .json"""
+  if path.lower().endswith('.json'):
+    with open(path, 'w') as f:
+      json.dump(table.summary(), f, indent=2)
+    return
+  with open(path, 'w', newline='') as f:
+    f.write('# %s\n' % HEADER)
+    f.write('# Bar length (mm) = %.2f, tolerance (mm) = %.2f, max deviation (mm) = %.2f\n' % (
+      table.length, table.tolerance, table.max_deviation if table.max_deviation is not None else float('nan')))
+    f.write('# Start = %s, direction = %s, first rotation from = %s\n' % tuple(
+      ' '.join('%.4f' % value for value in vector) for vector in (table.start, table.direction, table.normal)))
+    writer = csv.writer(f)
+    writer.writerow(['Bend', 'Position (mm)', 'Feed (mm)', 'Angle (deg)', 'Rotation (deg)'])
+    position = 0.0
+    for index, bend in enumerate(table.bends):
+      writer.writerow([index + 1, '%.2f' % bend.position, '%.2f' % (bend.position - position), '%.2f' % bend.angle,
+        '%.2f' % bend.rotation])
+      position = bend.position
+    writer.writerow(['End', '%.2f' % table.length, '%.2f' % (table.length - position), '', ''])
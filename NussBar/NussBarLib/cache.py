@@ -0,0 +1,93 @@
+"""
+Content-addressed, size-capped LRU cache for intermediate segmentation results.
+Entries are keyed on a digest of the input volume plus the processing
+parameters, so the same scan processed with the same settings is never
+segmented twice.
+"""
+import collections
+import hashlib
+import threading
+
+import numpy as np
+
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+
+def array_digest(array, *extra):
+  """Hex digest of an array's shape, type and content, plus any extra values"""
+  array = np.ascontiguousarray(array)
+  h = hashlib.blake2b(digest_size=16)
+  h.update(repr((array.shape, array.dtype.str, extra)).encode())
+  h.update(memoryview(array).cast('B'))
+  return h.hexdigest()
+
+
+def pack_mask(mask):
+  """Store a binary mask with one bit per voxel"""
+  mask = np.asarray(mask)
+  return np.packbits(mask.ravel() != 0), mask.shape
+
+
+def unpack_mask(packed):
+  """Inverse of pack_mask, returns a uint8 array of 0/1"""
+  bits, shape = packed
+  return np.unpackbits(bits, count=int(np.prod(shape))).reshape(shape)
+
+
+class LRUCache:
+  """
+  Least-recently-used cache bounded by the total size of its entries.
+  The size of each entry is given by the caller when it is stored.
+  """
+
+  def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+    self.max_bytes = max_bytes
+    self._entries = collections.OrderedDict()
+    self._bytes = 0
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  @property
+  def total_bytes(self):
+    return self._bytes
+
+  def get(self, key, default=None):
+    with self._lock:
+      if key not in self._entries:
+        self.misses += 1
+        return default
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return self._entries[key][0]
+
+  def put(self, key, value, nbytes):
+    """Store value, evicting the least recently used entries to stay under max_bytes"""
+    with self._lock:
+      if key in self._entries:
+        self._bytes -= self._entries.pop(key)[1]
+      if nbytes > self.max_bytes:
+        # Would evict everything and still not fit
+        return False
+      self._entries[key] = (value, nbytes)
+      self._bytes += nbytes
+      while self._bytes > self.max_bytes:
+        _, (_, evicted) = self._entries.popitem(last=False)
+        self._bytes -= evicted
+      return True
+
+  def discard(self, key):
+    with self._lock:
+      if key in self._entries:
+        self._bytes -= self._entries.pop(key)[1]
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._bytes = 0
@@ -0,0 +1,101 @@
+"""
+Clearance between a planned bar and the chest surface (skin or bone).
+
+Every vertex of the swept bar mesh is measured against the surface in one
+query of a SurfaceLocator, which is built once per surface and reused while
+the bar is edited. Distances are signed: positive on the free side of the
+surface, the side most of the bar is on, and negative where the bar passes
+through it. Each cross-section of the bar gets the clearance of its closest
+vertex, and runs of cross-sections closer than the contact distance are the
+predicted contacts.
+"""
+import numpy as np
+
+
+class Contact:
+  """Stretch of the bar closer to the surface than the contact distance"""
+
+  def __init__(self, point, surface_point, clearance, position, length):
+    # Bar vertex and surface point where the clearance is smallest
+    self.point = point
+    self.surface_point = surface_point
+    self.clearance = clearance
+    # Arc length of the closest cross-section from the start of the bar, and of the stretch
+    self.position = position
+    self.length = length
+
+  def summary(self):
+    return {
+      'point': np.round(self.point, 4).tolist(),
+      'surfacePoint': np.round(self.surface_point, 4).tolist(),
+      'clearanceMm': round(float(self.clearance), 4),
+      'positionMm': round(float(self.position), 4),
+      'lengthMm': round(float(self.length), 4),
+    }
+
+
+class Clearance:
+  """Clearance of one bar (millimeters, RAS)"""
+
+  def __init__(self, vertex_clearances, section_clearances, contacts, contact_distance):
+    # Signed clearance of every bar mesh vertex and of every cross-section
+    self.vertex_clearances = vertex_clearances
+    self.section_clearances = section_clearances
+    self.contacts = contacts
+    self.contact_distance = contact_distance
+
+  @property
+  def min_clearance(self):
+    return float(self.vertex_clearances.min())
+
+  @property
+  def mean_clearance(self):
+    return float(self.section_clearances.mean())
+
+  def summary(self):
+    """JSON-serializable clearance report"""
+    return {
+      'minClearanceMm': round(self.min_clearance, 4),
+      'meanClearanceMm': round(self.mean_clearance, 4),
+      'contactDistanceMm': round(float(self.contact_distance), 4),
+      'penetrates': bool(self.min_clearance < 0),
+      'contacts': [contact.summary() for contact in self.contacts],
+    }
+
+
+def runs(mask):
+  """(start, stop) index pairs of the runs of True in a 1D boolean array"""
+  edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+  return np.stack((np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)), axis=1)
+
+
+def analyze_clearance(centerline, vertices, locator, contact_distance=1.0, side=0):
+  """
+  Clearance of a bar mesh made by sweep.sweep_profile along centerline
+  (samples, 3), whose first samples * k vertices are the rings of the
+  cross-sections. side selects the free side of the surface as in
+  SurfaceLocator.project: +1 where its normals point, -1 the other side, 0 the
+  side most bar vertices are on.
+  """
+  centerline = np.asarray(centerline, dtype=float)
+  vertices = np.asarray(vertices, dtype=float)
+  samples = len(centerline)
+  ring_vertices = (len(vertices) - 2) // samples * samples
+
+  closest, _, distances = locator.signed_distances(vertices)
+  if not side:
+    side = 1 if np.count_nonzero(distances >= 0) * 2 >= len(distances) else -1
+  clearances = distances * np.sign(side)
+
+  rings = clearances[:ring_vertices].reshape(samples, -1)
+  closest_vertex = np.argmin(rings, axis=1)
+  sections = rings[np.arange(samples), closest_vertex]
+  position = np.concatenate(([0.0], np.cumsum(np.linalg.norm(np.diff(centerline, axis=0), axis=1))))
+
+  contacts = []
+  for start, stop in runs(sections < contact_distance):
+    section = start + int(np.argmin(sections[start:stop]))
+    vertex = section * rings.shape[1] + closest_vertex[section]
+    contacts.append(Contact(vertices[vertex], closest[vertex], sections[section], position[section],
+      position[stop - 1] - position[start]))
+  return Clearance(clearances, sections, contacts, contact_distance)
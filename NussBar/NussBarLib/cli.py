@@ -0,0 +1,142 @@
+"""
+Batch bar planning without Slicer.
+
+Plans a bar for every fiducial file (.fcsv / .mrk.json) in a directory and
+writes, per case, the bar mesh and a JSON summary:
+
+  python -m NussBarLib.cli <fiducial directory> <output directory> [--format obj stl]
+    [--profile rectangular|rounded] [--samples N] [--bar-length INCHES]
+    [--fit-tolerance MM] [--outlier-distance MM] [--workers N] [--plan] [--bend-tolerance MM]
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import sys
+import time
+
+from NussBarLib import bending, export, fiducials, geometry, plans, sweep
+
+
+def find_cases(input_dir, recursive=False):
+  """Sorted list of fiducial files in input_dir"""
+  paths = []
+  for root, dirs, files in os.walk(input_dir):
+    paths.extend(os.path.join(root, name) for name in files if fiducials.is_fiducial_file(name))
+    if not recursive:
+      break
+  return sorted(paths)
+
+
+def process_case(path, output_dir, formats=('obj',), resolution=50, samples=1000, profile='rectangular',
+    bar_length=None, fit_tolerance=None, outlier_distance=None, save_plan=False, bend_tolerance=None):
+  """
+  Plan one case and write its outputs. bar_length is the physical bar length in
+  millimeters, or None for the length of the curve. fit_tolerance and
+  outlier_distance (millimeters) select a smoothing spline fit. With save_plan,
+  a plan file that restores the case without planning it again is written too.
+  With bend_tolerance (millimeters), so is a bend table within that tolerance.
+  Returns the case summary.
+  """
+  name = fiducials.case_name(path)
+  summary = {'case': name, 'input': os.path.abspath(path)}
+  start = time.perf_counter()
+  try:
+    points = fiducials.read_fiducials(path)
+    plan = geometry.plan_bar(points, resolution, samples, profile,
+      bar_length=bar_length, fit_tolerance=fit_tolerance, outlier_distance=outlier_distance)
+    summary.update(plan.summary())
+    summary['outputs'] = []
+    for file_type in formats:
+      mesh_path = os.path.join(output_dir, name + '.' + file_type)
+      export.write_mesh(mesh_path, plan.vertices, plan.faces, file_type)
+      summary['outputs'].append(os.path.abspath(mesh_path))
+    if save_plan:
+      parameters = {'profile': profile, 'samples': samples, 'bar_length': bar_length,
+        'fit_tolerance': fit_tolerance, 'outlier_distance': outlier_distance}
+      saved = plans.Plan(name, points, plan.control_points, plan.curve, plan.bar_points, plan.vertices,
+        plan.faces, parameters)
+      summary['outputs'].append(os.path.abspath(plans.save_plan(os.path.join(output_dir, name), saved)))
+    if bend_tolerance:
+      table = bending.bend_table(plan.bar_points, bend_tolerance)
+      summary['numberOfBends'] = len(table.bends)
+      summary['maxBendDeviationMm'] = round(table.max_deviation, 4)
+      bend_path = os.path.join(output_dir, name + '.bends.csv')
+      bending.write_bend_table(bend_path, table)
+      summary['outputs'].append(os.path.abspath(bend_path))
+    summary['status'] = 'ok'
+  except Exception as e:
+    summary['status'] = 'error'
+    summary['error'] = str(e)
+  summary['seconds'] = round(time.perf_counter() - start, 4)
+  with open(os.path.join(output_dir, name + '.json'), 'w') as f:
+    json.dump(summary, f, indent=2)
+  return summary
+
+
+def run_batch(paths, output_dir, formats=('obj',), resolution=50, samples=1000, profile='rectangular',
+    workers=None, bar_length=None, fit_tolerance=None, outlier_distance=None, save_plan=False, bend_tolerance=None):
+  """Process cases in a process pool, yielding summaries as they complete"""
+  os.makedirs(output_dir, exist_ok=True)
+  options = (bar_length, fit_tolerance, outlier_distance, save_plan, bend_tolerance)
+  if workers == 1:
+    for path in paths:
+      yield process_case(path, output_dir, formats, resolution, samples, profile, *options)
+    return
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+    futures = [executor.submit(process_case, path, output_dir, formats, resolution, samples, profile, *options)
+      for path in paths]
+    for future in concurrent.futures.as_completed(futures):
+      yield future.result()
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Plan Nuss bars for a directory of fiducial files.')
+  parser.add_argument('input_dir', help='directory containing .fcsv or .mrk.json files')
+  parser.add_argument('output_dir', help='directory where meshes and summaries are written')
+  parser.add_argument('--format', dest='formats', nargs='+', choices=export.MESH_FORMATS,
+    default=['obj'], help='mesh file formats to write (default: obj)')
+  parser.add_argument('--resolution', type=int, default=50,
+    help='number of curve segments stored in the summary (default: 50)')
+  parser.add_argument('--samples', type=int, default=1000,
+    help='number of cross-sections along the bar mesh (default: 1000)')
+  parser.add_argument('--profile', choices=sweep.PROFILES, default='rectangular',
+    help='bar cross-section (default: rectangular)')
+  parser.add_argument('--bar-length', type=float, default=None,
+    help='physical bar length in inches; the bar is trimmed or extended to it (default: curve length)')
+  parser.add_argument('--fit-tolerance', type=float, default=None,
+    help='fit a smoothing spline within this RMS distance (mm) of the fiducials (default: pass through them)')
+  parser.add_argument('--outlier-distance', type=float, default=None,
+    help='ignore fiducials farther than this (mm) from the smoothing spline (default: keep all)')
+  parser.add_argument('--workers', type=int, default=None,
+    help='number of worker processes (default: number of CPUs)')
+  parser.add_argument('--recursive', action='store_true', help='also search subdirectories')
+  parser.add_argument('--plan', action='store_true',
+    help='also write a plan file (.plan.json and .plan.npz) per case, to reopen it in Slicer')
+  parser.add_argument('--bend-tolerance', type=float, default=None,
+    help='also write a bend table (.bends.csv) per case, bending the bar within this distance (mm) of the curve')
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO, format='%(message)s')
+  paths = find_cases(args.input_dir, args.recursive)
+  if not paths:
+    logging.error('No fiducial files found in ' + args.input_dir)
+    return 1
+
+  failed = 0
+  for summary in run_batch(paths, args.output_dir, args.formats, args.resolution, args.samples,
+      args.profile, args.workers, geometry.in_to_mm(args.bar_length) if args.bar_length else None,
+      args.fit_tolerance, args.outlier_distance, args.plan, args.bend_tolerance):
+    if summary['status'] == 'ok':
+      logging.info('%s: curve %.4f in, bar %.4f in' % (summary['case'], summary['markupBarLengthIn'],
+        summary['generatedBarLengthIn']))
+    else:
+      failed += 1
+      logging.error('%s: %s' % (summary['case'], summary['error']))
+  logging.info('Processed %d cases, %d failed' % (len(paths), failed))
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,205 @@
+"""
+Mesh writers working directly on NumPy vertex and face arrays.
+
+Binary STL, binary PLY and glTF binary (GLB) are written in chunks of faces,
+so multi-million-triangle skin surfaces are streamed to disk without building
+text or a full per-triangle copy in memory. GLB positions can be quantized to
+16-bit integers (KHR_mesh_quantization), and large surfaces can be simplified
+by vertex clustering before they are written.
+"""
+import json
+import os
+
+import numpy as np
+
+MESH_FORMATS = ('obj', 'stl', 'ply', 'glb')
+
+HEADER = 'NussBar output. SPACE=RAS'
+
+# Faces written per chunk by the streaming writers
+CHUNK_FACES = 1 << 18
+
+
+def write_obj(path, vertices, faces):
+  """Write a Wavefront OBJ file"""
+  vertices = np.asarray(vertices, dtype=float)
+  faces = np.asarray(faces, dtype=np.int64)
+  with open(path, 'w') as f:
+    f.write('# ' + HEADER + '\n')
+    np.savetxt(f, vertices, fmt='v %.8g %.8g %.8g')
+    np.savetxt(f, faces + 1, fmt='f %d %d %d')
+
+
+def face_normals(vertices, faces):
+  """Unit normals of each triangle"""
+  triangles = vertices[faces]
+  normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+  lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+  return normals / np.where(lengths > 0, lengths, 1.0)
+
+
+def write_stl(path, vertices, faces, chunk_faces=CHUNK_FACES):
+  """Write a binary STL file"""
+  vertices = np.asarray(vertices, dtype=float)
+  faces = np.asarray(faces, dtype=np.int64)
+  record = np.dtype([
+    ('normal', '<f4', (3,)),
+    ('vertices', '<f4', (3, 3)),
+    ('attribute', '<u2')])
+  with open(path, 'wb') as f:
+    f.write(HEADER.encode().ljust(80, b' '))
+    f.write(np.uint32(len(faces)).tobytes())
+    for start in range(0, len(faces), chunk_faces):
+      chunk = faces[start:start + chunk_faces]
+      data = np.zeros(len(chunk), dtype=record)
+      data['normal'] = face_normals(vertices, chunk)
+      data['vertices'] = vertices[chunk]
+      data.tofile(f)
+
+
+def write_ply(path, vertices, faces, chunk_faces=CHUNK_FACES):
+  """Write a binary little-endian PLY file"""
+  vertices = np.asarray(vertices, dtype=float)
+  faces = np.asarray(faces, dtype=np.int64)
+  header = '\n'.join([
+    'ply',
+    'format binary_little_endian 1.0',
+    'comment ' + HEADER,
+    'element vertex %d' % len(vertices),
+    'property float x',
+    'property float y',
+    'property float z',
+    'element face %d' % len(faces),
+    'property list uchar int vertex_indices',
+    'end_header']) + '\n'
+  record = np.dtype([('count', 'u1'), ('indices', '<i4', (3,))])
+  with open(path, 'wb') as f:
+    f.write(header.encode('ascii'))
+    vertices.astype('<f4').tofile(f)
+    for start in range(0, len(faces), chunk_faces):
+      chunk = faces[start:start + chunk_faces]
+      data = np.empty(len(chunk), dtype=record)
+      data['count'] = 3
+      data['indices'] = chunk
+      data.tofile(f)
+
+
+def _padding(length, alignment=4):
+  return -length % alignment
+
+
+def write_glb(path, vertices, faces, quantize=False, chunk_faces=CHUNK_FACES):
+  """
+  Write a glTF 2.0 binary file with one triangle mesh. Positions stay in RAS
+  millimeters and the node scales them to glTF meters. With quantize, positions
+  are stored as 16-bit integers (KHR_mesh_quantization, under 0.01% of the
+  mesh size in error) and dequantized by the node transform.
+  """
+  vertices = np.asarray(vertices, dtype=float)
+  faces = np.asarray(faces, dtype=np.int64)
+  low, high = vertices.min(axis=0), vertices.max(axis=0)
+  translation, scale = np.zeros(3), 1.0
+  if quantize:
+    translation = (low + high) / 2
+    scale = max(float((high - low).max()) / 65534, 1e-12)
+    # int16 x, y, z plus padding, as vertex attributes must be 4-byte aligned
+    positions = np.zeros((len(vertices), 4), dtype='<i2')
+    positions[:, :3] = np.rint((vertices - translation) / scale)
+    position_type, position_stride = 5122, 8
+    position_min = positions[:, :3].min(axis=0).tolist()
+    position_max = positions[:, :3].max(axis=0).tolist()
+  else:
+    positions = vertices.astype('<f4')
+    position_type, position_stride = 5126, 12
+    position_min, position_max = positions.min(axis=0).tolist(), positions.max(axis=0).tolist()
+  index_dtype, index_type = ('<u2', 5123) if len(vertices) < 65535 else ('<u4', 5125)
+
+  position_bytes = positions.nbytes
+  index_offset = position_bytes + _padding(position_bytes)
+  index_bytes = faces.size * np.dtype(index_dtype).itemsize
+  buffer_bytes = index_offset + index_bytes + _padding(index_bytes)
+
+  gltf = {
+    'asset': {'version': '2.0', 'generator': 'NussBar', 'extras': {'space': 'RAS', 'units': 'mm'}},
+    'scene': 0,
+    'scenes': [{'nodes': [0]}],
+    'nodes': [{'mesh': 0, 'translation': (translation / 1000).tolist(), 'scale': [scale / 1000] * 3}],
+    'meshes': [{'primitives': [{'attributes': {'POSITION': 0}, 'indices': 1, 'mode': 4}]}],
+    'buffers': [{'byteLength': buffer_bytes}],
+    'bufferViews': [
+      {'buffer': 0, 'byteOffset': 0, 'byteLength': position_bytes, 'byteStride': position_stride, 'target': 34962},
+      {'buffer': 0, 'byteOffset': index_offset, 'byteLength': index_bytes, 'target': 34963}],
+    'accessors': [
+      {'bufferView': 0, 'componentType': position_type, 'count': len(vertices), 'type': 'VEC3',
+        'min': position_min, 'max': position_max},
+      {'bufferView': 1, 'componentType': index_type, 'count': int(faces.size), 'type': 'SCALAR'}],
+  }
+  if quantize:
+    gltf['extensionsUsed'] = gltf['extensionsRequired'] = ['KHR_mesh_quantization']
+  content = json.dumps(gltf, separators=(',', ':')).encode()
+  content += b' ' * _padding(len(content))
+
+  with open(path, 'wb') as f:
+    f.write(np.array([0x46546C67, 2, 12 + 8 + len(content) + 8 + buffer_bytes], dtype='<u4').tobytes())
+    f.write(np.array([len(content), 0x4E4F534A], dtype='<u4').tobytes())
+    f.write(content)
+    f.write(np.array([buffer_bytes, 0x004E4942], dtype='<u4').tobytes())
+    positions.tofile(f)
+    f.write(b'\0' * _padding(position_bytes))
+    for start in range(0, len(faces), chunk_faces):
+      faces[start:start + chunk_faces].astype(index_dtype).tofile(f)
+    f.write(b'\0' * _padding(index_bytes))
+
+
+def cluster_vertices(vertices, faces, cell_size):
+  """
+  Simplify a mesh by vertex clustering: vertices in the same cubic cell of
+  cell_size millimeters are merged at their mean, and triangles that collapse
+  or repeat are dropped. Linear time, meant for dense skin surfaces whose
+  detail is finer than the planning needs.
+  Returns (vertices, faces).
+  """
+  vertices = np.asarray(vertices, dtype=float)
+  faces = np.asarray(faces, dtype=np.int64)
+  cells = np.floor((vertices - vertices.min(axis=0)) / cell_size).astype(np.int64)
+  # One integer key per cell is much faster to deduplicate than rows
+  keys = np.ravel_multi_index(cells.T, tuple(cells.max(axis=0) + 1))
+  _, cluster, counts = np.unique(keys, return_inverse=True, return_counts=True)
+  merged = np.stack([np.bincount(cluster, vertices[:, axis], minlength=len(counts)) for axis in range(3)], axis=1)
+  merged /= counts[:, None]
+
+  faces = cluster[faces]
+  faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])]
+  # Drop repeated triangles, keeping the orientation of the first one
+  corners = np.sort(faces, axis=1)
+  if len(merged) < 1 << 21:
+    _, first = np.unique(np.ravel_multi_index(corners.T, (len(merged),) * 3), return_index=True)
+  else:
+    _, first = np.unique(corners, axis=0, return_index=True)
+  faces = faces[np.sort(first)]
+
+  # Drop vertices no triangle uses any more
+  used = np.zeros(len(merged), dtype=bool)
+  used[faces.ravel()] = True
+  index = np.cumsum(used) - 1
+  return merged[used], index[faces]
+
+
+def write_mesh(path, vertices, faces, file_type=None, quantize=False):
+  """
+  Write a mesh, choosing the format from file_type or the file extension.
+  quantize only applies to GLB.
+  """
+  if file_type is None:
+    file_type = os.path.splitext(path)[1].lstrip('.')
+  file_type = file_type.lower()
+  if file_type == 'obj':
+    write_obj(path, vertices, faces)
+  elif file_type == 'stl':
+    write_stl(path, vertices, faces)
+  elif file_type == 'ply':
+    write_ply(path, vertices, faces)
+  elif file_type == 'glb':
+    write_glb(path, vertices, faces, quantize)
+  else:
+    raise ValueError('Unsupported mesh format: ' + file_type)
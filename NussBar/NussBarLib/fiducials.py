@@ -0,0 +1,71 @@
+"""
+Readers for Slicer markups files (.fcsv and .mrk.json).
+Positions are always returned in RAS millimeters, the coordinate system used by
+the NussBar module.
+"""
+import json
+import os
+
+import numpy as np
+
+FIDUCIAL_EXTENSIONS = ('.mrk.json', '.fcsv')
+
+
+def _to_ras(points, coordinate_system):
+  points = np.asarray(points, dtype=float).reshape(-1, 3)
+  if str(coordinate_system).upper() in ('LPS', '1'):
+    points = points * np.array([-1.0, -1.0, 1.0])
+  return points
+
+
+def read_fcsv(path):
+  """Read control point positions from a Slicer fiducial CSV file"""
+  coordinate_system = 'RAS'
+  points = []
+  with open(path, 'r') as f:
+    for line in f:
+      line = line.strip()
+      if not line:
+        continue
+      if line.startswith('#'):
+        key, _, value = line[1:].partition('=')
+        if key.strip() == 'CoordinateSystem':
+          coordinate_system = value.strip()
+        continue
+      fields = line.split(',')
+      points.append([float(v) for v in fields[1:4]])
+  return _to_ras(points, coordinate_system)
+
+
+def read_mrk_json(path):
+  """Read control point positions from the first markup in a .mrk.json file"""
+  with open(path, 'r') as f:
+    document = json.load(f)
+  markups = document.get('markups', [])
+  if not markups:
+    return np.zeros((0, 3))
+  markup = markups[0]
+  points = [p['position'] for p in markup.get('controlPoints', []) if 'position' in p]
+  return _to_ras(points, markup.get('coordinateSystem', 'LPS'))
+
+
+def is_fiducial_file(path):
+  return path.lower().endswith(FIDUCIAL_EXTENSIONS)
+
+
+def case_name(path):
+  """File name without the markups extension"""
+  name = os.path.basename(path)
+  for extension in FIDUCIAL_EXTENSIONS:
+    if name.lower().endswith(extension):
+      return name[:-len(extension)]
+  return os.path.splitext(name)[0]
+
+
+def read_fiducials(path):
+  """Read control point positions (RAS) from a .fcsv or .mrk.json file"""
+  if path.lower().endswith('.mrk.json'):
+    return read_mrk_json(path)
+  if path.lower().endswith('.fcsv'):
+    return read_fcsv(path)
+  raise ValueError('Unsupported fiducial file: ' + path)
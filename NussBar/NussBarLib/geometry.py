@@ -0,0 +1,675 @@
+"""
+Bar geometry computed from plain NumPy arrays: fiducial ordering, curve
+fitting, arc length and bar planning.
+"""
+import numpy as np
+
+from NussBarLib import sweep
+
+MM_PER_INCH = 25.4
+
+
+def mm_to_in(mm):
+  """Convert millimeters to inches"""
+  return mm / MM_PER_INCH
+
+
+def in_to_mm(inches):
+  """Convert inches to millimeters"""
+  return inches * MM_PER_INCH
+
+
+def as_points(points):
+  """Return points as a float (n, 3) array"""
+  points = np.asarray(points, dtype=float)
+  if points.ndim != 2 or points.shape[1] != 3:
+    raise ValueError('Expected an (n, 3) array of points, got shape %s' % (points.shape,))
+  return points
+
+
+def padded_bounds(points, padding):
+  """
+  Center and half-size of the bounding box of points, enlarged by padding
+  (scalar or per-axis) on every side
+  """
+  points = as_points(points)
+  low, high = points.min(axis=0), points.max(axis=0)
+  return (low + high) / 2, (high - low) / 2 + np.broadcast_to(padding, (3,))
+
+
+def order_points(points, neighbors=8):
+  """
+  Order points along the open curve they sample, from clicked fiducials to
+  dense point clouds of a contour, in O(n log n).
+  The points are joined by the minimum spanning tree of their nearest neighbor
+  graph. The two ends of the longest path through the tree are the ends of the
+  curve, and every point is placed where its branch joins that path, so the
+  order follows the chest wall however it bends or wraps. The first point is
+  the end with the larger x (patient left).
+  """
+  from scipy import sparse
+  from scipy.sparse import csgraph
+  from scipy.spatial import cKDTree
+
+  points = as_points(points)
+  n = len(points)
+  if n < 3:
+    return points[np.argsort(-points[:, 0], kind='stable')]
+
+  # Nearest neighbor graph, with more neighbors until it is connected
+  tree = cKDTree(points)
+  tiny = 1e-12 * max(np.ptp(points, axis=0).max(), 1.0)
+  k = min(neighbors, n - 1)
+  while True:
+    distances, indices = tree.query(points, k + 1)
+    # Zero weights would be read as missing edges
+    graph = sparse.csr_matrix((np.maximum(distances[:, 1:], tiny).ravel(), (np.repeat(np.arange(n), k), indices[:, 1:].ravel())),
+      shape=(n, n))
+    if k == n - 1 or csgraph.connected_components(graph, directed=False)[0] == 1:
+      break
+    k = min(2 * k, n - 1)
+  spanning_tree = csgraph.minimum_spanning_tree(graph)
+
+  # Ends of the longest path: the farthest point from any point, and the farthest from that one
+  start = int(np.argmax(csgraph.dijkstra(spanning_tree, directed=False, indices=0)))
+  from_start = csgraph.dijkstra(spanning_tree, directed=False, indices=start)
+  end = int(np.argmax(from_start))
+  from_end = csgraph.dijkstra(spanning_tree, directed=False, indices=end)
+
+  # Position along the path where each point's branch joins it, then distance from the start
+  order = np.lexsort((from_start, from_start - from_end))
+  if points[order[0], 0] < points[order[-1], 0]:
+    order = order[::-1]
+  return points[order]
+
+
+def order_fiducials(points):
+  """Order raw fiducial positions along the bar, as control points of its curve"""
+  return order_points(points)
+
+
+def polyline_length(points):
+  """Length of the polyline through points"""
+  points = as_points(points)
+  return float(np.sum(np.linalg.norm(np.diff(points, axis=0), axis=1)))
+
+
+# 5-point Gauss-Legendre rule on [-1, 1]
+_GAUSS_NODES, _GAUSS_WEIGHTS = np.polynomial.legendre.leggauss(5)
+
+
+def _gauss_legendre(function, a, b):
+  """Integrals of a vectorized scalar function over the intervals [a, b]"""
+  a, b = np.broadcast_arrays(np.asarray(a, dtype=float), np.asarray(b, dtype=float))
+  half = (b - a) / 2
+  nodes = ((a + b) / 2)[..., None] + half[..., None] * _GAUSS_NODES
+  return half * (function(nodes.ravel()).reshape(nodes.shape) @ _GAUSS_WEIGHTS)
+
+
+class ArcLengthTable:
+  """
+  Cumulative arc length of a curve, integrated with adaptive Gauss-Legendre
+  quadrature between the curve's knots, and a table of parameters evenly spaced
+  in arc length for constant-time length-to-parameter lookups.
+  """
+
+  def __init__(self, curve, tolerance=1e-7, resolution=4096, max_levels=30):
+    self.curve = curve
+    t = curve.knots
+    h = np.diff(t)
+
+    # Pieces as (knot interval, start and end fraction of the interval, length)
+    intervals, starts, ends, lengths = [], [], [], []
+    interval = np.arange(len(h))
+    a = np.zeros(len(interval))
+    b = np.ones(len(interval))
+    # Split pieces in half until the two halves agree with the whole
+    for level in range(max_levels):
+      if len(interval) == 0:
+        break
+      origin, width = t[interval], h[interval]
+      middle = (a + b) / 2
+      whole = _gauss_legendre(curve.speed, origin + a * width, origin + b * width)
+      halves = _gauss_legendre(curve.speed, origin + a * width, origin + middle * width) \
+        + _gauss_legendre(curve.speed, origin + middle * width, origin + b * width)
+      converged = np.abs(whole - halves) <= tolerance * np.maximum(halves, 1.0)
+      if level == max_levels - 1:
+        converged[:] = True
+      intervals.append(interval[converged])
+      starts.append(a[converged])
+      ends.append(b[converged])
+      lengths.append(halves[converged])
+      split = ~converged
+      interval = np.concatenate((interval[split], interval[split]))
+      a, b = np.concatenate((a[split], middle[split])), np.concatenate((middle[split], b[split]))
+    intervals, starts, ends, lengths = (np.concatenate(x) for x in (intervals, starts, ends, lengths))
+    order = np.lexsort((starts, intervals))
+    self.intervals, self.starts, self.ends = intervals[order], starts[order], ends[order]
+    self.piece_lengths = lengths[order]
+    self.parameters = np.concatenate((t[self.intervals] + self.starts * h[self.intervals], [t[-1]]))
+    self.lengths = np.concatenate(([0.0], np.cumsum(self.piece_lengths)))
+    self.length = float(self.lengths[-1])
+
+    # Parameters at evenly spaced arc lengths, inverted from lengths of small
+    # parameter cells that are exact at the piece boundaries
+    self.resolution = resolution
+    cells = np.union1d(np.linspace(0.0, 1.0, resolution + 1), self.parameters)
+    cell_lengths = _gauss_legendre(curve.speed, cells[:-1], cells[1:])
+    cumulative = np.concatenate(([0.0], np.cumsum(cell_lengths)))
+    cumulative *= self.length / max(cumulative[-1], 1e-300)
+    grid = np.interp(np.linspace(0.0, self.length, resolution + 1), cumulative, cells)
+    grid[0], grid[-1] = 0.0, 1.0
+    self.parameter_grid = grid
+
+  # Arrays that define a table, as stored in plan files
+  ARRAYS = ('intervals', 'starts', 'ends', 'piece_lengths', 'parameter_grid')
+
+  @classmethod
+  def restore(cls, curve, intervals, starts, ends, piece_lengths, parameter_grid):
+    """Table of curve from the arrays of one computed before, without integrating again"""
+    table = cls.__new__(cls)
+    table.curve = curve
+    table.intervals, table.starts, table.ends = intervals, starts, ends
+    table.piece_lengths = piece_lengths
+    t, h = curve.knots, np.diff(curve.knots)
+    table.parameters = np.concatenate((t[intervals] + starts * h[intervals], [t[-1]]))
+    table.lengths = np.concatenate(([0.0], np.cumsum(piece_lengths)))
+    table.length = float(table.lengths[-1])
+    table.resolution = len(parameter_grid) - 1
+    table.parameter_grid = parameter_grid
+    return table
+
+  def length_at(self, u):
+    """Arc length from the start of the curve to parameters u"""
+    u = np.clip(np.asarray(u, dtype=float), 0.0, 1.0)
+    i = np.clip(np.searchsorted(self.parameters, u, side='right') - 1, 0, len(self.parameters) - 2)
+    return self.lengths[i] + _gauss_legendre(self.curve.speed, self.parameters[i], u)
+
+  def parameter_at(self, s):
+    """Parameters at arc lengths s, by interpolation in the evenly spaced table"""
+    position = np.clip(np.asarray(s, dtype=float), 0.0, self.length) / max(self.length, 1e-300) * self.resolution
+    k = np.minimum(position.astype(np.int64), self.resolution - 1)
+    w = position - k
+    return self.parameter_grid[k] * (1 - w) + self.parameter_grid[k + 1] * w
+
+
+class ParametricCurve:
+  """
+  Piecewise polynomial curve parameterized by u from 0 to 1. Subclasses set the
+  knots and, per knot interval i, the coefficients (interval, power, xyz) of the
+  polynomial in (u - knots[i]).
+  """
+
+  knots = np.array([0.0, 1.0])
+  coefficients = np.zeros((1, 1, 3))
+
+  def _intervals(self, u):
+    u = np.clip(np.asarray(u, dtype=float), 0.0, 1.0)
+    i = np.clip(np.searchsorted(self.knots, u, side='right') - 1, 0, len(self.knots) - 2)
+    return i, (u - self.knots[i])[..., None]
+
+  def evaluate(self, u):
+    """Positions at parameters u (scalar or array in [0, 1])"""
+    i, d = self._intervals(u)
+    c = self.coefficients[i]
+    result = c[..., -1, :]
+    for power in range(c.shape[-2] - 2, -1, -1):
+      result = result * d + c[..., power, :]
+    return result
+
+  def derivative(self, u):
+    """Derivatives with respect to u at parameters u"""
+    i, d = self._intervals(u)
+    c = self.coefficients[i]
+    degree = c.shape[-2] - 1
+    if degree == 0:
+      return np.zeros_like(c[..., 0, :])
+    result = degree * c[..., degree, :]
+    for power in range(degree - 1, 0, -1):
+      result = result * d + power * c[..., power, :]
+    return result
+
+  def speed(self, u):
+    """Norm of the derivative"""
+    return np.linalg.norm(self.derivative(u), axis=-1)
+
+  def sample(self, resolution=50):
+    """resolution + 1 evenly spaced (in parameter) points along the curve"""
+    return self.evaluate(np.linspace(0.0, 1.0, resolution + 1))
+
+  @property
+  def arc_length_table(self):
+    table = getattr(self, '_arc_length_table', None)
+    if table is None:
+      table = self._arc_length_table = ArcLengthTable(self)
+    return table
+
+  def length(self):
+    """Arc length of the curve"""
+    return self.arc_length_table.length
+
+  def sample_by_length(self, samples):
+    """samples points evenly spaced in arc length"""
+    table = self.arc_length_table
+    return self.evaluate(table.parameter_at(np.linspace(0.0, table.length, samples)))
+
+
+class StoredCurve(ParametricCurve):
+  """
+  Curve given directly by its knots and coefficients, for example read from a
+  plan file, with the arrays of its arc length table if they are known (see
+  ArcLengthTable.restore).
+  """
+
+  def __init__(self, knots, coefficients, arc_length_arrays=None):
+    self.knots = np.asarray(knots, dtype=float)
+    self.coefficients = np.asarray(coefficients, dtype=float)
+    if arc_length_arrays is not None:
+      self._arc_length_table = ArcLengthTable.restore(self, **arc_length_arrays)
+
+
+class PolylineCurve(ParametricCurve):
+  """Straight segments through points, parameterized by normalized length"""
+
+  def __init__(self, points):
+    points = as_points(points)
+    lengths = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    points = points[np.concatenate(([True], lengths > 0))]
+    if len(points) < 2:
+      raise ValueError('At least two distinct points are needed to make a curve')
+    knots = np.concatenate(([0.0], np.cumsum(lengths[lengths > 0])))
+    self.points = points
+    self.knots = knots / knots[-1]
+    slopes = np.diff(points, axis=0) / np.diff(self.knots)[:, None]
+    self.coefficients = np.stack((points[:-1], slopes), axis=1)
+
+
+class SplineCurve(ParametricCurve):
+  """
+  Natural cubic spline through points, parameterized by normalized chord length
+  like vtkParametricSpline. The curve parameter u runs from 0 to 1.
+  """
+
+  def __init__(self, points):
+    points = as_points(points)
+    # Repeated points give zero-length intervals
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = np.any(np.diff(points, axis=0) != 0, axis=1)
+    points = points[keep]
+    if len(points) < 2:
+      raise ValueError('At least two distinct points are needed to fit a curve')
+
+    chords = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    knots = np.concatenate(([0.0], np.cumsum(chords)))
+    self.points = points
+    self.knots = knots / knots[-1]
+    self.second_derivatives = self._solve_second_derivatives(self.knots, points)
+    self.coefficients = self._coefficients(self.knots, points, self.second_derivatives)
+
+  @staticmethod
+  def _solve_second_derivatives(t, p):
+    """Solve the tridiagonal system of a natural spline (Thomas algorithm)"""
+    n = len(p)
+    m = np.zeros_like(p)
+    if n < 3:
+      return m
+    h = np.diff(t)
+    slopes = np.diff(p, axis=0) / h[:, None]
+    lower = h[1:-1].copy()
+    diag = 2 * (h[:-1] + h[1:])
+    upper = h[1:-1].copy()
+    rhs = 6 * np.diff(slopes, axis=0)
+    for i in range(1, n - 2):
+      w = lower[i - 1] / diag[i - 1]
+      diag[i] -= w * upper[i - 1]
+      rhs[i] -= w * rhs[i - 1]
+    inner = np.zeros_like(rhs)
+    inner[-1] = rhs[-1] / diag[-1]
+    for i in range(n - 4, -1, -1):
+      inner[i] = (rhs[i] - upper[i] * inner[i + 1]) / diag[i]
+    m[1:-1] = inner
+    return m
+
+  @staticmethod
+  def _coefficients(t, p, m):
+    """Cubic coefficients of each interval from the knot values and second derivatives"""
+    h = np.diff(t)[:, None]
+    slope = np.diff(p, axis=0) / h
+    return np.stack((p[:-1], slope - h * (2 * m[:-1] + m[1:]) / 6, m[:-1] / 2, (m[1:] - m[:-1]) / (6 * h)), axis=1)
+
+
+def _chord_parameters(points, window=1):
+  """
+  Normalized chord-length parameters of ordered points and the total chord
+  length. With a window, chords are measured between the medians of blocks of
+  window consecutive points, which ignores noise and isolated outliers, and
+  the parameters of the points are interpolated linearly by index.
+  """
+  n = len(points)
+  blocks = n // window
+  if blocks < 2:
+    blocks, window = n, 1
+  medians = np.median(points[:blocks * window].reshape(blocks, window, 3), axis=1) if window > 1 else points
+  chords = np.concatenate(([0.0], np.cumsum(np.linalg.norm(np.diff(medians, axis=0), axis=1))))
+  if chords[-1] <= 0:
+    raise ValueError('At least two distinct points are needed to fit a curve')
+  if window == 1:
+    return chords / chords[-1], chords[-1]
+  # Block medians sit at the block centers; extrapolate linearly to the first and last points
+  centers = np.arange(blocks) * window + (window - 1) / 2
+  index = np.arange(n)
+  parameters = np.interp(index, centers, chords)
+  before, after = index < centers[0], index > centers[-1]
+  parameters[before] = (index[before] - centers[0]) * (chords[1] - chords[0]) / window
+  parameters[after] = chords[-1] + (index[after] - centers[-1]) * (chords[-1] - chords[-2]) / window
+  parameters -= parameters[0]
+  return parameters / parameters[-1], parameters[-1]
+
+
+def _uniform_basis(u, segments):
+  """Knot span and the four nonzero uniform cubic B-spline weights at parameters u"""
+  x = np.clip(u, 0.0, 1.0) * segments
+  span = np.minimum(x.astype(np.int64), segments - 1)
+  t = x - span
+  t2, t3 = t * t, t * t * t
+  weights = np.stack(((1 - t)**3, 3 * t3 - 6 * t2 + 4, -3 * t3 + 3 * t2 + 3 * t + 1, t3), axis=1) / 6
+  return span, weights
+
+
+def _difference_penalty(segments):
+  """Upper bands (offset 0, 1, 2) of D'D for the second differences D of segments + 3 control points"""
+  size = segments + 3
+  rows = np.arange(size - 2)
+  second_difference = (1.0, -2.0, 1.0)
+  bands = np.zeros((3, size))
+  for p in range(3):
+    for q in range(p, 3):
+      bands[q - p] += np.bincount(rows + q, minlength=size) * second_difference[p] * second_difference[q]
+  return bands
+
+
+def _fit_uniform_bspline(span, basis, points, weights, segments, smoothing):
+  """
+  Control points of the uniform cubic B-spline minimizing the weighted squared
+  distances to points plus smoothing times the sum of squared second
+  differences of the control points. The normal equations are banded.
+  """
+  from scipy.linalg import solveh_banded
+
+  size = segments + 3
+  weighted = basis * weights[:, None]
+  # Upper banded form, as expected by solveh_banded
+  bands = np.zeros((4, size))
+  for a in range(4):
+    for b in range(a, 4):
+      bands[3 - (b - a)] += np.bincount(span + b, weighted[:, a] * basis[:, b], minlength=size)
+  bands[1:] += smoothing * _difference_penalty(segments)[::-1]
+  rhs = np.stack([sum(np.bincount(span + a, weighted[:, a] * points[:, axis], minlength=size) for a in range(4))
+    for axis in range(3)], axis=1)
+  return solveh_banded(bands, rhs)
+
+
+def _evaluate_uniform_bspline(span, basis, control_points):
+  return np.einsum('nk,nkd->nd', basis, control_points[span[:, None] + np.arange(4)])
+
+
+def _closest_parameters(control_points, segments, points, per_segment=64):
+  """
+  Parameter of the closest point of a uniform B-spline to each point and the
+  distance to it, from per_segment samples of every knot interval. The
+  parameter of the nearest sample is refined by a step along the tangent, so
+  points past the ends get parameters below 0 or above 1 in their order.
+  """
+  from scipy.spatial import cKDTree
+
+  u = np.linspace(0.0, 1.0, segments * per_segment + 1)
+  samples = _evaluate_uniform_bspline(*_uniform_basis(u, segments), control_points)
+  distances, index = cKDTree(samples).query(points, workers=-1)
+  tangents = np.gradient(samples, u[1], axis=0)[index]
+  steps = np.einsum('nd,nd->n', points - samples[index], tangents) / np.maximum(
+    np.einsum('nd,nd->n', tangents, tangents), 1e-300)
+  return u[index] + steps, distances
+
+
+class SmoothingSplineCurve(ParametricCurve):
+  """
+  Least-squares cubic smoothing spline (P-spline) through ordered points, for
+  noisy clicks as well as dense point clouds sampled from a surface.
+
+  A uniform cubic B-spline with segments intervals is fitted to the points at
+  their chord-length parameters, penalized by smoothing (mm^2) times its
+  bending energy. The normal equations are banded, so a fit is O(n) in the
+  number of points plus a banded solve over the control points.
+  With tolerance (millimeters), smoothing is chosen as the largest value whose
+  RMS residual stays within tolerance. With outlier_distance (millimeters),
+  points farther from the curve are rejected: RANSAC trials fit a coarse
+  spline to small random subsets, and the largest consensus set is refined
+  with the full spline until it no longer changes. Outliers can mislead the
+  order of the points, so during rejection the inliers are parameterized by
+  their closest points on the latest curve instead of by their order.
+  """
+
+  def __init__(self, points, smoothing=0.01, tolerance=None, segments=None, outlier_distance=None, trials=50,
+      seed=0):
+    points = as_points(points)
+    if len(points) < 2:
+      raise ValueError('At least two points are needed to fit a curve')
+    n = len(points)
+    self.points = points
+    self.segments = segments = int(segments or np.clip(n // 2, 4, 100))
+    self.window = max(1, n // (4 * segments))
+
+    weights = np.ones(n)
+    self._parameterize(weights)
+    if outlier_distance:
+      weights, parameters = self._consensus(smoothing, outlier_distance, trials, np.random.default_rng(seed))
+      self._parameterize(weights, parameters)
+    for attempt in range(10):
+      self.smoothing, self.control_points = self._fit_tolerance(weights, smoothing, tolerance)
+      if not outlier_distance:
+        break
+      parameters, distances = _closest_parameters(self.control_points, segments, points)
+      inliers = distances <= outlier_distance
+      if np.all(inliers == (weights > 0)) or np.count_nonzero(inliers) < 2:
+        break
+      weights = inliers.astype(float)
+      self._parameterize(weights, parameters)
+    self.inliers = weights > 0
+    self.rms_error = float(np.sqrt(np.average(self.residuals(self.control_points)**2, weights=weights)))
+
+    self.knots = np.linspace(0.0, 1.0, segments + 1)
+    self.coefficients = self._coefficients(self.control_points, segments)
+
+  def _parameterize(self, weights, closest=None):
+    """
+    Chord-length parameters of the points with nonzero weight, taken in their
+    order or, given the parameters of their closest points on a previous
+    curve, in the order of those. The other points get parameters
+    interpolated by index, or by closest parameter.
+    """
+    index = np.flatnonzero(weights > 0)
+    if closest is not None:
+      index = index[np.argsort(closest[index], kind='stable')]
+    parameters, self._chord_length = _chord_parameters(self.points[index], self.window)
+    if closest is None:
+      self.parameters = np.interp(np.arange(len(self.points)), index, parameters)
+    else:
+      self.parameters = np.interp(closest, closest[index], parameters)
+    self._span, self._basis = _uniform_basis(self.parameters, self.segments)
+
+  def _penalty_scale(self, smoothing, weights, segments, chord_length=None):
+    # Bending energy integral(|s''(u)|^2 du) is segments^3 |D c|^2. Dividing it by the squared
+    # chord length makes smoothing mean the same for small and large chests.
+    return smoothing * weights.sum() * segments**3 / (chord_length or self._chord_length)**2
+
+  def _solve(self, weights, smoothing):
+    return _fit_uniform_bspline(self._span, self._basis, self.points, weights, self.segments,
+      self._penalty_scale(smoothing, weights, self.segments))
+
+  def residuals(self, control_points):
+    """Distances between the points and the curve of control_points at the same parameters"""
+    return np.linalg.norm(self.points - _evaluate_uniform_bspline(self._span, self._basis, control_points), axis=1)
+
+  def _fit_tolerance(self, weights, smoothing, tolerance):
+    """(smoothing, control points), searching the smoothing for tolerance if given"""
+    if not tolerance:
+      return smoothing, self._solve(weights, smoothing)
+
+    def rms(control_points):
+      return np.sqrt(np.average(self.residuals(control_points)**2, weights=weights))
+
+    # Bisection on log10(smoothing): the residual grows with the smoothing
+    low, high = -8.0, 6.0
+    best = (10**low, self._solve(weights, 10**low))
+    if rms(best[1]) > tolerance:
+      return best
+    while high - low > 0.05:
+      middle = (low + high) / 2
+      control_points = self._solve(weights, 10**middle)
+      if rms(control_points) <= tolerance:
+        low, best = middle, (10**middle, control_points)
+      else:
+        high = middle
+    return best
+
+  def _consensus(self, smoothing, outlier_distance, trials, rng, scored_points=5000):
+    """
+    Weights (0 or 1) of the largest set of points within outlier_distance of a
+    coarse spline fitted to a random subset, small enough to often be free of
+    outliers, and the parameters of the closest points of every point on that
+    spline. Outliers can fold the order of the points (out along the outliers,
+    back along the curve), so subsets are drawn regardless of the order and
+    ordered by themselves, and distances are measured to the closest point of
+    the spline. Subsets are scored on at most scored_points points.
+    """
+    n = len(self.points)
+    segments = min(self.segments, 8)
+    subset_size = min(n, 2 * (segments + 3))
+    if subset_size >= n:
+      # Too few points for subsets: leave one point out at a time
+      subsets = [np.delete(np.arange(n), i) for i in range(n)] if n > 3 else [np.arange(n)]
+    else:
+      subsets = [rng.choice(n, subset_size, replace=False) for _ in range(trials)]
+    scored = np.arange(n) if n <= scored_points else rng.choice(n, scored_points, replace=False)
+    best, best_count, best_error = None, -1, np.inf
+    for subset in subsets:
+      points = order_points(self.points[subset])
+      weights = np.ones(len(subset))
+      try:
+        parameters, chord_length = _chord_parameters(points)
+      except ValueError:
+        continue
+      span, basis = _uniform_basis(parameters, segments)
+      control_points = _fit_uniform_bspline(span, basis, points, weights, segments,
+        self._penalty_scale(smoothing, weights, segments, chord_length))
+      distances = _closest_parameters(control_points, segments, self.points[scored])[1]
+      inliers = distances <= outlier_distance
+      count, error = int(np.count_nonzero(inliers)), float(np.sum(distances[inliers]**2))
+      if count > best_count or (count == best_count and error < best_error):
+        best, best_count, best_error = control_points, count, error
+    if best is None:
+      return np.ones(n), None
+    parameters, distances = _closest_parameters(best, segments, self.points)
+    inliers = distances <= outlier_distance
+    if np.count_nonzero(inliers) < 2:
+      return np.ones(n), None
+    return inliers.astype(float), parameters
+
+  @staticmethod
+  def _coefficients(control_points, segments):
+    """Cubic coefficients of each knot interval in powers of (u - knots[i])"""
+    c0, c1, c2, c3 = (control_points[i:i + segments] for i in range(4))
+    h = 1.0 / segments
+    return np.stack(((c0 + 4 * c1 + c2) / 6, (c2 - c0) / (2 * h), (c0 - 2 * c1 + c2) / (2 * h**2),
+      (c3 - 3 * c2 + 3 * c1 - c0) / (6 * h**3)), axis=1)
+
+
+def fit_curve(points, tolerance=None, outlier_distance=None):
+  """
+  Curve through ordered control points: the interpolating SplineCurve, or a
+  SmoothingSplineCurve within tolerance millimeters of them (rejecting points
+  farther than outlier_distance) if either is given.
+  """
+  if tolerance or outlier_distance:
+    return SmoothingSplineCurve(points, tolerance=tolerance, outlier_distance=outlier_distance)
+  return SplineCurve(points)
+
+
+def constrain_length(curve, target_length, samples=1000):
+  """
+  Points evenly spaced along a bar of exactly target_length, centered on the
+  middle of the curve: the curve is trimmed equally at both ends, or extended
+  equally along its end tangents.
+  """
+  table = curve.arc_length_table
+  length = table.length
+  start = (length - target_length) / 2
+  s = np.linspace(start, start + target_length, samples)
+  points = curve.evaluate(table.parameter_at(s))
+  if target_length > length:
+    before, after = s < 0, s > length
+    first_tangent = curve.derivative(0.0)
+    last_tangent = curve.derivative(1.0)
+    first_tangent /= np.linalg.norm(first_tangent)
+    last_tangent /= np.linalg.norm(last_tangent)
+    points[before] = curve.evaluate(0.0) + s[before, None] * first_tangent
+    points[after] = curve.evaluate(1.0) + (s[after] - length)[:, None] * last_tangent
+  return points
+
+
+class BarPlan:
+  """Result of planning one bar from a set of fiducials"""
+
+  def __init__(self, control_points, curve, curve_points, bar_points, vertices, faces):
+    self.control_points = control_points
+    self.curve = curve
+    self.curve_points = curve_points
+    self.bar_points = bar_points
+    self.vertices = vertices
+    self.faces = faces
+
+  @property
+  def markup_length(self):
+    """Arc length of the curve through the fiducials, in millimeters"""
+    return self.curve.length()
+
+  @property
+  def bar_length(self):
+    """Length of the generated bar, in millimeters"""
+    return polyline_length(self.bar_points)
+
+  def summary(self):
+    """JSON-serializable description of the plan"""
+    return {
+      'numberOfFiducials': int(len(self.control_points)),
+      'markupBarLengthMm': round(self.markup_length, 4),
+      'markupBarLengthIn': round(mm_to_in(self.markup_length), 4),
+      'generatedBarLengthMm': round(self.bar_length, 4),
+      'generatedBarLengthIn': round(mm_to_in(self.bar_length), 4),
+      'numberOfVertices': int(len(self.vertices)),
+      'numberOfFaces': int(len(self.faces)),
+      'controlPoints': self.control_points.tolist(),
+      'curvePoints': self.curve_points.tolist(),
+    }
+
+
+def plan_bar(fiducials, resolution=50, samples=1000, profile='rectangular', frame='parallel', bar_length=None,
+    fit_tolerance=None, outlier_distance=None):
+  """
+  Compute the bar curve, its arc length and the bar mesh from raw fiducial
+  positions (RAS, millimeters). If bar_length (millimeters) is given, the bar is
+  trimmed or extended to exactly that length. The mesh is swept along samples
+  points of the bar. With fit_tolerance or outlier_distance (millimeters), the
+  curve is a smoothing spline instead of passing through every fiducial.
+  """
+  fiducials = as_points(fiducials)
+  if len(fiducials) < 2:
+    raise ValueError('Add at least two fiducials')
+  control_points = order_fiducials(fiducials)
+  curve = fit_curve(control_points, fit_tolerance, outlier_distance)
+  if bar_length:
+    bar_points = constrain_length(curve, bar_length, samples)
+  else:
+    bar_points = curve.sample_by_length(samples)
+  vertices, faces = sweep.sweep_profile(bar_points, sweep.make_profile(profile), frame=frame)
+  return BarPlan(control_points, curve, curve.sample(resolution), bar_points, vertices, faces)
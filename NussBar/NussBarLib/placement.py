@@ -0,0 +1,209 @@
+"""
+Automatic bar placement from a thresholded and smoothed chest volume.
+
+The anterior and posterior chest-wall contours of every axial slice are found at
+once from the binary mask. In each slice the sternal depression is the most
+posterior point of the anterior contour between the two anterior peaks of the
+chest wall, and the Haller index is the transverse diameter divided by the
+anteroposterior distance at that point. The slice with the largest Haller index
+is the level of the bar, and the proposed fiducials follow its anterior
+contour from one side of the chest to the other, bridging the depression.
+
+Masks use Slicer's (k, j, i) axis order and ijk_to_ras is the 4x4 IJK-to-RAS
+matrix of the volume, which must be acquired axially (in any axis order or
+direction).
+"""
+import numpy as np
+
+from NussBarLib import geometry, segmentation
+
+
+class Placement:
+  """Proposed bar level, fiducials and the measurements they come from (millimeters, RAS)"""
+
+  def __init__(self, slice_index, haller_indices, haller_index, depression_depth, transverse_diameter,
+      anteroposterior_distance, depression_point, fiducials):
+    self.slice_index = slice_index
+    # Haller index of every axial slice, NaN where it is not defined
+    self.haller_indices = haller_indices
+    self.haller_index = haller_index
+    self.depression_depth = depression_depth
+    self.transverse_diameter = transverse_diameter
+    self.anteroposterior_distance = anteroposterior_distance
+    self.depression_point = depression_point
+    self.fiducials = fiducials
+    self.curve = geometry.SplineCurve(fiducials)
+
+  def summary(self):
+    """JSON-serializable measurements of the placement"""
+    return {
+      'sliceIndex': int(self.slice_index),
+      'superiorMm': round(float(self.depression_point[2]), 4),
+      'hallerIndex': round(float(self.haller_index), 4),
+      'depressionDepthMm': round(float(self.depression_depth), 4),
+      'transverseDiameterMm': round(float(self.transverse_diameter), 4),
+      'anteroposteriorDistanceMm': round(float(self.anteroposterior_distance), 4),
+      'depressionPoint': np.round(self.depression_point, 4).tolist(),
+      'fiducials': np.round(self.fiducials, 4).tolist(),
+      'curveLengthIn': round(geometry.mm_to_in(self.curve.length()), 4),
+    }
+
+
+def axial_view(mask, ijk_to_ras):
+  """
+  View of mask with axes (superior, anterior, right), each index increasing in
+  that direction, and the 4x4 matrix from (s, a, r) view indices to RAS.
+  Raises ValueError if the volume axes are not aligned with the RAS axes.
+  """
+  ijk_to_ras = np.asarray(ijk_to_ras, dtype=float)
+  # RAS direction of each array axis (k, j, i)
+  directions = ijk_to_ras[:3, 2::-1] / segmentation.voxel_spacing(ijk_to_ras)
+  axes = [int(np.argmax(np.abs(directions[ras]))) for ras in (2, 1, 0)]
+  if sorted(axes) != [0, 1, 2] or min(abs(directions[ras, axis]) for ras, axis in zip((2, 1, 0), axes)) < 0.9:
+    raise ValueError('The volume is not acquired axially')
+
+  view = np.transpose(mask, axes)
+  view_to_array = np.zeros((4, 4))
+  view_to_array[3, 3] = 1.0
+  flips = []
+  for view_axis, (ras, axis) in enumerate(zip((2, 1, 0), axes)):
+    if directions[ras, axis] < 0:
+      flips.append(view_axis)
+      view_to_array[axis, view_axis] = -1.0
+      view_to_array[axis, 3] = mask.shape[axis] - 1
+    else:
+      view_to_array[axis, view_axis] = 1.0
+  view = np.flip(view, flips) if flips else view
+  # Array indices (k, j, i) to homogeneous IJK
+  array_to_ijk = np.zeros((4, 4))
+  array_to_ijk[[2, 1, 0, 3], [0, 1, 2, 3]] = 1.0
+  return view, ijk_to_ras @ array_to_ijk @ view_to_array
+
+
+def chest_contours(view):
+  """
+  Anterior and posterior contour of every axial slice of an (s, a, r) mask
+  view, as (slices, columns) arrays of anterior indices, -1 where a column is
+  empty. Every slice is processed at once.
+  """
+  filled = view.any(axis=1)
+  front = np.where(filled, view.shape[1] - 1 - np.argmax(view[:, ::-1, :], axis=1), -1)
+  back = np.where(filled, np.argmax(view, axis=1), -1)
+  return front, back
+
+
+def depressions(front):
+  """
+  Sternal depression of every slice from its anterior contour: the columns of
+  the left and right anterior peaks and the most posterior column between them.
+  Returns (left peak, deepest, right peak) column arrays and the depth of the
+  depression in voxels below the lower peak, 0 where there is no depression.
+  """
+  slices, columns = front.shape
+  column = np.arange(columns)
+  filled = front >= 0
+  left_edge = np.where(filled.any(axis=1), np.argmax(filled, axis=1), 0)
+  right_edge = np.where(filled.any(axis=1), columns - 1 - np.argmax(filled[:, ::-1], axis=1), 0)
+  middle = (left_edge + right_edge) / 2
+
+  contour = np.where(filled, front, -1).astype(float)
+  left_peak = np.argmax(np.where(column < middle[:, None], contour, -np.inf), axis=1)
+  right_peak = np.argmax(np.where(column >= middle[:, None], contour, -np.inf), axis=1)
+  between = filled & (column >= left_peak[:, None]) & (column <= right_peak[:, None])
+  lowest = np.where(between, contour, np.inf)
+  # Middle of the deepest columns, which are often several at voxel resolution
+  deepest_columns = lowest == lowest.min(axis=1, keepdims=True)
+  deepest = np.rint((deepest_columns * column).sum(axis=1) / np.maximum(deepest_columns.sum(axis=1), 1)).astype(int)
+
+  rows = np.arange(slices)
+  lower_peak = np.minimum(contour[rows, left_peak], contour[rows, right_peak])
+  depth = np.clip(lower_peak - contour[rows, deepest], 0, None)
+  return left_peak, deepest, right_peak, depth
+
+
+def anteroposterior_distances(view, front, back, deepest):
+  """
+  Anteroposterior distance (voxels) at the deepest column of every slice. In a
+  bone mask it runs from the posterior surface of the sternum to the anterior
+  surface of the spine; in a filled body mask, from the front to the back.
+  """
+  slices, depth, _ = view.shape
+  rows = np.arange(slices)
+  column = view[rows[:, None], np.arange(depth)[None, :], deepest[:, None]]
+  anterior = np.arange(depth)[None, :]
+  start = front[rows, deepest][:, None]
+  # First empty voxel behind the front and the first filled voxel behind that
+  gap = np.where(~column & (anterior < start), anterior, -1).max(axis=1)
+  spine = np.where(column & (anterior < gap[:, None]), anterior, -1).max(axis=1)
+  inner = gap - spine
+  outer = front[rows, deepest] - back[rows, deepest] + 1
+  return np.where((gap >= 0) & (spine >= 0), inner, outer)
+
+
+def upper_hull(x, y):
+  """Upper convex hull of points (x, y) evaluated at x, sorted by x"""
+  order = np.argsort(x, kind='stable')
+  x, y = x[order], y[order]
+  keep = []
+  for i in range(len(x)):
+    while len(keep) >= 2:
+      a, b = keep[-2], keep[-1]
+      if (x[b] - x[a]) * (y[i] - y[a]) - (y[b] - y[a]) * (x[i] - x[a]) >= 0:
+        keep.pop()
+      else:
+        break
+    keep.append(i)
+  return x, np.interp(x, x[keep], y[keep])
+
+
+def place_bar(mask, ijk_to_ras, count=9, bridge=True, min_width_fraction=0.8):
+  """
+  Propose the bar level and count fiducials from a binary chest mask (skin or
+  bone). Only slices at least min_width_fraction as wide as the widest slice
+  are considered, which excludes the neck and abdomen. With bridge, the
+  fiducials follow the upper convex hull of the anterior contour, i.e. the
+  chest wall with the depression corrected; otherwise the contour itself.
+  The fiducials span the chest between the points where the anterior contour
+  meets the mid-coronal plane of the slice.
+  """
+  view, view_to_ras = axial_view(np.asarray(mask) != 0, ijk_to_ras)
+  spacing = np.linalg.norm(view_to_ras[:3, :3], axis=0)
+
+  front, back = chest_contours(view)
+  filled = front >= 0
+  if not filled.any():
+    raise ValueError('The mask is empty')
+  widths = np.where(filled.any(axis=1),
+    view.shape[2] - np.argmax(filled[:, ::-1], axis=1) - np.argmax(filled, axis=1), 0) * spacing[2]
+  left_peak, deepest, right_peak, depth = depressions(front)
+  distances = anteroposterior_distances(view, front, back, deepest) * spacing[1]
+
+  valid = (widths >= min_width_fraction * widths.max()) & (depth > 0) & (distances > 0)
+  if not valid.any():
+    raise ValueError('No sternal depression found')
+  haller = np.full(len(widths), np.nan)
+  haller[valid] = widths[valid] / distances[valid]
+  # Middle of the slices with the largest index
+  levels = np.flatnonzero(haller >= np.nanmax(haller) - 1e-9)
+  level = int(levels[len(levels) // 2])
+
+  # Anterior contour of the chosen slice, between the crossings of the mid-coronal plane
+  columns = np.flatnonzero(filled[level])
+  contour = front[level, columns].astype(float)
+  middle = (contour.max() + back[level, columns].min()) / 2
+  anterior = columns[contour >= middle]
+  span = (columns >= anterior.min()) & (columns <= anterior.max())
+  x, y = columns[span].astype(float), contour[span]
+  if bridge:
+    x, y = upper_hull(x, y)
+  r = np.linspace(x[0], x[-1], count)
+  a = np.interp(r, x, y)
+
+  def to_ras(s, a, r):
+    view_points = np.stack((np.broadcast_to(s, np.shape(r)), a, r, np.ones(np.shape(r))), axis=-1)
+    return (view_points @ view_to_ras.T)[..., :3]
+
+  fiducials = to_ras(float(level), a, r)
+  depression_point = to_ras(float(level), float(front[level, deepest[level]]), float(deepest[level]))
+  return Placement(level, haller, haller[level], depth[level] * spacing[1], widths[level], distances[level],
+    depression_point, fiducials)
@@ -0,0 +1,146 @@
+"""
+Comparison of several candidate bars, for example one per intercostal level or
+two bars for the same patient.
+
+Each candidate is fitted from its own fiducials. Sampling, surface snapping,
+clearance, curvature and mesh generation then run on all candidates at once
+as (candidates, samples, 3) arrays, and the candidates are ranked.
+"""
+import numpy as np
+
+from NussBarLib import geometry, sweep
+
+
+class Candidate:
+  """One planned bar and its comparison metrics (millimeters)"""
+
+  def __init__(self, name, control_points, curve, bar_points, vertices, faces, min_bend_radius,
+      min_clearance=None, mean_clearance=None, too_close=False, penetrates=False):
+    self.name = name
+    self.control_points = control_points
+    self.curve = curve
+    self.bar_points = bar_points
+    self.vertices = vertices
+    self.faces = faces
+    self.min_bend_radius = min_bend_radius
+    self.min_clearance = min_clearance
+    self.mean_clearance = mean_clearance
+    self.too_close = too_close
+    self.penetrates = penetrates
+    self.rank = None
+
+  @property
+  def curve_length(self):
+    return self.curve.length()
+
+  @property
+  def bar_length(self):
+    return geometry.polyline_length(self.bar_points)
+
+  def summary(self):
+    """JSON-serializable metrics of the candidate"""
+    def rounded(value):
+      return None if value is None else round(float(value), 4)
+    return {
+      'rank': self.rank,
+      'name': self.name,
+      'curveLengthIn': rounded(geometry.mm_to_in(self.curve_length)),
+      'barLengthIn': rounded(geometry.mm_to_in(self.bar_length)),
+      'minBendRadiusMm': rounded(self.min_bend_radius),
+      'minClearanceMm': rounded(self.min_clearance),
+      'meanClearanceMm': rounded(self.mean_clearance),
+      'tooClose': bool(self.too_close),
+      'penetrates': bool(self.penetrates),
+    }
+
+
+def levels(points, count, spacing, axis=(0.0, 0.0, 1.0)):
+  """
+  count copies of points shifted along axis (default: superior), spacing
+  millimeters apart and centered on the original level.
+  Returns a list of (offset, points).
+  """
+  points = geometry.as_points(points)
+  axis = np.asarray(axis, dtype=float)
+  axis = axis / np.linalg.norm(axis)
+  offsets = (np.arange(count) - (count - 1) / 2) * spacing
+  return [(offset, points + offset * axis) for offset in offsets]
+
+
+def bend_radii(points, window=10.0):
+  """
+  Radius of the circle through each sample of evenly spaced (..., samples, 3)
+  centerlines and the samples about window millimeters before and after it.
+  Measuring over a window ignores the facets of curves snapped to a surface.
+  Each centerline has its own spacing, so the first and last samples of
+  short ones, which have no neighbors that far away, get an infinite radius.
+  """
+  points = np.asarray(points, dtype=float)
+  samples = points.shape[-2]
+  curves = points.reshape(-1, samples, 3)
+  radii = np.full(curves.shape[:2], np.inf)
+  for curve, curve_radii in zip(curves, radii):
+    step = np.linalg.norm(curve[1] - curve[0])
+    k = int(np.clip(round(window / max(step, 1e-12)), 1, max((samples - 1) // 2, 1)))
+    before, middle, after = curve[:-2 * k], curve[k:-k], curve[2 * k:]
+    a = np.linalg.norm(middle - before, axis=-1)
+    b = np.linalg.norm(after - middle, axis=-1)
+    c = np.linalg.norm(after - before, axis=-1)
+    double_area = np.linalg.norm(np.cross(middle - before, after - before), axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      curve_radii[k:samples - k] = np.where(double_area > 0, a * b * c / (2 * double_area), np.inf)
+  return radii.reshape(points.shape[:-1])
+
+
+def plan_candidates(point_sets, names=None, samples=1000, bar_length=None, profile='rectangular', frame='parallel',
+    locator=None, snap=False, clearance=0.0, snap_samples=500, tolerance=0.25, fit_tolerance=None,
+    outlier_distance=None):
+  """
+  Plan one bar per fiducial set and rank them. With a surface locator, the
+  free side of the surface is the side most fiducials are on, and the signed
+  clearance between each bar centerline and the surface, negative where it
+  passes through, is measured on that side. If snap is set, the curves are
+  first projected onto the surface clearance millimeters away on the free
+  side. Candidates that pass through the surface (by more than tolerance, for
+  the facets of the surface) rank last, then those closer to it than
+  clearance less tolerance; the others are ranked by their smallest bend
+  radius, gentlest first. fit_tolerance and outlier_distance select a
+  smoothing spline fit as in geometry.fit_curve.
+  Returns the candidates in rank order.
+  """
+  names = list(names) if names is not None else ['Candidate %d' % (i + 1) for i in range(len(point_sets))]
+  control_points = [geometry.order_fiducials(points) for points in point_sets]
+  curves = [geometry.fit_curve(points, fit_tolerance, outlier_distance) for points in control_points]
+
+  side = locator.side_of(np.concatenate(control_points)) if locator is not None else 0
+  if snap and locator is not None:
+    # Project the samples of all curves in one query, all on the free side
+    samples_per_curve = np.stack([curve.sample(snap_samples) for curve in curves])
+    projected = locator.project(samples_per_curve.reshape(-1, 3), clearance, side)
+    curves = [geometry.PolylineCurve(points) for points in projected.reshape(samples_per_curve.shape)]
+
+  if bar_length:
+    bar_points = np.stack([geometry.constrain_length(curve, bar_length, samples) for curve in curves])
+  else:
+    bar_points = np.stack([curve.sample_by_length(samples) for curve in curves])
+
+  radii = bend_radii(bar_points).min(axis=1)
+  distances = None
+  if locator is not None:
+    distances = side * locator.signed_distances(bar_points.reshape(-1, 3))[2].reshape(bar_points.shape[:2])
+  vertices, faces = sweep.sweep_profile(bar_points, sweep.make_profile(profile), frame=frame)
+
+  candidates = []
+  for i, name in enumerate(names):
+    candidate = Candidate(name, control_points[i], curves[i], bar_points[i], vertices[i], faces, radii[i])
+    if distances is not None:
+      candidate.min_clearance = distances[i].min()
+      candidate.mean_clearance = distances[i].mean()
+      candidate.too_close = candidate.min_clearance < clearance - tolerance
+      candidate.penetrates = candidate.min_clearance < -tolerance
+    candidates.append(candidate)
+
+  candidates.sort(key=lambda c: (c.penetrates, c.too_close, -c.min_bend_radius))
+  for rank, candidate in enumerate(candidates):
+    candidate.rank = rank + 1
+  return candidates
@@ -0,0 +1,189 @@
+"""
+Plan files: a planned bar saved with everything needed to restore it.
+
+A plan is a JSON manifest (<name>.plan.json) next to an uncompressed NumPy
+archive (<name>.plan.npz). The archive holds the arrays: the fiducials, the
+ordered control points, the knots and coefficients of the fitted curve, its
+arc length table, the bar centerline and the bar mesh. The manifest holds the
+planning parameters, a reference to the skin surface and a checksum of every
+array. Loading reads the arrays back as they were computed, so the curve is
+neither fitted nor integrated again, and a damaged archive is detected.
+"""
+import concurrent.futures
+import datetime
+import json
+import os
+import zipfile
+
+import numpy as np
+
+from NussBarLib import cache, geometry
+
+FORMAT = 'NussBarPlan'
+VERSION = 1
+
+MANIFEST_EXTENSION = '.plan.json'
+ARCHIVE_EXTENSION = '.plan.npz'
+
+# Errors of plan files that cannot be read
+PLAN_ERRORS = (OSError, ValueError, KeyError, zipfile.BadZipFile)
+
+
+class Plan:
+  """A planned bar and the state it was planned from (RAS, millimeters)"""
+
+  def __init__(self, name, fiducials, control_points, curve, bar_points, vertices, faces, parameters=None,
+      surface=None, created=None):
+    self.name = name
+    self.fiducials = fiducials
+    self.control_points = control_points
+    self.curve = curve
+    self.bar_points = bar_points
+    self.vertices = vertices
+    self.faces = faces
+    # Settings the bar was planned with, by the keyword names of the planning code
+    self.parameters = dict(parameters or {})
+    # Skin surface reference, see surface_reference()
+    self.surface = surface
+    self.created = created
+
+  @property
+  def markup_length(self):
+    """Arc length of the curve through the fiducials, in millimeters"""
+    return self.curve.length()
+
+  @property
+  def bar_length(self):
+    """Length of the bar centerline, in millimeters"""
+    return geometry.polyline_length(self.bar_points)
+
+  def summary(self):
+    """JSON-serializable description of the plan"""
+    return {
+      'name': self.name,
+      'created': self.created,
+      'numberOfFiducials': int(len(self.fiducials)),
+      'markupBarLengthIn': round(geometry.mm_to_in(self.markup_length), 4),
+      'generatedBarLengthIn': round(geometry.mm_to_in(self.bar_length), 4),
+      'numberOfVertices': int(len(self.vertices)),
+      'numberOfFaces': int(len(self.faces)),
+      'surface': None if self.surface is None else self.surface.get('name'),
+    }
+
+
+def surface_reference(vertices, name=None, path=None):
+  """
+  Reference to a skin surface: its name, the file it was loaded from, and
+  the number and digest of its points to recognize it when a plan is loaded.
+  """
+  vertices = np.asarray(vertices, dtype=float)
+  return {'name': name, 'path': os.path.abspath(path) if path else None, 'numberOfPoints': int(len(vertices)),
+    'digest': cache.array_digest(vertices)}
+
+
+def plan_paths(path):
+  """Manifest and archive paths of the plan at path (either file, or the name without extension)"""
+  for extension in (MANIFEST_EXTENSION, ARCHIVE_EXTENSION):
+    if path.endswith(extension):
+      path = path[:-len(extension)]
+      break
+  return path + MANIFEST_EXTENSION, path + ARCHIVE_EXTENSION
+
+
+def _arrays(plan):
+  table = plan.curve.arc_length_table
+  arrays = {
+    'fiducials': plan.fiducials,
+    'control_points': plan.control_points,
+    'knots': plan.curve.knots,
+    'coefficients': plan.curve.coefficients,
+    'bar_points': plan.bar_points,
+    'vertices': plan.vertices,
+    'faces': plan.faces,
+  }
+  for key in geometry.ArcLengthTable.ARRAYS:
+    arrays['arc_' + key] = getattr(table, key)
+  return {key: np.ascontiguousarray(value) for key, value in arrays.items()}
+
+
+def save_plan(path, plan):
+  """
+  Write plan to the manifest and archive of path (see plan_paths).
+  Returns the manifest path.
+  """
+  manifest_path, archive_path = plan_paths(path)
+  arrays = _arrays(plan)
+  if plan.created is None:
+    plan.created = datetime.datetime.now().isoformat(timespec='seconds')
+  manifest = {
+    'format': FORMAT,
+    'version': VERSION,
+    'name': plan.name,
+    'created': plan.created,
+    'archive': os.path.basename(archive_path),
+    'curveType': type(plan.curve).__name__,
+    'parameters': plan.parameters,
+    'surface': plan.surface,
+    'checksums': {key: cache.array_digest(value) for key, value in arrays.items()},
+    'summary': plan.summary(),
+  }
+  # Uncompressed, so that loading is a plain read of each array
+  with open(archive_path, 'wb') as f:
+    np.savez(f, **arrays)
+  with open(manifest_path, 'w') as f:
+    json.dump(manifest, f, indent=2)
+  return manifest_path
+
+
+def load_plan(path, verify=True):
+  """
+  Read the plan at path (see plan_paths). With verify, the checksum of every
+  array is checked. Raises ValueError if the files are not a plan of this
+  version or do not match their checksums.
+  """
+  manifest_path, _ = plan_paths(path)
+  with open(manifest_path, 'r') as f:
+    manifest = json.load(f)
+  if manifest.get('format') != FORMAT:
+    raise ValueError(manifest_path + ' is not a Nuss bar plan')
+  if manifest.get('version') != VERSION:
+    raise ValueError('Unsupported plan version %s in %s' % (manifest.get('version'), manifest_path))
+  archive_path = os.path.join(os.path.dirname(manifest_path), manifest['archive'])
+  with np.load(archive_path, allow_pickle=False) as archive:
+    arrays = {key: archive[key] for key in archive.files}
+
+  checksums = manifest['checksums']
+  missing = sorted(set(checksums) - set(arrays))
+  if missing:
+    raise ValueError('%s lacks the arrays %s' % (archive_path, ', '.join(missing)))
+  if verify:
+    changed = [key for key, digest in checksums.items() if cache.array_digest(arrays[key]) != digest]
+    if changed:
+      raise ValueError('Checksum mismatch in %s: %s' % (archive_path, ', '.join(sorted(changed))))
+
+  curve = geometry.StoredCurve(arrays['knots'], arrays['coefficients'],
+    {key: arrays['arc_' + key] for key in geometry.ArcLengthTable.ARRAYS})
+  return Plan(manifest['name'], arrays['fiducials'], arrays['control_points'], curve, arrays['bar_points'],
+    arrays['vertices'], arrays['faces'], manifest['parameters'], manifest['surface'], manifest['created'])
+
+
+def load_plans(paths, verify=True, workers=None):
+  """
+  Read many plans at once on a thread pool, for example for a review session.
+  Returns the plans that were read, in the order of paths, and (path, error
+  message) for the others.
+  """
+  plans, errors = [], []
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+    futures = [executor.submit(load_plan, path, verify) for path in paths]
+    for path, future in zip(paths, futures):
+      try:
+        plans.append(future.result())
+      except PLAN_ERRORS as e:
+        errors.append((path, str(e)))
+  return plans, errors
+
+
+def find_plans(directory):
+  """Sorted manifest paths of the plans in directory"""
+  return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(MANIFEST_EXTENSION))
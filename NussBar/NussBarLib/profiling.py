@@ -0,0 +1,119 @@
+"""
+Lightweight instrumentation of the planning stages.
+
+Stages are wrapped in Profiler.span() context managers, which record wall time,
+CPU time of the calling thread and the change in resident memory. Spans can be
+summarized per stage or exported in the Chrome trace event format, which can be
+opened in chrome://tracing or https://ui.perfetto.dev.
+"""
+import collections
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+
+def current_rss_bytes():
+  """Resident set size of this process, or None if it cannot be read"""
+  try:
+    import psutil
+    return psutil.Process().memory_info().rss
+  except ImportError:
+    pass
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except (OSError, ValueError, AttributeError):
+    return None
+
+
+class Span:
+  """One timed stage"""
+
+  def __init__(self, name, category, start, thread):
+    self.name = name
+    self.category = category
+    self.start = start
+    self.thread = thread
+    self.wall = 0.0
+    self.cpu = 0.0
+    self.rss_delta = None
+
+
+class Profiler:
+  """Thread-safe collection of the most recent max_spans spans"""
+
+  def __init__(self, max_spans=100000):
+    self.spans = collections.deque(maxlen=max_spans)
+    self._origin = time.perf_counter()
+    self._lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def span(self, name, category=''):
+    """Record the enclosed block as a span, also when it raises"""
+    rss = current_rss_bytes()
+    cpu = time.thread_time()
+    start = time.perf_counter()
+    record = Span(name, category, start - self._origin, threading.get_ident())
+    try:
+      yield record
+    finally:
+      record.wall = time.perf_counter() - start
+      record.cpu = time.thread_time() - cpu
+      if rss is not None:
+        record.rss_delta = current_rss_bytes() - rss
+      with self._lock:
+        self.spans.append(record)
+
+  def traced(self, function, name=None, category=''):
+    """function wrapped in a span, e.g. to run it in a worker thread"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      with self.span(name or function.__name__, category):
+        return function(*args, **kwargs)
+    return wrapper
+
+  def clear(self):
+    with self._lock:
+      self.spans.clear()
+
+  def breakdown(self):
+    """
+    Totals per (category, name) in order of first appearance, as dicts with
+    category, name, calls, wall, cpu and rssDelta (bytes, None if unknown)
+    """
+    with self._lock:
+      spans = sorted(self.spans, key=lambda s: s.start)
+    rows = {}
+    for s in spans:
+      row = rows.setdefault((s.category, s.name),
+        {'category': s.category, 'name': s.name, 'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'rssDelta': None})
+      row['calls'] += 1
+      row['wall'] += s.wall
+      row['cpu'] += s.cpu
+      if s.rss_delta is not None:
+        row['rssDelta'] = (row['rssDelta'] or 0) + s.rss_delta
+    return list(rows.values())
+
+  def chrome_trace(self):
+    """Spans as a Chrome trace event dict (complete events, microseconds)"""
+    pid = os.getpid()
+    with self._lock:
+      spans = list(self.spans)
+    events = [{
+      'name': s.name,
+      'cat': s.category,
+      'ph': 'X',
+      'ts': round(s.start * 1e6, 3),
+      'dur': round(s.wall * 1e6, 3),
+      'pid': pid,
+      'tid': s.thread,
+      'args': {'cpuMs': round(s.cpu * 1e3, 3), 'rssDeltaBytes': s.rss_delta},
+    } for s in spans]
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+  def write_chrome_trace(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.chrome_trace(), f)
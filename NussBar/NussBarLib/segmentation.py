@@ -0,0 +1,313 @@
+"""
+Skin segmentation on NumPy voxel arrays: threshold, median smoothing and
+closed surface extraction. These are the same stages as the Segment Editor
+pipeline in NussBarLogic.mesh, but they can run outside the GUI thread.
+stream_skin_surface runs them slab by slab on a volume read from disk, and
+parallel_skin_surface in blocks on a thread pool.
+
+Voxel arrays use Slicer's (k, j, i) axis order and ijk_to_ras is the 4x4
+IJK-to-RAS matrix of the volume.
+"""
+import os
+
+import numpy as np
+
+
+def _report(progress, fraction, message):
+  if progress is not None:
+    progress(fraction, message)
+
+
+def voxel_spacing(ijk_to_ras):
+  """Spacing along the array axes (k, j, i)"""
+  return np.linalg.norm(np.asarray(ijk_to_ras, dtype=float)[:3, :3], axis=0)[::-1]
+
+
+def median_kernel_size(kernel_size_mm, spacing):
+  """Odd kernel size in voxels per axis, as computed by the Segment Editor smoothing effect"""
+  return tuple(int(round((kernel_size_mm / s + 1) / 2)) * 2 - 1 for s in spacing)
+
+
+def threshold(voxels, minimum, maximum):
+  """Binary mask of voxels within [minimum, maximum]"""
+  return (voxels >= minimum) & (voxels <= maximum)
+
+
+def smooth_median(mask, kernel_size, progress=None):
+  """
+  Median filter of a binary mask with a box kernel. The median of 0/1 values
+  over an odd-sized box is a majority vote, so it is computed from separable
+  box averages instead of sorting each neighborhood.
+  """
+  from scipy import ndimage
+
+  average = mask.astype(np.float32)
+  for axis, size in enumerate(kernel_size):
+    if size > 1:
+      ndimage.uniform_filter1d(average, size, axis=axis, output=average, mode='nearest')
+    _report(progress, (axis + 1) / len(kernel_size), 'Smoothing')
+  return average > 0.5
+
+
+def compute_normals(surface):
+  """Copy of a closed surface with point normals oriented outwards"""
+  import vtk
+
+  normals = vtk.vtkPolyDataNormals()
+  normals.AutoOrientNormalsOn()
+  normals.ConsistencyOn()
+  normals.SetInputData(surface)
+  normals.Update()
+  return normals.GetOutput()
+
+
+def label_surface(mask, first_slice=0, pad=((1, 1), (1, 1), (1, 1))):
+  """
+  Surface of a binary mask in IJK coordinates by discrete flying edges, with
+  mask[0] the axial slice first_slice of the volume. pad gives the voxels of
+  padding (before, after) along each axis (k, j, i), which close the surface
+  where the mask touches the border of the volume.
+  """
+  import vtk
+  from vtk.util import numpy_support
+
+  padded = np.ascontiguousarray(np.pad(mask, pad).astype(np.uint8))
+  image = vtk.vtkImageData()
+  image.SetDimensions(padded.shape[::-1])
+  image.SetOrigin(-pad[2][0], -pad[1][0], first_slice - pad[0][0])
+  scalars = numpy_support.numpy_to_vtk(padded.ravel(), deep=False, array_type=vtk.VTK_UNSIGNED_CHAR)
+  image.GetPointData().SetScalars(scalars)
+
+  flying_edges = vtk.vtkDiscreteFlyingEdges3D()
+  flying_edges.SetInputData(image)
+  flying_edges.SetValue(0, 1)
+  flying_edges.ComputeGradientsOff()
+  flying_edges.ComputeNormalsOff()
+  flying_edges.ComputeScalarsOff()
+  flying_edges.Update()
+  return flying_edges.GetOutput()
+
+
+def finish_surface(surface, ijk_to_ras, smoothing_factor=0.5, progress=None, normals=True):
+  """
+  Windowed sinc smoothing of an IJK label surface, transformed to RAS, with
+  normals oriented outwards unless normals is False.
+  """
+  import vtk
+
+  if smoothing_factor > 0:
+    _report(progress, 0.0, 'Smoothing surface')
+    smoother = vtk.vtkWindowedSincPolyDataFilter()
+    smoother.SetInputData(surface)
+    smoother.SetNumberOfIterations(20)
+    smoother.SetPassBand(pow(10.0, -4.0 * smoothing_factor))
+    smoother.BoundarySmoothingOff()
+    smoother.FeatureEdgeSmoothingOff()
+    smoother.NonManifoldSmoothingOn()
+    smoother.NormalizeCoordinatesOn()
+    smoother.Update()
+    surface = smoother.GetOutput()
+
+  _report(progress, 0.5, 'Transforming to RAS')
+  matrix = vtk.vtkMatrix4x4()
+  for row in range(4):
+    for column in range(4):
+      matrix.SetElement(row, column, float(ijk_to_ras[row][column]))
+  transform = vtk.vtkTransform()
+  transform.SetMatrix(matrix)
+  transformer = vtk.vtkTransformPolyDataFilter()
+  transformer.SetInputData(surface)
+  transformer.SetTransform(transform)
+  transformer.Update()
+  if not normals:
+    return transformer.GetOutput()
+
+  _report(progress, 0.65, 'Computing normals')
+  return compute_normals(transformer.GetOutput())
+
+
+def extract_surface(mask, ijk_to_ras, smoothing_factor=0.5, progress=None, normals=True):
+  """
+  Closed surface (vtkPolyData, RAS) of a binary mask, built like Slicer's
+  binary labelmap to closed surface conversion: discrete flying edges followed
+  by windowed sinc smoothing. Unless normals is False, surface normals are
+  computed and oriented outwards.
+  """
+  _report(progress, 0.0, 'Extracting surface')
+  surface = label_surface(mask)
+  return finish_surface(surface, ijk_to_ras, smoothing_factor, _stage(progress, 0.4, 1.0), normals)
+
+
+def _stage(progress, start, end):
+  """Progress callback mapping a stage's 0..1 progress into [start, end]"""
+  if progress is None:
+    return None
+  return lambda fraction, message: progress(start + (end - start) * fraction, message)
+
+
+def extract_skin_surface(voxels, ijk_to_ras, minimum=100, maximum=5000, kernel_size_mm=10,
+    progress=None):
+  """
+  Threshold, median-smooth and extract the closed surface of voxels.
+  Returns (surface, smoothed mask).
+  """
+  _report(progress, 0.0, 'Thresholding')
+  mask = threshold(voxels, minimum, maximum)
+  _report(progress, 0.1, 'Smoothing')
+  if kernel_size_mm:
+    kernel_size = median_kernel_size(kernel_size_mm, voxel_spacing(ijk_to_ras))
+    mask = smooth_median(mask, kernel_size, _stage(progress, 0.1, 0.5))
+  surface = extract_surface(mask, ijk_to_ras, progress=_stage(progress, 0.5, 1.0))
+  return surface, mask
+
+
+def preview_surface(voxels, ijk_to_ras, minimum=100, maximum=5000, kernel_size_mm=10, max_voxels=1 << 20):
+  """
+  Coarse skin surface for adjusting the thresholds interactively: voxels are
+  subsampled with the same stride along every axis to at most max_voxels, then
+  thresholded, smoothed and meshed as in extract_skin_surface, without normals.
+  """
+  stride = max(1, int(np.ceil((np.asarray(voxels).size / max_voxels) ** (1.0 / 3.0))))
+  coarse = np.ascontiguousarray(voxels[::stride, ::stride, ::stride])
+  coarse_to_ras = np.array(ijk_to_ras, dtype=float)
+  coarse_to_ras[:3, :3] *= stride
+  mask = threshold(coarse, minimum, maximum)
+  if kernel_size_mm:
+    mask = smooth_median(mask, median_kernel_size(kernel_size_mm, voxel_spacing(coarse_to_ras)))
+  return extract_surface(mask, coarse_to_ras, normals=False)
+
+
+def _slab_pad(start, stop, slices):
+  """Padding of the label map of slices start to stop: only the ends of the volume are padded along k"""
+  return ((int(start == 0), int(stop == slices)), (1, 1), (1, 1))
+
+
+def merge_slab_surfaces(surfaces, ijk_to_ras, progress=None):
+  """
+  Join the label surfaces of consecutive slabs, which share their boundary
+  slices, by merging their coincident points, then smooth the whole surface
+  and transform it to RAS as in extract_surface.
+  """
+  import vtk
+
+  _report(progress, 0.0, 'Merging slabs')
+  append = vtk.vtkAppendPolyData()
+  for surface in surfaces:
+    append.AddInputData(surface)
+  append.Update()
+  merge = vtk.vtkCleanPolyData()
+  merge.SetInputData(append.GetOutput())
+  append.RemoveAllInputs()
+  merge.PointMergingOn()
+  merge.SetTolerance(0.0)
+  merge.ConvertLinesToPointsOff()
+  merge.ConvertPolysToLinesOff()
+  merge.ConvertStripsToPolysOff()
+  merge.Update()
+  return finish_surface(merge.GetOutput(), ijk_to_ras, progress=_stage(progress, 0.2, 1.0))
+
+
+def stream_skin_surface(volume, minimum=100, maximum=5000, kernel_size_mm=10, slab_slices=32, progress=None):
+  """
+  Same surface as extract_skin_surface for a volumes.Volume too large for
+  memory. Axial slabs of slab_slices slices are read with a halo of half the
+  smoothing kernel on both sides, so each smoothed slab matches the smoothing
+  of the whole volume exactly. The label surfaces of the slabs share their
+  boundary slices and are merged there before the whole surface is smoothed.
+  Peak memory is bounded by the slab size and the surface, not by the volume.
+  """
+  slices = volume.shape[0]
+  kernel_size = (1, 1, 1)
+  if kernel_size_mm:
+    kernel_size = median_kernel_size(kernel_size_mm, voxel_spacing(volume.ijk_to_ras))
+  halo = kernel_size[0] // 2
+  surfaces = []
+  for start in range(0, slices, slab_slices):
+    _report(progress, 0.6 * start / slices, 'Segmenting slices %d to %d' % (start, min(start + slab_slices, slices)))
+    # One more slice for the cells between this slab and the next one
+    stop = min(start + slab_slices + 1, slices)
+    low, high = max(start - halo, 0), min(stop + halo, slices)
+    mask = threshold(volume.slab(low, high), minimum, maximum)
+    if kernel_size_mm:
+      mask = smooth_median(mask, kernel_size)
+    surfaces.append(label_surface(mask[start - low:stop - low], start, _slab_pad(start, stop, slices)))
+    if stop == slices:
+      break
+  return merge_slab_surfaces(surfaces, volume.ijk_to_ras, _stage(progress, 0.6, 1.0))
+
+
+def _split(length, count):
+  """(start, stop) of count nearly equal, non-empty parts of range(length)"""
+  bounds = np.linspace(0, length, min(count, length) + 1).round().astype(int)
+  return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _blocks(shape, axis, count):
+  """Index tuples of count blocks of an array of shape, split along axis"""
+  blocks = []
+  for start, stop in _split(shape[axis], count):
+    index = [slice(None)] * len(shape)
+    index[axis] = slice(start, stop)
+    blocks.append(tuple(index))
+  return blocks
+
+
+def parallel_skin_surface(voxels, ijk_to_ras, minimum=100, maximum=5000, kernel_size_mm=10, workers=None,
+    progress=None):
+  """
+  extract_skin_surface on a thread pool of workers threads (default: one per
+  core). NumPy, SciPy and VTK release the GIL in the work done here. Each
+  one-dimensional pass of the median smoothing is split along another axis,
+  so blocks need no halo and the result is identical to smooth_median. The
+  label surface is extracted in axial slabs sharing their boundary slices and
+  merged as in stream_skin_surface.
+  Returns (surface, smoothed mask), the same as extract_skin_surface.
+  """
+  from concurrent.futures import ThreadPoolExecutor
+  from scipy import ndimage
+
+  workers = workers or os.cpu_count() or 1
+  # A few blocks per worker balance the load between slow and fast blocks
+  count = 4 * workers
+  shape = voxels.shape
+  kernel_size = median_kernel_size(kernel_size_mm, voxel_spacing(ijk_to_ras)) if kernel_size_mm else (1, 1, 1)
+  passes = [axis for axis, size in enumerate(kernel_size) if size > 1]
+
+  with ThreadPoolExecutor(workers, thread_name_prefix='NussBarSegmentation') as executor:
+    def run(function, blocks, fraction, message):
+      _report(progress, fraction, message)
+      for _ in executor.map(function, blocks):
+        pass
+
+    mask = np.empty(shape, dtype=bool)
+    average = np.empty(shape, dtype=np.float32) if passes else None
+
+    def threshold_block(index):
+      mask[index] = threshold(voxels[index], minimum, maximum)
+      if average is not None:
+        average[index] = mask[index]
+    run(threshold_block, _blocks(shape, 0, count), 0.0, 'Thresholding')
+
+    for step, axis in enumerate(passes):
+      # Split along the longest of the other axes
+      other = max((a for a in range(3) if a != axis), key=lambda a: shape[a])
+      def smooth_block(index, axis=axis):
+        ndimage.uniform_filter1d(average[index], kernel_size[axis], axis=axis, output=average[index], mode='nearest')
+      run(smooth_block, _blocks(shape, other, count), 0.1 + 0.3 * step / len(passes), 'Smoothing')
+
+    if average is not None:
+      def majority_block(index):
+        np.greater(average[index], 0.5, out=mask[index])
+      run(majority_block, _blocks(shape, 0, count), 0.4, 'Smoothing')
+      del average
+
+    slabs = _split(shape[0] - 1, workers) if shape[0] > 1 else [(0, 0)]
+    def slab_surface(slab):
+      # One more slice for the cells between this slab and the next one
+      start, stop = slab[0], slab[1] + 1
+      return label_surface(mask[start:stop], start, _slab_pad(start, stop, shape[0]))
+    _report(progress, 0.45, 'Extracting surface')
+    surfaces = list(executor.map(slab_surface, slabs))
+
+  surface = merge_slab_surfaces(surfaces, ijk_to_ras, _stage(progress, 0.6, 1.0))
+  return surface, mask
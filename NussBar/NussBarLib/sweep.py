@@ -0,0 +1,199 @@
+"""
+Bar mesh generation by sweeping a cross-section profile along the bar
+centerline. Everything is computed on whole arrays: frames, vertices and faces
+are produced in one pass without per-point Python loops. Centerlines with the
+same number of samples can be swept together as a (bars, samples, 3) array;
+they share one face array.
+"""
+import numpy as np
+
+# Cross-section of the bar, in millimeters
+BAR_WIDTH = 15.0
+BAR_THICKNESS = 2.0
+
+PROFILES = ('rectangular', 'rounded')
+FRAMES = ('parallel', 'frenet')
+
+
+def rectangular_profile(width=BAR_WIDTH, thickness=BAR_THICKNESS):
+  """
+  Counter-clockwise cross-section polygon as (k, 2) array of
+  (width, thickness) coordinates centered on the centerline.
+  """
+  a, b = width / 2.0, thickness / 2.0
+  return np.array([[-a, -b], [a, -b], [a, b], [-a, b]], dtype=float)
+
+
+def rounded_profile(width=BAR_WIDTH, thickness=BAR_THICKNESS, radius=None, segments=6):
+  """
+  Counter-clockwise rounded-rectangle cross-section. The default radius rounds
+  the narrow sides into half circles.
+  """
+  a, b = width / 2.0, thickness / 2.0
+  if radius is None:
+    radius = min(a, b)
+  radius = min(radius, a, b)
+  corners = np.array([[a - radius, -(b - radius)], [a - radius, b - radius],
+    [-(a - radius), b - radius], [-(a - radius), -(b - radius)]])
+  start_angles = np.array([-0.5, 0.0, 0.5, 1.0]) * np.pi
+  angles = start_angles[:, None] + np.linspace(0.0, 0.5 * np.pi, segments + 1)[None, :]
+  points = corners[:, None, :] + radius * np.stack((np.cos(angles), np.sin(angles)), axis=-1)
+  points = points.reshape(-1, 2)
+  # Drop repeated points where an arc meets a zero-length side
+  keep = np.linalg.norm(points - np.roll(points, 1, axis=0), axis=1) > 1e-9 * max(a, b)
+  return points[keep]
+
+
+def make_profile(profile='rectangular', width=BAR_WIDTH, thickness=BAR_THICKNESS, segments=6):
+  """Cross-section polygon by name"""
+  if profile == 'rectangular':
+    return rectangular_profile(width, thickness)
+  if profile == 'rounded':
+    return rounded_profile(width, thickness, segments=segments)
+  raise ValueError('Unknown bar profile: ' + str(profile))
+
+
+def resample_polyline(points, samples):
+  """samples points evenly spaced by arc length along a polyline"""
+  points = np.asarray(points, dtype=float)
+  lengths = np.linalg.norm(np.diff(points, axis=0), axis=1)
+  keep = np.concatenate(([True], lengths > 0))
+  points = points[keep]
+  s = np.concatenate(([0.0], np.cumsum(lengths[lengths > 0])))
+  if len(points) < 2:
+    raise ValueError('The centerline has zero length')
+  targets = np.linspace(0.0, s[-1], samples)
+  i = np.clip(np.searchsorted(s, targets, side='right') - 1, 0, len(s) - 2)
+  w = ((targets - s[i]) / (s[i + 1] - s[i]))[:, None]
+  return points[i] * (1 - w) + points[i + 1] * w
+
+
+def _normalize(v):
+  n = np.linalg.norm(v, axis=-1, keepdims=True)
+  return v / np.where(n > 0, n, 1.0)
+
+
+def _skew(v):
+  k = np.zeros(v.shape[:-1] + (3, 3))
+  k[..., 0, 1], k[..., 0, 2] = -v[..., 2], v[..., 1]
+  k[..., 1, 0], k[..., 1, 2] = v[..., 2], -v[..., 0]
+  k[..., 2, 0], k[..., 2, 1] = -v[..., 1], v[..., 0]
+  return k
+
+
+def _minimal_rotations(a, b):
+  """Rotation matrices taking unit vectors a onto unit vectors b"""
+  v = np.cross(a, b)
+  c = np.sum(a * b, axis=-1)
+  k = _skew(v)
+  scale = 1.0 / np.maximum(1.0 + c, 1e-12)
+  return np.eye(3) + k + (k @ k) * scale[..., None, None]
+
+
+def _initial_normal(tangent, up):
+  """Direction of the bar width at the first sample: up, made normal to the tangent"""
+  up = np.asarray(up, dtype=float)
+  normal = up - np.sum(up * tangent, axis=-1, keepdims=True) * tangent
+  # Where the tangent is parallel to up, use any perpendicular direction
+  for axis in ([1.0, 0.0, 0.0], [0.0, 1.0, 0.0]):
+    parallel = np.linalg.norm(normal, axis=-1, keepdims=True) < 1e-6
+    normal = np.where(parallel, np.cross(tangent, axis), normal)
+  return _normalize(normal)
+
+
+def parallel_transport_frames(tangents, up=(0.0, 0.0, 1.0)):
+  """
+  Rotation-minimizing width directions along unit tangents of shape
+  (..., samples, 3). The chain of rotations between consecutive tangents is
+  accumulated with a parallel prefix product (log2(n) batched matrix products).
+  """
+  n = tangents.shape[-2]
+  normals = np.empty_like(tangents)
+  normals[..., 0, :] = _initial_normal(tangents[..., 0, :], up)
+  if n > 1:
+    transport = _minimal_rotations(tangents[..., :-1, :], tangents[..., 1:, :])
+    step = 1
+    while step < n - 1:
+      transport[..., step:, :, :] = transport[..., step:, :, :] @ transport[..., :-step, :, :]
+      step *= 2
+    normals[..., 1:, :] = (transport @ normals[..., 0, None, :, None])[..., 0]
+  # Remove accumulated round-off
+  normals = _normalize(normals - np.sum(normals * tangents, axis=-1, keepdims=True) * tangents)
+  return normals
+
+
+def frenet_frames(points, tangents, up=(0.0, 0.0, 1.0)):
+  """
+  Width directions along the Frenet binormal. Straight stretches take the
+  binormal of the nearest curved sample. Note that the binormal flips at
+  inflection points.
+  """
+  if points.ndim > 2:
+    return np.stack([frenet_frames(p, t, up) for p, t in zip(points, tangents)])
+  curvature = np.gradient(tangents, axis=0)
+  curvature -= np.sum(curvature * tangents, axis=1, keepdims=True) * tangents
+  magnitude = np.linalg.norm(curvature, axis=1)
+  valid = magnitude > 1e-8 * max(np.max(magnitude), 1e-300)
+  if not np.any(valid):
+    return parallel_transport_frames(tangents, up)
+  binormals = _normalize(np.cross(tangents, curvature))
+  # Fill straight stretches from the nearest valid sample
+  index = np.arange(len(points))
+  previous = np.maximum.accumulate(np.where(valid, index, -1))
+  following = np.minimum.accumulate(np.where(valid, index, len(index))[::-1])[::-1]
+  use_previous = (previous >= 0) & ((following >= len(index)) | (index - previous <= following - index))
+  nearest = np.where(use_previous, previous, np.minimum(following, len(index) - 1))
+  binormals = binormals[nearest]
+  return _normalize(binormals - np.sum(binormals * tangents, axis=1, keepdims=True) * tangents)
+
+
+def sweep_profile(centerline, profile, up=(0.0, 0.0, 1.0), frame='parallel'):
+  """
+  Sweep a closed, convex, counter-clockwise profile along a centerline of
+  shape (samples, 3), or along several centerlines of shape (bars, samples, 3).
+  Profile x runs along the bar width (initially towards up) and profile y along
+  its thickness. Returns (vertices, faces) of a closed, consistently oriented
+  triangle mesh; vertices have the leading bars axis of the centerlines.
+  """
+  points = np.asarray(centerline, dtype=float)
+  profile = np.asarray(profile, dtype=float)
+  m, k = points.shape[-2], len(profile)
+  if m < 2:
+    raise ValueError('At least two centerline samples are needed')
+
+  tangents = _normalize(np.gradient(points, axis=-2))
+  if frame == 'parallel':
+    widths = parallel_transport_frames(tangents, up)
+  elif frame == 'frenet':
+    widths = frenet_frames(points, tangents, up)
+  else:
+    raise ValueError('Unknown frame type: ' + str(frame))
+  thicknesses = np.cross(tangents, widths)
+
+  rings = points[..., :, None, :] + profile[:, 0, None] * widths[..., :, None, :] \
+    + profile[:, 1, None] * thicknesses[..., :, None, :]
+  vertices = np.concatenate((rings.reshape(points.shape[:-2] + (-1, 3)), points[..., [0, -1], :]), axis=-2)
+
+  # Two triangles per profile edge between consecutive rings
+  ring = np.arange(m - 1)[:, None] * k
+  edge = np.arange(k)[None, :]
+  a = ring + edge
+  b = ring + (edge + 1) % k
+  c = b + k
+  d = a + k
+  sides = np.stack((np.stack((a, b, c), -1), np.stack((a, c, d), -1)), axis=2).reshape(-1, 3)
+
+  # Triangle fans closing both ends
+  start, end = m * k, m * k + 1
+  first = np.arange(k)
+  last = first + (m - 1) * k
+  start_cap = np.stack((np.full(k, start), (first + 1) % k, first), -1)
+  end_cap = np.stack((np.full(k, end), last, (first + 1) % k + (m - 1) * k), -1)
+  return vertices, np.concatenate((sides, start_cap, end_cap)).astype(np.int64)
+
+
+def bar_mesh(centerline, samples=1000, profile='rectangular', width=BAR_WIDTH,
+    thickness=BAR_THICKNESS, segments=6, up=(0.0, 0.0, 1.0), frame='parallel'):
+  """Resample a centerline evenly and sweep the named bar profile along it"""
+  points = resample_polyline(centerline, samples)
+  return sweep_profile(points, make_profile(profile, width, thickness, segments), up, frame)
@@ -0,0 +1,113 @@
+"""
+Background execution of long-running planning stages.
+
+Work functions take a progress callback as their "progress" keyword argument
+and call it as progress(fraction, message) between steps. The callback raises
+TaskCancelled once the task has been cancelled, so cancellation takes effect at
+the next reported step. The GUI polls Task.progress / Task.message from its own
+thread instead of the workers touching any widgets.
+"""
+import concurrent.futures
+import logging
+import threading
+
+
+class TaskCancelled(Exception):
+  pass
+
+
+class Task:
+  """Handle on one submitted function: progress, cancellation and result"""
+
+  def __init__(self, name=''):
+    self.name = name
+    self.future = None
+    self._progress = 0.0
+    self._message = ''
+    self._cancelled = threading.Event()
+    self._lock = threading.Lock()
+
+  @property
+  def progress(self):
+    """Completed fraction, between 0 and 1"""
+    with self._lock:
+      return self._progress
+
+  @property
+  def message(self):
+    with self._lock:
+      return self._message
+
+  def report(self, fraction, message=None):
+    """Progress callback given to the work function"""
+    if self._cancelled.is_set():
+      raise TaskCancelled(self.name)
+    self._update(fraction, message)
+
+  def _update(self, fraction, message=None):
+    with self._lock:
+      self._progress = min(max(float(fraction), 0.0), 1.0)
+      if message is not None:
+        self._message = message
+
+  def cancel(self):
+    """Request cancellation. Tasks that have not started yet never run."""
+    self._cancelled.set()
+    if self.future is not None:
+      self.future.cancel()
+
+  @property
+  def cancelled(self):
+    return self._cancelled.is_set()
+
+  def done(self):
+    return self.future is not None and self.future.done()
+
+  def result(self, timeout=None):
+    """Return value of the work function; raises its exception or TaskCancelled"""
+    try:
+      return self.future.result(timeout)
+    except concurrent.futures.CancelledError:
+      raise TaskCancelled(self.name)
+
+
+class TaskRunner:
+  """
+  Thread pool for planning work. NumPy, SciPy and VTK release the interpreter
+  lock in their heavy loops, so stages of several cases run in parallel.
+  """
+
+  def __init__(self, max_workers=None):
+    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='NussBar')
+    self.tasks = []
+
+  def submit(self, function, *args, name='', **kwargs):
+    """Run function(*args, progress=task.report, **kwargs) in the pool"""
+    task = Task(name or getattr(function, '__name__', ''))
+    kwargs['progress'] = task.report
+    task.future = self._executor.submit(self._run, task, function, args, kwargs)
+    self.tasks = [t for t in self.tasks if not t.done()] + [task]
+    return task
+
+  @staticmethod
+  def _run(task, function, args, kwargs):
+    task.report(0.0, 'Starting ' + task.name)
+    try:
+      result = function(*args, **kwargs)
+    except TaskCancelled:
+      logging.info('Cancelled ' + task.name)
+      raise
+    task._update(1.0, 'Completed ' + task.name)
+    return result
+
+  def active(self):
+    """Tasks that are queued or running"""
+    return [t for t in self.tasks if not t.done()]
+
+  def cancel_all(self):
+    for task in self.active():
+      task.cancel()
+
+  def shutdown(self, wait=False):
+    self.cancel_all()
+    self._executor.shutdown(wait=wait)
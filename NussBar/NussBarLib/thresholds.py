@@ -0,0 +1,113 @@
+"""
+Segmentation presets and automatic thresholds from the intensity histogram.
+
+A preset gives the threshold range and smoothing kernel for one tissue. Its
+minimum can instead be chosen per scan by Otsu's method or at the valley
+between the two main histogram peaks, both searched within the preset's
+window so that, for example, the bone threshold is not pulled towards air.
+The histogram is computed in one pass over the voxels.
+"""
+import numpy as np
+
+
+class Preset:
+  """Threshold range (scalar values, HU for CT) and median kernel size (millimeters)"""
+
+  def __init__(self, name, minimum, maximum, kernel_size_mm, window):
+    self.name = name
+    self.minimum = minimum
+    self.maximum = maximum
+    self.kernel_size_mm = kernel_size_mm
+    # Range of values searched for an automatic minimum
+    self.window = window
+
+
+PRESETS = {preset.name: preset for preset in (
+  # The original thresholds of the skin surface
+  Preset('Default', 100, 5000, 10, (-1024, 3000)),
+  # Everything denser than fat: the body outline
+  Preset('Skin', -200, 3000, 10, (-1024, 500)),
+  # Ribs, sternum and spine
+  Preset('Bone', 250, 3000, 3, (100, 1500)),
+  # Costal cartilage, denser than muscle but less than bone
+  Preset('Cartilage', 80, 250, 3, (0, 400)),
+)}
+
+AUTO_METHODS = ('otsu', 'valley')
+
+
+def histogram(voxels, window=None, bins=512):
+  """
+  Histogram of voxels in equal bins over window (default: the value range), as
+  (counts, bin edges). Integer volumes are counted with bincount in one pass.
+  """
+  voxels = np.asarray(voxels)
+  if window is None:
+    window = (float(voxels.min()), float(voxels.max()))
+  low, high = float(window[0]), float(window[1])
+  if high <= low:
+    high = low + 1.0
+  edges = np.linspace(low, high, bins + 1)
+  if np.issubdtype(voxels.dtype, np.integer) and voxels.dtype.itemsize <= 2:
+    # Count every integer value, then sum the values of each bin
+    offset = int(np.iinfo(voxels.dtype).min)
+    values = np.bincount((voxels.ravel().astype(np.int32) - offset))
+    centers = np.arange(len(values)) + offset
+    inside = (centers >= low) & (centers <= high)
+    index = np.minimum(((centers[inside] - low) / (high - low) * bins).astype(int), bins - 1)
+    counts = np.bincount(index, values[inside], minlength=bins)
+  else:
+    counts = np.histogram(voxels, bins=edges)[0].astype(float)
+  return counts, edges
+
+
+def otsu(counts, edges):
+  """Threshold between two bins that maximizes the between-class variance"""
+  centers = (edges[:-1] + edges[1:]) / 2
+  weight = np.cumsum(counts)
+  total = weight[-1]
+  if total == 0:
+    raise ValueError('No voxels in the threshold window')
+  moment = np.cumsum(counts * centers)
+  background = weight[:-1]
+  foreground = total - background
+  with np.errstate(divide='ignore', invalid='ignore'):
+    mean_background = moment[:-1] / background
+    mean_foreground = (moment[-1] - moment[:-1]) / foreground
+    variance = background * foreground * (mean_background - mean_foreground)**2
+  variance = np.where((background > 0) & (foreground > 0), variance, np.nan)
+  # Classes that are well apart separate equally well anywhere in the gap
+  # between them: take the middle of the gap
+  best = np.flatnonzero(variance >= np.nanmax(variance) * (1 - 1e-4))
+  return float(edges[best[len(best) // 2] + 1])
+
+
+def valley(counts, edges, smoothing=5):
+  """
+  Threshold at the lowest point of the smoothed histogram between its two
+  highest peaks. Falls back to Otsu's method if there is only one peak.
+  """
+  kernel = np.hanning(2 * smoothing + 3)[1:-1]
+  smooth = np.convolve(counts, kernel / kernel.sum(), mode='same')
+  inner = smooth[1:-1]
+  peaks = np.flatnonzero((inner >= smooth[:-2]) & (inner > smooth[2:])) + 1
+  if len(peaks) < 2:
+    return otsu(counts, edges)
+  first, second = np.sort(peaks[np.argsort(smooth[peaks])[-2:]])
+  between = smooth[first:second + 1]
+  # Middle of the lowest bins, as an empty gap is often many bins wide
+  lowest = first + np.flatnonzero(between <= between.min() + 1e-9 * between.max())
+  middle = lowest[len(lowest) // 2]
+  return float((edges[middle] + edges[middle + 1]) / 2)
+
+
+def auto_threshold(voxels, preset='Default', method='otsu', bins=512):
+  """Automatic minimum threshold of voxels within the window of a preset (name or Preset)"""
+  if not isinstance(preset, Preset):
+    preset = PRESETS[preset]
+  counts, edges = histogram(voxels, preset.window, bins)
+  if method == 'otsu':
+    return otsu(counts, edges)
+  if method == 'valley':
+    return valley(counts, edges)
+  raise ValueError('Unknown threshold method: ' + str(method))
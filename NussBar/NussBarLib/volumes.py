@@ -0,0 +1,165 @@
+"""
+Memory-mapped reading of uncompressed NRRD and NIfTI volumes.
+
+The voxels stay on disk and are paged in as slabs of axial slices are read,
+so volumes larger than the available memory can be segmented slab by slab
+(see segmentation.stream_skin_surface). Voxel arrays use Slicer's (k, j, i)
+axis order and ijk_to_ras is the 4x4 IJK-to-RAS matrix, as elsewhere in
+NussBarLib.
+"""
+import os
+
+import numpy as np
+
+NRRD_TYPES = {
+  'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+  'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+  'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2', 'int16': 'i2', 'int16_t': 'i2',
+  'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2', 'uint16': 'u2', 'uint16_t': 'u2',
+  'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+  'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+  'longlong': 'i8', 'long long': 'i8', 'long long int': 'i8', 'int64': 'i8', 'int64_t': 'i8',
+  'ulonglong': 'u8', 'unsigned long long': 'u8', 'unsigned long long int': 'u8', 'uint64': 'u8', 'uint64_t': 'u8',
+  'float': 'f4', 'double': 'f8',
+}
+
+NIFTI_TYPES = {2: 'u1', 4: 'i2', 8: 'i4', 16: 'f4', 64: 'f8', 256: 'i1', 512: 'u2', 768: 'u4', 1024: 'i8', 1280: 'u8'}
+
+
+class Volume:
+  """
+  Voxels stored in a file at offset, in (k, j, i) order, with their geometry.
+  Stored values are mapped to scalar values by slope and intercept, as in
+  NIfTI (1 and 0 for NRRD).
+  """
+
+  def __init__(self, path, dtype, shape, offset, ijk_to_ras, slope=1.0, intercept=0.0):
+    self.path = path
+    self.dtype = np.dtype(dtype)
+    self.shape = tuple(shape)
+    self.offset = offset
+    self.ijk_to_ras = ijk_to_ras
+    self.slope = slope
+    self.intercept = intercept
+
+  @property
+  def voxels(self):
+    """Memory map of all stored values"""
+    return np.memmap(self.path, dtype=self.dtype, mode='r', offset=self.offset, shape=self.shape)
+
+  def slab(self, start, stop):
+    """
+    Scalar values of axial slices start to stop, read from disk. Only the slab
+    is mapped, and unmapped again, so the pages read do not accumulate in the
+    resident memory of the process.
+    """
+    slice_bytes = int(np.prod(self.shape[1:])) * self.dtype.itemsize
+    mapped = np.memmap(self.path, dtype=self.dtype, mode='r', offset=self.offset + start * slice_bytes,
+      shape=(stop - start,) + self.shape[1:])
+    voxels = np.array(mapped)
+    del mapped
+    if self.slope != 1.0 or self.intercept != 0.0:
+      voxels = voxels * self.slope + self.intercept
+    return voxels
+
+
+def _vector(text):
+  return [float(value) for value in text.strip().strip('()').split(',')]
+
+
+def read_nrrd(path):
+  """Volume of a NRRD file with raw encoding, attached or detached"""
+  fields = {}
+  with open(path, 'rb') as f:
+    magic = f.readline()
+    if not magic.startswith(b'NRRD'):
+      raise ValueError(path + ' is not a NRRD file')
+    for line in f:
+      line = line.decode('latin-1').rstrip('\r\n')
+      if not line:
+        break
+      if line.startswith('#') or ':' not in line or ':=' in line:
+        continue
+      key, value = line.split(':', 1)
+      fields[key.strip().lower()] = value.strip()
+    offset = f.tell()
+
+  if fields.get('encoding', 'raw') != 'raw':
+    raise ValueError('Only uncompressed (raw) NRRD files can be memory-mapped, %s is %s' % (path, fields['encoding']))
+  if int(fields['dimension']) != 3:
+    raise ValueError('%s is not a 3D volume' % path)
+  dtype = np.dtype(NRRD_TYPES[fields['type']])
+  if dtype.itemsize > 1:
+    dtype = dtype.newbyteorder('<' if fields.get('endian', 'little') == 'little' else '>')
+  sizes = [int(size) for size in fields['sizes'].split()]
+
+  data_file = fields.get('data file', fields.get('datafile'))
+  if data_file:
+    path = os.path.join(os.path.dirname(path), data_file)
+    offset = 0
+  offset += int(fields.get('byte skip', 0))
+
+  directions = np.array([_vector(d) for d in fields['space directions'].split(')') if d.strip()]).T
+  origin = np.array(_vector(fields.get('space origin', '(0,0,0)')))
+  ijk_to_ras = np.eye(4)
+  ijk_to_ras[:3, :3] = directions
+  ijk_to_ras[:3, 3] = origin
+  space = fields.get('space', 'right-anterior-superior').lower()
+  if space in ('left-posterior-superior', 'lps'):
+    ijk_to_ras[:2] *= -1
+  elif space not in ('right-anterior-superior', 'ras'):
+    raise ValueError('Unsupported NRRD space: ' + space)
+  return Volume(path, dtype, sizes[::-1], offset, ijk_to_ras)
+
+
+def read_nifti(path):
+  """Volume of an uncompressed NIfTI-1 (.nii) file"""
+  header = np.fromfile(path, dtype=np.uint8, count=348).tobytes()
+  if len(header) < 348:
+    raise ValueError(path + ' is not a NIfTI file')
+  byte_order = '<' if np.frombuffer(header, '<i4', 1)[0] == 348 else '>'
+  if np.frombuffer(header, byte_order + 'i4', 1)[0] != 348 or header[344:347] != b'n+1':
+    raise ValueError('Only single-file NIfTI-1 volumes (.nii) can be memory-mapped: ' + path)
+
+  def values(offset, type, count=1):
+    return np.frombuffer(header, byte_order + type, count, offset)
+
+  dims = values(40, 'i2', 8)
+  if dims[0] < 3 or np.any(dims[4:dims[0] + 1] > 1):
+    raise ValueError('%s is not a 3D volume' % path)
+  datatype = int(values(70, 'i2')[0])
+  if datatype not in NIFTI_TYPES:
+    raise ValueError('Unsupported NIfTI data type %d' % datatype)
+  dtype = np.dtype(byte_order + NIFTI_TYPES[datatype])
+  offset = int(values(108, 'f4')[0])
+  slope, intercept = (float(v) for v in values(112, 'f4', 2))
+
+  pixdim = values(76, 'f4', 8)
+  qform_code, sform_code = (int(v) for v in values(252, 'i2', 2))
+  ijk_to_ras = np.eye(4)
+  if sform_code > 0:
+    ijk_to_ras[:3] = values(280, 'f4', 12).reshape(3, 4)
+  elif qform_code > 0:
+    b, c, d = (float(v) for v in values(256, 'f4', 3))
+    a = np.sqrt(max(1.0 - (b * b + c * c + d * d), 0.0))
+    rotation = np.array([
+      [a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+      [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+      [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b]])
+    qfac = -1.0 if pixdim[0] < 0 else 1.0
+    ijk_to_ras[:3, :3] = rotation * np.array([pixdim[1], pixdim[2], qfac * pixdim[3]])
+    ijk_to_ras[:3, 3] = values(268, 'f4', 3)
+  else:
+    ijk_to_ras[:3, :3] = np.diag(pixdim[1:4])
+  shape = tuple(int(d) for d in dims[3:0:-1])
+  return Volume(path, dtype, shape, offset, ijk_to_ras, slope if slope else 1.0, intercept if slope else 0.0)
+
+
+def read_volume(path):
+  """Volume of a .nrrd, .nhdr or .nii file, read lazily through memory maps"""
+  lower = path.lower()
+  if lower.endswith(('.nrrd', '.nhdr')):
+    return read_nrrd(path)
+  if lower.endswith('.nii'):
+    return read_nifti(path)
+  raise ValueError('Only uncompressed .nrrd, .nhdr and .nii volumes can be memory-mapped: ' + path)
@@ -0,0 +1,330 @@
+"""
+Headless performance benchmarks of the planning pipeline on synthetic pectus
+excavatum phantoms. No Slicer GUI or GPU is needed, only NumPy, SciPy and VTK.
+It is part of the tests, not of the installed module.
+
+  python Testing/Python/benchmark.py [--sizes small medium] [--repeat N]
+    [--output results.json] [--compare baseline.json] [--tolerance 1.25]
+    [--workers 1 2 4 8]
+
+Every stage (threshold, smoothing, surface extraction, normals, curve fit, arc
+length and bar extrusion) is run once to record its peak memory, then timed on
+each phantom size. Peak memory comes from tracemalloc, except for the VTK
+stages, whose allocations tracemalloc does not see: their peak resident set
+size is measured instead where the process peak can be reset (Linux), and they
+are reported as not measured elsewhere. Results are written as JSON; with
+--compare, stages slower than the baseline by more than the tolerance factor are
+reported and the exit code is 1. With --workers, the multi-core segmentation
+(threshold to surface) is also timed with each number of threads.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+# NussBarLib is in the module folder, two levels up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from NussBarLib import geometry, profiling, segmentation, sweep
+
+try:
+  import resource
+except ImportError:
+  # Not available on Windows
+  resource = None
+
+STAGES = ('threshold', 'smoothing', 'surface', 'normals', 'curve_fit', 'arc_length', 'extrusion')
+
+# Stages allocating in VTK, out of sight of tracemalloc
+VTK_STAGES = ('surface', 'normals')
+
+# Volume shape (k, j, i), isotropic spacing in millimeters and number of fiducials
+SIZES = {
+  'small': ((64, 96, 128), 3.0, 7),
+  'medium': ((128, 192, 256), 1.5, 15),
+  'large': ((256, 384, 512), 0.75, 31),
+}
+
+# Thresholds and kernel of the default skin segmentation
+MINIMUM, MAXIMUM, KERNEL_SIZE_MM = 100, 5000, 10
+TISSUE_VALUE = 1000
+
+
+def chest_front(x, z, half_width=150.0, half_depth=100.0, depth=35.0, width=40.0, height=60.0):
+  """
+  Anterior chest wall height (RAS y, millimeters) of the phantom at x, z: an
+  elliptical torso with a Gaussian sternal depression of the given depth.
+  """
+  x, z = np.asarray(x, dtype=float), np.asarray(z, dtype=float)
+  ellipse = half_depth * np.sqrt(np.clip(1 - (x / half_width)**2, 0.0, None))
+  return ellipse - depth * np.exp(-x**2 / (2 * width**2) - z**2 / (2 * height**2))
+
+
+def make_phantom(shape, spacing, noise=0.02, seed=0):
+  """
+  Synthetic CT-like volume of a pectus excavatum torso. Returns the int16 voxel
+  array in (k, j, i) order and its IJK-to-RAS matrix, with the volume centered
+  on the RAS origin. noise is the fraction of voxels flipped to the other class.
+  """
+  shape = tuple(shape)
+  ijk_to_ras = np.diag([spacing, spacing, spacing, 1.0])
+  ijk_to_ras[:3, 3] = -(np.array(shape[::-1]) - 1) / 2 * spacing
+  k, j, i = np.ogrid[:shape[0], :shape[1], :shape[2]]
+  x = i * spacing + ijk_to_ras[0, 3]
+  y = j * spacing + ijk_to_ras[1, 3]
+  z = k * spacing + ijk_to_ras[2, 3]
+  front = chest_front(x, z)
+  back = -100.0 * np.sqrt(np.clip(1 - (x / 150.0)**2, 0.0, None))
+  inside = (y <= front) & (y >= back)
+  rng = np.random.default_rng(seed)
+  inside ^= rng.random(shape) < noise
+  voxels = np.where(inside, TISSUE_VALUE, -TISSUE_VALUE).astype(np.int16)
+  return voxels, ijk_to_ras
+
+
+def make_fiducials(count, clearance=5.0, seed=0):
+  """count fiducials along the anterior chest wall at z = 0, in random order"""
+  x = np.linspace(-120.0, 120.0, count)
+  points = np.stack((x, chest_front(x, 0.0) + clearance, np.zeros(count)), axis=1)
+  return points[np.random.default_rng(seed).permutation(count)]
+
+
+def pipeline(voxels, ijk_to_ras, fiducials, samples=1000):
+  """(stage name, function) pairs; each function takes and updates a state dict"""
+  def threshold(state):
+    state['mask'] = segmentation.threshold(voxels, MINIMUM, MAXIMUM)
+
+  def smoothing(state):
+    kernel = segmentation.median_kernel_size(KERNEL_SIZE_MM, segmentation.voxel_spacing(ijk_to_ras))
+    state['mask'] = segmentation.smooth_median(state['mask'], kernel)
+
+  def surface(state):
+    state['surface'] = segmentation.extract_surface(state['mask'], ijk_to_ras, normals=False)
+
+  def normals(state):
+    state['surface'] = segmentation.compute_normals(state['surface'])
+
+  def curve_fit(state):
+    control_points = geometry.order_fiducials(fiducials)
+    state['curve'] = geometry.SplineCurve(control_points)
+
+  def arc_length(state):
+    state['bar_points'] = state['curve'].sample_by_length(samples)
+
+  def extrusion(state):
+    state['mesh'] = sweep.bar_mesh(state['bar_points'], samples)
+
+  return list(zip(STAGES, (threshold, smoothing, surface, normals, curve_fit, arc_length, extrusion)))
+
+
+def peak_rss_bytes():
+  """Peak resident set size of this process, or None if unknown"""
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Kilobytes on Linux, bytes on macOS
+  return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def reset_peak_rss():
+  """Reset the peak resident set size of this process to the current one. Returns whether it could be reset (Linux)."""
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+    return True
+  except OSError:
+    return False
+
+
+def peak_rss_since_reset_bytes():
+  """Peak resident set size of this process since reset_peak_rss(), or None if unknown"""
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) * 1024
+  except (OSError, ValueError):
+    pass
+  return None
+
+
+def stage_peak_bytes(function, state, vtk_stage):
+  """
+  Run function(state) and return the growth of memory at its peak and how it
+  was measured: 'tracemalloc', 'rss' for VTK stages, or (None, None) if a VTK
+  stage could not be measured. tracemalloc must be tracing.
+  """
+  if vtk_stage:
+    start = profiling.current_rss_bytes() if reset_peak_rss() else None
+    function(state)
+    peak = peak_rss_since_reset_bytes() if start is not None else None
+    return (None, None) if peak is None else (peak - start, 'rss')
+  tracemalloc.reset_peak()
+  current = tracemalloc.get_traced_memory()[0]
+  function(state)
+  return tracemalloc.get_traced_memory()[1] - current, 'tracemalloc'
+
+
+def run_size(name, repeat=3, samples=1000):
+  """Time every stage on one phantom size. Returns the result dict of that size."""
+  shape, spacing, count = SIZES[name]
+  voxels, ijk_to_ras = make_phantom(shape, spacing)
+  fiducials = make_fiducials(count)
+  stages = pipeline(voxels, ijk_to_ras, fiducials, samples)
+
+  # Untimed run for memory, since tracemalloc slows down allocations. It also
+  # warms up lazy imports before the timed runs.
+  # Loaded first, so that its import does not count as memory of the first VTK stage
+  import vtk  # noqa: F401
+  peak_bytes, peak_sources = {}, {}
+  state = {}
+  tracemalloc.start()
+  try:
+    for stage, function in stages:
+      peak_bytes[stage], peak_sources[stage] = stage_peak_bytes(function, state, stage in VTK_STAGES)
+  finally:
+    tracemalloc.stop()
+
+  seconds = {stage: [] for stage in STAGES}
+  for _ in range(repeat):
+    state = {}
+    for stage, function in stages:
+      start = time.perf_counter()
+      function(state)
+      seconds[stage].append(time.perf_counter() - start)
+
+  return {
+    'shape': list(shape),
+    'spacing': spacing,
+    'fiducials': count,
+    'triangles': int(state['surface'].GetNumberOfPolys()),
+    'peakRssBytes': peak_rss_bytes(),
+    'stages': {stage: {
+      'seconds': [round(t, 6) for t in seconds[stage]],
+      'median': round(float(np.median(seconds[stage])), 6),
+      'min': round(min(seconds[stage]), 6),
+      'peakBytes': None if peak_bytes[stage] is None else int(peak_bytes[stage]),
+      'peakSource': peak_sources[stage],
+    } for stage in STAGES},
+  }
+
+
+def run(sizes=('small', 'medium'), repeat=3, samples=1000):
+  """Benchmark the given phantom sizes. Returns the JSON-serializable results."""
+  results = {
+    'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'environment': {
+      'python': platform.python_version(),
+      'numpy': np.__version__,
+      'platform': platform.platform(),
+      'processor': platform.processor(),
+    },
+    'repeat': repeat,
+    'samples': samples,
+    'sizes': {},
+  }
+  for name in sizes:
+    logging.info('Benchmarking %s phantom %s' % (name, SIZES[name][0]))
+    results['sizes'][name] = run_size(name, repeat, samples)
+  return results
+
+
+def scaling(sizes=('small', 'medium'), workers=(1, 2, 4), repeat=3):
+  """
+  Median seconds of segmentation.parallel_skin_surface per phantom size and
+  number of worker threads, and the speedup over the first number
+  """
+  results = {}
+  for name in sizes:
+    shape, spacing, _ = SIZES[name]
+    voxels, ijk_to_ras = make_phantom(shape, spacing)
+    timings = {}
+    for count in workers:
+      seconds = []
+      for _ in range(repeat):
+        start = time.perf_counter()
+        segmentation.parallel_skin_surface(voxels, ijk_to_ras, MINIMUM, MAXIMUM, KERNEL_SIZE_MM, workers=count)
+        seconds.append(time.perf_counter() - start)
+      timings[count] = float(np.median(seconds))
+    first = timings[workers[0]]
+    results[name] = {str(count): {'median': round(t, 6), 'speedup': round(first / t, 3)} for count, t in timings.items()}
+  return results
+
+
+def compare(results, baseline, tolerance=1.25, min_seconds=0.005):
+  """
+  Stages whose median time grew by more than the tolerance factor relative to
+  the baseline, as (size, stage, baseline seconds, seconds) tuples. Increases
+  under min_seconds are timer noise and are ignored.
+  """
+  regressions = []
+  for name, size in results['sizes'].items():
+    reference = baseline.get('sizes', {}).get(name)
+    if reference is None:
+      continue
+    for stage, timing in size['stages'].items():
+      if stage in reference['stages']:
+        before = reference['stages'][stage]['median']
+        if timing['median'] > before * tolerance and timing['median'] - before > min_seconds:
+          regressions.append((name, stage, before, timing['median']))
+  return regressions
+
+
+def format_table(results):
+  """Plain text table of median seconds and peak memory per stage (RSS for VTK stages, n/a if not measured)"""
+  lines = ['%-8s %-12s %10s %12s' % ('size', 'stage', 'median s', 'peak MiB')]
+  for name, size in results['sizes'].items():
+    for stage, timing in size['stages'].items():
+      peak = timing['peakBytes']
+      memory = 'n/a' if peak is None else '%.1f%s' % (peak / 1024**2, ' rss' if timing.get('peakSource') == 'rss' else '')
+      lines.append('%-8s %-12s %10.4f %12s' % (name, stage, timing['median'], memory))
+  return '\n'.join(lines)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark the Nuss bar planning pipeline on synthetic phantoms.')
+  parser.add_argument('--sizes', nargs='+', choices=sorted(SIZES), default=['small', 'medium'],
+    help='phantom sizes to benchmark (default: small medium)')
+  parser.add_argument('--repeat', type=int, default=3, help='timed runs per size (default: 3)')
+  parser.add_argument('--samples', type=int, default=1000,
+    help='number of cross-sections along the bar mesh (default: 1000)')
+  parser.add_argument('--output', help='JSON file where results are written')
+  parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+  parser.add_argument('--tolerance', type=float, default=1.25,
+    help='slowdown factor reported as a regression (default: 1.25)')
+  parser.add_argument('--workers', type=int, nargs='+',
+    help='also time the multi-core segmentation with these numbers of threads')
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO, format='%(message)s')
+  results = run(args.sizes, args.repeat, args.samples)
+  print(format_table(results))
+  if args.workers:
+    results['scaling'] = scaling(args.sizes, args.workers, args.repeat)
+    for name, timings in results['scaling'].items():
+      for count, timing in timings.items():
+        print('%-8s %3s threads %10.4f s %8.2fx' % (name, count, timing['median'], timing['speedup']))
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
+
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for name, stage, before, after in regressions:
+      logging.error('%s %s: %.4f s -> %.4f s (%.2fx)' % (name, stage, before, after, after / before))
+    if regressions:
+      return 1
+    logging.info('No stage slower than %.2fx the baseline' % args.tolerance)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
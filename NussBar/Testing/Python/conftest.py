@@ -0,0 +1,10 @@
+"""
+Tests of the Slicer-free NussBarLib, run with pytest from the module folder:
+
+  python -m pytest Testing/Python
+"""
+import os
+import sys
+
+# NussBarLib is in the module folder, two levels up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
@@ -0,0 +1,105 @@
+"""Fiducial order, curve fitting, arc length and bar length (NussBarLib.geometry)"""
+import numpy as np
+import pytest
+
+from NussBarLib import geometry
+
+
+def chest_curve(t):
+  """Anterior chest wall with a sternal depression, from patient right (t < 0) to left"""
+  t = np.asarray(t, dtype=float)
+  return np.stack((120 * np.sin(t), 80 * np.cos(t) - 20 * np.exp(-(t / 0.3)**2), np.zeros_like(t)), axis=1)
+
+
+def dense_length(t0=-1.2, t1=1.2):
+  return geometry.polyline_length(chest_curve(np.linspace(t0, t1, 200001)))
+
+
+@pytest.mark.parametrize('count', [3, 5, 9, 31, 500])
+def test_order_points_recovers_shuffled_order(count):
+  points = chest_curve(np.linspace(-1.2, 1.2, count))
+  shuffled = points[np.random.default_rng(count).permutation(count)]
+  # From patient left, the end with the larger x
+  np.testing.assert_array_equal(geometry.order_points(shuffled), points[::-1])
+
+
+def test_order_points_follows_a_wrapping_curve():
+  angles = np.radians(np.linspace(-140, 160, 40))
+  points = 100 * np.stack((np.cos(angles), np.sin(angles), np.zeros_like(angles)), axis=1)
+  shuffled = points[np.random.default_rng(0).permutation(len(points))]
+  np.testing.assert_array_equal(geometry.order_points(shuffled), points)
+
+
+def test_spline_passes_through_the_control_points():
+  points = chest_curve(np.linspace(-1.2, 1.2, 9))
+  curve = geometry.SplineCurve(points)
+  np.testing.assert_allclose(curve.evaluate(curve.knots), points, atol=1e-9)
+
+
+def test_arc_length_of_a_circle():
+  angles = np.linspace(0.0, np.pi, 181)
+  curve = geometry.SplineCurve(50 * np.stack((np.cos(angles), np.sin(angles), np.zeros_like(angles)), axis=1))
+  assert curve.length() == pytest.approx(50 * np.pi, rel=1e-6)
+
+
+def test_arc_length_table_lookups():
+  curve = geometry.SplineCurve(chest_curve(np.linspace(-1.2, 1.2, 9)))
+  table = curve.arc_length_table
+  s = np.linspace(0.0, table.length, 57)
+  np.testing.assert_allclose(table.length_at(table.parameter_at(s)), s, atol=1e-4)
+  steps = np.linalg.norm(np.diff(curve.sample_by_length(1000), axis=0), axis=1)
+  np.testing.assert_allclose(steps, table.length / 999, rtol=1e-3)
+
+
+@pytest.mark.parametrize('target', [150.0, 256.0, 400.0])
+def test_constrain_length_gives_the_exact_length(target):
+  curve = geometry.SplineCurve(chest_curve(np.linspace(-1.2, 1.2, 15)))
+  points = geometry.constrain_length(curve, target, 4000)
+  assert geometry.polyline_length(points) == pytest.approx(target, rel=1e-5)
+  # Trimmed or extended equally at both ends
+  length = curve.length()
+  if target < length:
+    u = np.linspace(0.0, 1.0, 200001)
+    on_curve = curve.evaluate(u)
+    ends = [u[np.argmin(np.linalg.norm(on_curve - point, axis=1))] for point in (points[0], points[-1])]
+    trimmed = curve.arc_length_table.length_at(np.array(ends))
+    assert trimmed[0] == pytest.approx(length - trimmed[1], abs=0.01)
+  else:
+    extensions = np.linalg.norm(points[[0, -1]] - curve.evaluate(np.array([0.0, 1.0])), axis=1)
+    np.testing.assert_allclose(extensions, (target - length) / 2, rtol=1e-4)
+
+
+def test_plan_bar_with_bar_length():
+  fiducials = chest_curve(np.linspace(-1.2, 1.2, 9))
+  plan = geometry.plan_bar(fiducials[::-1][np.random.default_rng(1).permutation(9)], bar_length=300.0)
+  assert plan.bar_length == pytest.approx(300.0, rel=1e-5)
+  # Nine fiducials smooth out part of the depression
+  assert plan.markup_length == pytest.approx(dense_length(), rel=0.01)
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_outliers_are_rejected_on_shuffled_input(seed):
+  # Outliers offset to one side, in the order order_fiducials gives the shuffled points
+  rng = np.random.default_rng(seed)
+  points = chest_curve(np.sort(rng.uniform(-1.2, 1.2, 2000))) + rng.normal(0.0, 0.5, (2000, 3))
+  outliers = rng.random(2000) < 0.1
+  points[outliers, 1] += 20.0
+  order = rng.permutation(2000)
+  points, outliers = points[order], outliers[order]
+  ordered = geometry.order_fiducials(points)
+  # Which ordered points are outliers
+  index = {tuple(p): i for i, p in enumerate(points)}
+  outliers = outliers[[index[tuple(p)] for p in ordered]]
+
+  curve = geometry.fit_curve(ordered, None, 5.0)
+  np.testing.assert_array_equal(curve.inliers, ~outliers)
+  assert curve.length() == pytest.approx(dense_length(), rel=0.01)
+  stray = np.linalg.norm(curve.sample(200)[:, None, :] - chest_curve(np.linspace(-1.2, 1.2, 4001))[None], axis=2)
+  assert stray.min(axis=1).max() < 1.0
+
+
+def test_smoothing_spline_keeps_within_tolerance():
+  rng = np.random.default_rng(2)
+  points = chest_curve(np.linspace(-1.2, 1.2, 60)) + rng.normal(0.0, 0.5, (60, 3))
+  curve = geometry.fit_curve(geometry.order_fiducials(points), 1.0)
+  assert curve.rms_error <= 1.0 + 1e-6
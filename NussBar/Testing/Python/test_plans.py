@@ -0,0 +1,77 @@
+"""Saving and loading plan files (NussBarLib.plans)"""
+import json
+
+import numpy as np
+import pytest
+
+from NussBarLib import geometry, plans
+
+
+@pytest.fixture
+def plan():
+  t = np.linspace(-1.2, 1.2, 9)
+  fiducials = np.stack((120 * np.sin(t), 80 * np.cos(t), np.zeros_like(t)), axis=1)
+  bar = geometry.plan_bar(fiducials, samples=500)
+  surface = plans.surface_reference(bar.vertices, 'Skin', 'skin.stl')
+  return plans.Plan('Case 1', fiducials, bar.control_points, bar.curve, bar.bar_points, bar.vertices, bar.faces,
+    {'bar_length': None, 'clearance': 2.0}, surface)
+
+
+def test_round_trip(tmp_path, plan):
+  manifest_path = plans.save_plan(str(tmp_path / 'case'), plan)
+  assert manifest_path.endswith(plans.MANIFEST_EXTENSION)
+  loaded = plans.load_plan(manifest_path)
+  for key in ('fiducials', 'control_points', 'bar_points', 'vertices', 'faces'):
+    np.testing.assert_array_equal(getattr(loaded, key), getattr(plan, key))
+  u = np.linspace(0.0, 1.0, 101)
+  np.testing.assert_array_equal(loaded.curve.evaluate(u), plan.curve.evaluate(u))
+  # The arc length table is read back, not integrated again
+  assert loaded.curve.length() == plan.curve.length()
+  np.testing.assert_array_equal(loaded.curve.arc_length_table.parameter_grid, plan.curve.arc_length_table.parameter_grid)
+  assert loaded.parameters == plan.parameters
+  assert loaded.surface == plan.surface
+  assert loaded.summary() == plan.summary()
+
+
+def test_either_file_names_the_plan(tmp_path, plan):
+  plans.save_plan(str(tmp_path / 'case'), plan)
+  assert plans.load_plan(str(tmp_path / ('case' + plans.ARCHIVE_EXTENSION))).name == 'Case 1'
+  assert plans.load_plan(str(tmp_path / 'case')).name == 'Case 1'
+
+
+def test_checksum_mismatch_is_detected(tmp_path, plan):
+  manifest_path, archive_path = plans.plan_paths(plans.save_plan(str(tmp_path / 'case'), plan))
+  with np.load(archive_path) as archive:
+    arrays = {key: archive[key] for key in archive.files}
+  arrays['bar_points'] = arrays['bar_points'] + 1.0
+  with open(archive_path, 'wb') as f:
+    np.savez(f, **arrays)
+  with pytest.raises(ValueError, match='Checksum mismatch'):
+    plans.load_plan(manifest_path)
+  plans.load_plan(manifest_path, verify=False)
+
+
+def test_missing_array_is_detected(tmp_path, plan):
+  manifest_path, archive_path = plans.plan_paths(plans.save_plan(str(tmp_path / 'case'), plan))
+  with np.load(archive_path) as archive:
+    arrays = {key: archive[key] for key in archive.files if key != 'faces'}
+  with open(archive_path, 'wb') as f:
+    np.savez(f, **arrays)
+  with pytest.raises(ValueError, match='lacks'):
+    plans.load_plan(manifest_path, verify=False)
+
+
+def test_other_files_are_rejected(tmp_path):
+  path = tmp_path / ('other' + plans.MANIFEST_EXTENSION)
+  path.write_text(json.dumps({'format': 'Something else'}))
+  with pytest.raises(ValueError, match='not a Nuss bar plan'):
+    plans.load_plan(str(path))
+
+
+def test_load_plans_reports_errors(tmp_path, plan):
+  good = plans.save_plan(str(tmp_path / 'good'), plan)
+  missing = str(tmp_path / ('missing' + plans.MANIFEST_EXTENSION))
+  loaded, errors = plans.load_plans([missing, good], workers=2)
+  assert [p.name for p in loaded] == ['Case 1']
+  assert [path for path, _ in errors] == [missing]
+  assert plans.find_plans(str(tmp_path)) == [good]
@@ -0,0 +1,79 @@
+"""Skin segmentation paths of NussBarLib.segmentation on a synthetic phantom"""
+import numpy as np
+import pytest
+
+from NussBarLib import segmentation, surface, volumes
+
+import benchmark
+
+pytest.importorskip('vtk')
+pytest.importorskip('scipy')
+
+SHAPE, SPACING = (40, 48, 64), 4.0
+
+
+@pytest.fixture(scope='module')
+def phantom():
+  return benchmark.make_phantom(SHAPE, SPACING)
+
+
+@pytest.fixture(scope='module')
+def reference(phantom):
+  return surface.polydata_arrays(segmentation.extract_skin_surface(*phantom)[0])
+
+
+def sorted_points(vertices):
+  return vertices[np.lexsort(vertices.T[::-1])]
+
+
+def assert_same_surface(polydata, reference):
+  vertices, triangles = surface.polydata_arrays(polydata)
+  assert len(triangles) == len(reference[1])
+  np.testing.assert_allclose(sorted_points(vertices), sorted_points(reference[0]), atol=1e-6)
+
+
+def write_nrrd(path, voxels, ijk_to_ras):
+  """Raw little-endian NRRD of int16 voxels in (k, j, i) order"""
+  directions = ' '.join('(%.17g,%.17g,%.17g)' % tuple(ijk_to_ras[:3, axis]) for axis in range(3))
+  header = ('NRRD0004\ntype: short\ndimension: 3\nspace: right-anterior-superior\nsizes: %d %d %d\n'
+    'space directions: %s\nencoding: raw\nendian: little\nspace origin: (%.17g,%.17g,%.17g)\n\n') % (
+    voxels.shape[2], voxels.shape[1], voxels.shape[0], directions, *ijk_to_ras[:3, 3])
+  with open(path, 'wb') as f:
+    f.write(header.encode('ascii'))
+    f.write(voxels.astype('<i2').tobytes())
+
+
+def test_phantom_surface_is_closed(reference):
+  vertices, triangles = reference
+  assert len(triangles) > 0
+  # Normals split sharp edges into coincident points, which are merged first
+  _, merged = np.unique(vertices, axis=0, return_inverse=True)
+  triangles = merged.ravel()[triangles]
+  edges = np.sort(np.concatenate((triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]])), axis=1)
+  _, counts = np.unique(edges, axis=0, return_counts=True)
+  assert np.all(counts == 2)
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_parallel_matches_extract(phantom, reference, workers):
+  polydata, mask = segmentation.parallel_skin_surface(*phantom, workers=workers)
+  assert_same_surface(polydata, reference)
+
+
+@pytest.mark.parametrize('slab_slices', [8, 13, 100])
+def test_stream_matches_extract(tmp_path, phantom, reference, slab_slices):
+  path = str(tmp_path / 'phantom.nrrd')
+  write_nrrd(path, *phantom)
+  volume = volumes.read_volume(path)
+  np.testing.assert_allclose(volume.ijk_to_ras, phantom[1])
+  assert_same_surface(segmentation.stream_skin_surface(volume, slab_slices=slab_slices), reference)
+
+
+def test_smoothing_keeps_the_mask_shape(phantom):
+  voxels, ijk_to_ras = phantom
+  mask = segmentation.threshold(voxels, 100, 5000)
+  kernel = segmentation.median_kernel_size(10, segmentation.voxel_spacing(ijk_to_ras))
+  smoothed = segmentation.smooth_median(mask, kernel)
+  assert smoothed.shape == mask.shape
+  # The phantom's noise is removed, the torso is kept
+  assert np.count_nonzero(smoothed != mask) < 0.05 * mask.size
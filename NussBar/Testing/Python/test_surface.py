@@ -0,0 +1,88 @@
+"""Signed distances, snapping, clearance and candidate ranking against a surface"""
+import numpy as np
+import pytest
+
+from NussBarLib import clearance, geometry, planning, surface, sweep
+
+pytest.importorskip('scipy')
+
+
+@pytest.fixture(scope='module')
+def plane():
+  """Locator of the plane z = 0 from -200 to 200 mm, with normals towards +z"""
+  coordinates = np.linspace(-200.0, 200.0, 41)
+  x, y = np.meshgrid(coordinates, coordinates)
+  vertices = np.stack((x.ravel(), y.ravel(), np.zeros(x.size)), axis=1)
+  corner = (np.arange(40)[:, None] * 41 + np.arange(40)[None, :]).ravel()
+  triangles = np.concatenate((np.stack((corner, corner + 1, corner + 42), axis=1),
+    np.stack((corner, corner + 42, corner + 41), axis=1)))
+  return surface.SurfaceLocator(vertices, triangles)
+
+
+def arch(height, bulge=10.0, y=0.0, count=9):
+  """Fiducials along x at z = height, bulging by bulge in the middle"""
+  t = np.linspace(-1.0, 1.0, count)
+  return np.stack((100 * t, np.full(count, y), height + bulge * (1 - t**2)), axis=1)
+
+
+def test_signed_distances(plane):
+  points = np.array([[10.0, 5.0, 3.0], [-7.5, 20.0, -2.0], [0.0, 0.0, 0.0]])
+  closest, _, distances = plane.signed_distances(points)
+  np.testing.assert_allclose(distances, [3.0, -2.0, 0.0], atol=1e-9)
+  np.testing.assert_allclose(closest[:, 2], 0.0, atol=1e-9)
+
+
+def test_side_of_is_the_majority_side(plane):
+  points = np.array([[0.0, 0.0, -5.0], [10.0, 0.0, -1.0], [20.0, 0.0, 4.0]])
+  assert plane.side_of(points) == -1
+  assert plane.side_of(-points) == 1
+
+
+def test_project_keeps_one_side(plane):
+  # A curve mostly below the plane that crosses it in the middle
+  points = arch(-10.0, 12.0, count=41)
+  projected = plane.project(points, 2.0)
+  np.testing.assert_allclose(projected[:, 2], -2.0, atol=1e-9)
+  np.testing.assert_allclose(plane.project(points, 2.0, 1)[:, 2], 2.0, atol=1e-9)
+
+
+def bar_clearance(plane, points):
+  bar_points = geometry.SplineCurve(points).sample_by_length(200)
+  vertices, _ = sweep.sweep_profile(bar_points, sweep.make_profile())
+  return clearance.analyze_clearance(bar_points, vertices, plane)
+
+
+def test_clearance_of_a_bar_above_the_surface(plane):
+  result = bar_clearance(plane, arch(10.0))
+  # The bar is 2 mm thick and its width is vertical at the ends
+  assert 0 < result.min_clearance < 10.0
+  assert not result.contacts
+  assert not result.summary()['penetrates']
+
+
+def test_clearance_of_a_bar_through_the_surface(plane):
+  # Mostly below the plane, the free side, and 2 mm above it in the middle
+  result = bar_clearance(plane, arch(-10.0, 12.0))
+  assert result.min_clearance < -2.0
+  assert result.summary()['penetrates']
+  assert len(result.contacts) == 1
+
+
+def test_candidates_through_the_surface_rank_last(plane):
+  # Mostly below the plane, the free side: 25 mm, 3 mm and -2 mm away at the closest
+  point_sets = [arch(-30.0, 5.0), arch(-20.0, 17.0, y=40.0), arch(-8.0, 10.0, y=-40.0)]
+  candidates = planning.plan_candidates(point_sets, ['Clear', 'Close', 'Through'], samples=200, locator=plane,
+    clearance=5.0)
+  assert [c.name for c in candidates] == ['Clear', 'Close', 'Through']
+  through = candidates[-1]
+  assert through.penetrates and through.too_close and through.min_clearance < 0
+  assert candidates[1].too_close and not candidates[1].penetrates
+  assert candidates[0].min_clearance == pytest.approx(25.0, abs=0.01)
+
+
+def test_bend_radii_use_each_candidates_spacing():
+  t = np.linspace(0.0, np.pi / 2, 500)
+  small, large = (radius * np.stack((np.cos(t), np.sin(t), np.zeros_like(t)), axis=1) for radius in (50.0, 400.0))
+  radii = planning.bend_radii(np.stack((small, large)))
+  assert radii.shape == (2, 500)
+  np.testing.assert_allclose(np.nanmin(radii, axis=1), [50.0, 400.0], rtol=1e-6)
@@ -0,0 +1,45 @@
+"""Bar mesh generation (NussBarLib.sweep)"""
+import numpy as np
+import pytest
+
+from NussBarLib import geometry, sweep
+
+
+def centerline(samples=300):
+  t = np.linspace(-1.2, 1.2, samples)
+  return np.stack((120 * np.sin(t), 80 * np.cos(t) - 20 * np.exp(-(t / 0.3)**2), 10 * t), axis=1)
+
+
+def signed_volume(vertices, faces):
+  a, b, c = (vertices[faces[:, i]] for i in range(3))
+  return np.einsum('ij,ij->i', a, np.cross(b, c)).sum() / 6
+
+
+@pytest.mark.parametrize('frame', sweep.FRAMES)
+@pytest.mark.parametrize('profile', sweep.PROFILES)
+def test_bar_mesh_is_watertight(profile, frame):
+  vertices, faces = sweep.bar_mesh(centerline(), 200, profile, frame=frame)
+  assert np.all((faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 2] != faces[:, 0]))
+  edges = np.concatenate((faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]))
+  directed = set(map(tuple, edges))
+  # Every edge in exactly two triangles, once in each direction: closed and consistently oriented
+  assert len(directed) == len(edges)
+  assert all((b, a) in directed for a, b in directed)
+
+
+def test_bar_mesh_encloses_the_swept_volume():
+  points = centerline()
+  vertices, faces = sweep.bar_mesh(points, 1000)
+  expected = sweep.BAR_WIDTH * sweep.BAR_THICKNESS * geometry.polyline_length(points)
+  # Outward normals give a positive volume
+  assert signed_volume(vertices, faces) == pytest.approx(expected, rel=0.01)
+
+
+def test_bars_swept_together_match_one_at_a_time():
+  bars = np.stack((centerline(), centerline() + [0.0, 0.0, 30.0]))
+  profile = sweep.make_profile('rounded')
+  vertices, faces = sweep.sweep_profile(bars, profile)
+  for bar, bar_vertices in zip(bars, vertices):
+    single_vertices, single_faces = sweep.sweep_profile(bar, profile)
+    np.testing.assert_allclose(bar_vertices, single_vertices, atol=1e-9)
+    np.testing.assert_array_equal(faces, single_faces)